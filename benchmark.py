@@ -0,0 +1,1426 @@
+import argparse
+import copy
+import csv
+import itertools
+import json
+import os
+import pickle
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import h5py
+
+import numpy as np
+import torch
+from torch.nn.functional import pad
+from torch.utils.data import DataLoader, Dataset
+from torchvision.transforms.functional import crop
+
+from data.batching import ResumableSampler, get_batch_loader
+from data.clevr import project_bounding_box, project_bounding_boxes
+from data.datasets import get_dataset
+from data.depth_pack import DTYPES, DepthPackWriter, PackedDepthmaps
+from data.image_decode import DECODE_BACKENDS
+from data.vgg_cache import CachedFeatureBatches, VGGFeatureCache, vgg_feature_shapes
+from utils.amp import autocast, float32_spectral_norm
+from utils.checkpoint import (CheckpointWriter, get_rng_states, latest_checkpoint, list_checkpoints, load_checkpoint,
+                              save_checkpoint, set_rng_states)
+from utils.metrics import CsvSink, JsonlSink, MetricsAccumulator
+from utils.depth import (depth_estimation, get_bboxes_depths_from_depthmap, get_bboxes_depths_from_depthmaps,
+                         get_depth_layouts)
+from utils.util import VGGLoss, Vgg19, normalize_tensor, scale_boxes
+
+
+def timeit(fn, repeat: int) -> float:
+    '''Returns the mean time of fn() in microseconds'''
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def legacy_coco_objects(objects, WW, HH, flip, max_objects):
+    '''Per-object loop CocoSceneGraphDataset.__getitem__ used to assemble the layout'''
+    objs, boxes = [], []
+    for object_data in objects:
+        objs.append(object_data['category_id'])
+        x, y, w, h = object_data['bbox']
+        x0 = x / WW
+        y0 = y / HH
+        x1 = (w) / WW
+        y1 = (h) / HH
+        if flip:
+            x0 = 1 - (x0 + x1)
+        boxes.append(np.array([x0, y0, x1, y1]))
+
+    for _ in range(len(objs), max_objects):
+        objs.append(0)
+        boxes.append(np.array([-0.6, -0.6, 0.5, 0.5]))
+
+    return torch.LongTensor(objs), np.vstack(boxes)
+
+
+def coco_objects(args):
+    '''Per-sample cost of the layout assembly of CocoSceneGraphDataset, without image decoding'''
+    dataset = get_dataset('coco', 128, args.mode)
+    num = min(args.samples, len(dataset.image_ids))
+
+    # rebuild the raw annotation dicts the legacy loop worked on
+    legacy = []
+    for index in range(num):
+        WW, HH = dataset.image_id_to_size[dataset.image_ids[index]]
+        start, end = dataset.obj_offsets[index], dataset.obj_offsets[index + 1]
+        objects = [{'category_id': int(label), 'bbox': [x * WW, y * HH, w * WW, h * HH]}
+                   for label, (x, y, w, h) in zip(dataset.obj_labels[start:end], dataset.obj_boxes[start:end])]
+        legacy.append((objects, WW, HH))
+
+    def run_legacy():
+        for objects, WW, HH in legacy:
+            for flip in (False, True):
+                legacy_coco_objects(objects, WW, HH, flip, dataset.max_objects_per_image)
+
+    def run_vectorized():
+        for index in range(num):
+            for flip in (False, True):
+                objs, boxes = dataset.get_objects(index, flip)
+                torch.from_numpy(objs)
+
+    legacy_us = timeit(run_legacy, args.repeat) / (2 * num)
+    vectorized_us = timeit(run_vectorized, args.repeat) / (2 * num)
+
+    print(f'coco layout assembly over {num} images, both flips')
+    print(f'  per-object loop: {legacy_us:8.2f} us/sample')
+    print(f'  vectorized:      {vectorized_us:8.2f} us/sample ({legacy_us / vectorized_us:.1f}x)')
+
+
+class _PeakMemory(Dataset):
+    '''Returns the peak RSS in MB of the process loading each sample'''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        self.dataset[index]
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def vg_memory(args):
+    '''Checks that the memory-mapped VG dataset returns the same samples and compares worker memory'''
+    datasets = {}
+    for memory_map in (False, True):
+        start = time.perf_counter()
+        datasets[memory_map] = get_dataset('vg', 128, args.mode, memory_map=memory_map)
+        print(f'memory_map={memory_map}: loaded in {time.perf_counter() - start:.2f} s')
+
+    num = min(args.samples, len(datasets[False]))
+    for index in range(num):
+        samples = []
+        for memory_map in (False, True):
+            # the same objects are sampled with the same seed
+            random.seed(index)
+            samples.append(datasets[memory_map][index])
+        assert all(torch.equal(a, b) for a, b in zip(*samples)), f'sample {index} differs'
+    print(f'{num} samples identical in both modes')
+
+    for memory_map in (False, True):
+        loader = DataLoader(_PeakMemory(datasets[memory_map]), batch_size=1, shuffle=True,
+                            num_workers=args.num_workers)
+        peak = 0
+        for index, rss in enumerate(loader):
+            peak = max(peak, rss.item())
+            if index >= num:
+                break
+        print(f'memory_map={memory_map}: worker peak RSS {peak:.0f} MB')
+
+
+def legacy_scale_boxes(boxes, shape, format=None, dtype=None):
+    '''Per-box loop scale_boxes used to scale the boxes'''
+    bboxes = boxes.clone()
+    for i, box in enumerate(bboxes):
+        x, y, w, h = box
+        hh, ww = shape
+        if format is None or format == 'coordinates':
+            bboxes[i] = torch.tensor((int(x*ww), int(y*hh), int(x*ww)+int(w*ww), int(y*hh)+int(h*hh)))
+        elif format == 'size':
+            bboxes[i] = torch.tensor((int(x*ww), int(y*hh), int(w*ww), int(h*hh)))
+        elif format == 'inverse_size':
+            bboxes[i] = torch.tensor((int(y*hh), int(x*ww), int(h*hh), int(w*ww)))
+        if dtype is not None:
+            bboxes = bboxes.type(dtype)
+    return bboxes
+
+
+def scale_boxes_check(args):
+    '''Checks scale_boxes against the per-box loop on random boxes and compares their cost'''
+    generator = torch.Generator().manual_seed(0)
+    formats = (None, 'coordinates', 'size', 'inverse_size')
+    dtypes = (None, torch.int, torch.long, torch.float)
+
+    for trial in range(args.trials):
+        num_o = int(torch.randint(1, args.max_objects + 1, (1,), generator=generator))
+        shape = tuple(torch.randint(1, 1025, (2,), generator=generator).tolist())
+        # boxes in and slightly out of (0,1), with dummy objects,
+        # and boxes falling exactly on pixel boundaries
+        boxes = torch.rand(num_o, 4, generator=generator) * 1.2 - 0.1
+        boxes[::3] = torch.tensor([-0.6, -0.6, 0.5, 0.5])
+        boxes[1::4] = torch.randint(0, 9, (len(boxes[1::4]), 4), generator=generator) / 8
+        boxes = boxes.double() if trial % 2 else boxes
+
+        for format in formats:
+            for dtype in dtypes:
+                legacy = legacy_scale_boxes(boxes, shape, format, dtype)
+                vectorized = scale_boxes(boxes, shape, format, dtype)
+                assert legacy.dtype == vectorized.dtype and torch.equal(legacy, vectorized), \
+                    f'trial {trial}: {format} {dtype} differs'
+
+        # a batch is scaled as each of its images
+        batch = boxes.expand(3, num_o, 4)
+        assert torch.equal(scale_boxes(batch, shape, 'coordinates', torch.int),
+                           scale_boxes(boxes, shape, 'coordinates', torch.int).expand(3, num_o, 4))
+    print(f'{args.trials} random box sets identical for all formats and dtypes')
+
+    boxes = torch.rand(args.max_objects, 4, generator=generator)
+    legacy_us = timeit(lambda: legacy_scale_boxes(boxes, (128, 128), 'coordinates', torch.int), args.repeat)
+    vectorized_us = timeit(lambda: scale_boxes(boxes, (128, 128), 'coordinates', torch.int), args.repeat)
+    print(f'{args.max_objects} boxes: per-box loop {legacy_us:8.2f} us, '
+          f'vectorized {vectorized_us:8.2f} us ({legacy_us / vectorized_us:.1f}x)')
+
+
+def legacy_box_depths(depthmap, boxes):
+    '''Per-box crop and mean get_bboxes_depths_from_depthmap used to compute the depths'''
+    num_o = boxes.shape[0]
+    boxes = boxes[boxes[:, 0] >= 0]
+    size_boxes = legacy_scale_boxes(boxes, depthmap.shape[-2:], 'inverse_size', dtype=torch.int)
+    depths = torch.tensor([crop(depthmap, *(box.tolist())).mean() for box in size_boxes])
+    depths = normalize_tensor(depths, (0, 1))
+    return pad(depths, (0, num_o - depths.shape[0]), value=-0.5)
+
+
+def box_depths(args):
+    '''Checks the batched box depths against the per-box crops and compares their cost'''
+    generator = torch.Generator().manual_seed(0)
+    depthmaps = torch.rand(args.batch_size, args.height, args.width, generator=generator) * 30
+
+    for num_o in range(args.min_objects, args.max_objects + 1):
+        # random boxes inside the image, then dummy objects up to max_objects
+        xy = torch.rand(args.batch_size, num_o, 2, generator=generator)
+        wh = (torch.rand(args.batch_size, num_o, 2, generator=generator) * (1 - xy)).clamp(min=0.02)
+        boxes = torch.cat((xy, wh), dim=-1).double()
+        dummies = torch.tensor([-0.6, -0.6, 0.5, 0.5], dtype=boxes.dtype)
+        boxes = torch.cat((boxes, dummies.repeat(args.batch_size, args.max_objects - num_o, 1)), dim=1)
+
+        # both are compared to the crop means computed in float64,
+        # they only differ from it (and each other) in rounding
+        exact = torch.stack([legacy_box_depths(d.double(), b) for d, b in zip(depthmaps, boxes)]).float()
+        legacy = torch.stack([legacy_box_depths(d, b) for d, b in zip(depthmaps, boxes)])
+        batched = get_bboxes_depths_from_depthmaps(depthmaps, boxes)
+        assert torch.allclose(exact, batched, atol=args.atol), f'{num_o} objects: depths differ'
+
+        legacy_us = timeit(lambda: [legacy_box_depths(d, b) for d, b in zip(depthmaps, boxes)],
+                           args.repeat) / args.batch_size
+        batched_us = timeit(lambda: get_bboxes_depths_from_depthmaps(depthmaps, boxes),
+                            args.repeat) / args.batch_size
+        print(f'{num_o:2d} objects: crops {legacy_us:9.2f} us/image, '
+              f'batched {batched_us:9.2f} us/image ({legacy_us / batched_us:.1f}x), '
+              f'max error {(exact - legacy).abs().max():.1e} / {(exact - batched).abs().max():.1e}')
+
+    if args.mode is not None:
+        box_depth_table(args)
+
+
+def box_depth_table(args):
+    '''Builds the box depth table of a coco split with python -m utils.depth --box_depths and checks it loads'''
+    depth_dir = get_dataset('coco', 128, args.mode).depth_dir
+
+    with tempfile.TemporaryDirectory() as table_dir:
+        # the table is saved next to the depthmaps, link them so the real depth folder is left untouched
+        for path in Path(depth_dir).glob('*.npy'):
+            os.symlink(path.resolve(), Path(table_dir, path.name))
+
+        command = [sys.executable, '-m', 'utils.depth', '--box_depths', '--dataset', 'coco', '--mode', args.mode,
+                   '--depth_dir', table_dir, '--num_workers', str(args.num_workers)]
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=Path(__file__).parent)
+        build_s = time.perf_counter() - start
+
+        dataset = get_dataset('coco', 128, args.mode, depth_dir=table_dir, return_depth=True)
+        assert dataset.box_depths is not None, f'no box depth table in {table_dir}'
+        indices = range(min(args.limit, len(dataset.image_ids)))
+        objects = {(index, flip): dataset.get_objects(index, flip)[1]
+                   for index in indices for flip in (False, True)}
+
+        def from_table():
+            return [dataset.get_depths(index, flip, boxes) for (index, flip), boxes in objects.items()]
+
+        def from_depthmaps():
+            return [dataset.load_depths(dataset.image_id_to_filename[dataset.image_ids[index]], flip, boxes)
+                    for (index, flip), boxes in objects.items()]
+
+        for (index, flip), table, depths in zip(objects, from_table(), from_depthmaps()):
+            assert torch.allclose(table, depths.float()), f'image {index} flip {flip}: table depths differ'
+
+        table_us = timeit(from_table, args.repeat) / len(objects)
+        depthmaps_us = timeit(from_depthmaps, args.repeat) / len(objects)
+
+    print(f'box depth table of {len(dataset.image_ids)} images built in {build_s:.1f} s, '
+          f'{len(indices)} images match both flips')
+    print(f'depths per sample: depthmaps {depthmaps_us:9.2f} us, table {table_us:9.2f} us '
+          f'({depthmaps_us / table_us:.1f}x)')
+
+
+def legacy_depth_layout(depths, size, boxes):
+    '''Painter\'s algorithm get_depth_layout used to render a depth layout'''
+    boxes_depths = sorted([(i, d) for i, d in enumerate(depths[depths >= 0])], key=lambda item: item[1])
+    coord_boxes = legacy_scale_boxes(boxes, size, 'coordinates', dtype=torch.int)
+    depth_layout = torch.zeros(size)
+    for i, d in boxes_depths:
+        x, y, xmax, ymax = coord_boxes[i]
+        depth_layout[..., y:ymax, x:xmax] = d.clone().repeat(depth_layout[..., y:ymax, x:xmax].shape)
+    return depth_layout
+
+
+def depth_layout(args):
+    '''Checks the batched depth layouts against the painter\'s algorithm and compares their cost'''
+    generator = torch.Generator().manual_seed(0)
+    size = (args.image_size, args.image_size)
+
+    # random boxes and depths, with ties and 0 depths, then dummy objects
+    num_o = torch.randint(1, args.max_objects + 1, (args.batch_size,), generator=generator)
+    xy = torch.rand(args.batch_size, args.max_objects, 2, generator=generator)
+    wh = torch.rand(args.batch_size, args.max_objects, 2, generator=generator) * (1 - xy)
+    boxes = torch.cat((xy, wh), dim=-1)
+    depths = torch.randint(0, 9, (args.batch_size, args.max_objects), generator=generator) / 8
+    dummy = torch.arange(args.max_objects) >= num_o.unsqueeze(1)
+    boxes[dummy] = torch.tensor([-0.6, -0.6, 0.5, 0.5])
+    depths[dummy] = -0.5
+
+    legacy = torch.stack([legacy_depth_layout(d, size, b) for d, b in zip(depths, boxes)])
+    batched = get_depth_layouts(depths, size, boxes)
+    assert legacy.dtype == batched.dtype and torch.equal(legacy, batched), 'depth layouts differ'
+    print(f'{args.batch_size} depth layouts identical')
+
+    # CPU boxes and device depths, as in the training loop
+    if torch.cuda.is_available():
+        mixed = get_depth_layouts(depths.cuda(), size, boxes)
+        assert mixed.is_cuda and torch.equal(mixed.cpu(), legacy), 'depth layouts of CPU boxes differ'
+        print('depth layouts of CPU boxes and CUDA depths identical')
+    else:
+        print('no CUDA device, CPU boxes with CUDA depths not checked')
+
+    legacy_us = timeit(lambda: [legacy_depth_layout(d, size, b) for d, b in zip(depths, boxes)], args.repeat)
+    batched_us = timeit(lambda: get_depth_layouts(depths, size, boxes), args.repeat)
+    print(f'{args.batch_size} layouts of up to {args.max_objects} boxes: painter {legacy_us / 1000:8.2f} ms, '
+          f'batched {batched_us / 1000:8.2f} ms ({legacy_us / batched_us:.1f}x)')
+
+class StandInDepthModel(torch.nn.Module):
+    '''Small convolutional model with the input and output of MiDaS, to run depth_estimation on CPU'''
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 1, kernel_size=3, padding=1)
+
+    def forward(self, images):
+        return self.conv(images).squeeze(1)
+
+
+def stand_in_transform(image):
+    '''Resizes the shorter side of an RGB image to 384 with sizes multiple of 32, as dpt_transform'''
+    H, W = image.shape[:2]
+    scale = 384 / min(H, W)
+    size = (round(W * scale / 32) * 32, round(H * scale / 32) * 32)
+    image = cv2.resize(image, size, interpolation=cv2.INTER_CUBIC)
+    image = torch.from_numpy(image).permute(2, 0, 1).float().div(255).sub(0.5).div(0.5)
+    return image.unsqueeze(0)
+
+
+def legacy_depth_estimation(dataset, model, transform, limit):
+    '''One image at a time loop depth_estimation used to predict the depthmaps'''
+    depthmaps = {}
+    for index in range(limit):
+        filename = dataset.image_id_to_filename[dataset.image_ids[index]]
+        image = cv2.imread(str(Path(dataset.image_dir, filename)))
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        with torch.no_grad():
+            predicted_depth = model(transform(image))
+            prediction = torch.nn.functional.interpolate(
+                predicted_depth.unsqueeze(1), size=dataset.image_size, mode="bicubic", align_corners=False)
+        depthmaps[filename] = prediction.squeeze().numpy()
+    return depthmaps
+
+
+def depth_pipeline(args):
+    '''Checks the batched depth estimation with a stand-in model against the one image at a time loop'''
+    dataset = get_dataset('coco', args.image_size, args.mode)
+    limit = min(args.limit, len(dataset.image_ids))
+
+    torch.manual_seed(0)
+    model = StandInDepthModel().eval()
+
+    start = time.perf_counter()
+    legacy = legacy_depth_estimation(dataset, model, stand_in_transform, limit)
+    legacy_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as save_path:
+        start = time.perf_counter()
+        depth_estimation(dataset, 'coco', args.mode, visualize=False, save=True, limit=limit,
+                         batch_size=args.batch_size, num_workers=args.num_workers,
+                         model=model, transform=stand_in_transform, save_path=save_path)
+        batched_s = time.perf_counter() - start
+
+        for filename, depthmap in legacy.items():
+            saved = np.load(Path(save_path, filename + '.npy'))
+            assert saved.shape == depthmap.shape and np.allclose(saved, depthmap, atol=1e-5), \
+                f'{filename}: depthmaps differ'
+        print(f'{limit} depthmaps match')
+
+        # a second run finds every depthmap and has nothing to do
+        start = time.perf_counter()
+        depth_estimation(dataset, 'coco', args.mode, visualize=False, save=True, limit=limit,
+                         batch_size=args.batch_size, num_workers=args.num_workers,
+                         model=model, transform=stand_in_transform, save_path=save_path)
+        resumed_s = time.perf_counter() - start
+
+    print(f'one image at a time {legacy_s:.2f} s, batched {batched_s:.2f} s ({legacy_s / batched_s:.1f}x), '
+          f'resumed complete run {resumed_s:.2f} s')
+
+def depth_pack(args):
+    '''Measures the box depth error of packed depthmaps and compares their loading with .npy files'''
+    dataset = get_dataset('coco', 128, args.mode)
+    indices = range(min(args.limit, len(dataset.image_ids)))
+    filenames = [dataset.image_id_to_filename[dataset.image_ids[index]] for index in indices]
+    npy_paths = [Path(dataset.depth_dir, filename + '.npy') for filename in filenames]
+
+    def load_npy():
+        for path in npy_paths:
+            np.load(path)
+
+    npy_s = timeit(load_npy, args.repeat) / 1e6
+    npy_mb = sum(path.stat().st_size for path in npy_paths) / 2**20
+    print(f'.npy: {npy_mb:9.1f} MB, {len(npy_paths) / npy_s:8.1f} depthmaps/s')
+
+    # per-box depths of the full resolution depthmaps
+    exact = [get_bboxes_depths_from_depthmap(torch.from_numpy(np.load(path)),
+                                             torch.from_numpy(dataset.get_objects(index, False)[1]))
+             for index, path in zip(indices, npy_paths)]
+
+    for max_size, dtype in itertools.product(args.max_sizes, args.dtypes):
+        max_size = max_size or None
+        with tempfile.TemporaryDirectory() as pack_dir:
+            with DepthPackWriter(pack_dir, max_size, dtype) as writer:
+                for filename, path in zip(filenames, npy_paths):
+                    writer.add(filename, np.load(path))
+            pack = PackedDepthmaps(pack_dir)
+
+            def load_pack():
+                for filename in filenames:
+                    pack[filename]
+
+            pack_s = timeit(load_pack, args.repeat) / 1e6
+            pack_mb = sum(path.stat().st_size for path in Path(pack_dir).iterdir()) / 2**20
+
+            errors = []
+            for index, filename, depths in zip(indices, filenames, exact):
+                boxes = torch.from_numpy(dataset.get_objects(index, False)[1])
+                packed = get_bboxes_depths_from_depthmap(torch.from_numpy(pack[filename]), boxes)
+                errors.append((packed - depths)[depths >= 0].abs())
+            errors = torch.cat(errors)
+
+        print(f'{dtype} max_size {max_size}: {pack_mb:9.1f} MB, {len(filenames) / pack_s:8.1f} depthmaps/s, '
+              f'box depth error mean {errors.mean():.2e}, p99 {errors.quantile(0.99):.2e}, max {errors.max():.2e}')
+
+
+def image_decode(args):
+    '''Compares the speed of the image decode backends and their images with the full size decoding'''
+    datasets = {backend: get_dataset(args.dataset, args.image_size, args.mode, decode_backend=backend)
+                for backend in DECODE_BACKENDS}
+    indices = range(min(args.limit, len(datasets['pil'])))
+
+    # images are in [-1, 1]
+    reference = [datasets['pil'][index][0] for index in indices]
+
+    for backend, dataset in datasets.items():
+        def load():
+            for index in indices:
+                dataset[index]
+
+        seconds = timeit(load, args.repeat) / 1e6
+        images = [dataset[index][0] for index in indices]
+        errors = torch.stack([((image - ref) / 2).abs().mean() for image, ref in zip(images, reference)])
+        mse = torch.stack([((image - ref) / 2).pow(2).mean() for image, ref in zip(images, reference)])
+        psnr = 10 * torch.log10(1 / mse.clamp(min=1e-12))
+        print(f'{backend}: {len(indices) / seconds:8.1f} images/s per worker, mean abs error {errors.mean():.2e} '
+              f'(max {errors.max():.2e}), PSNR mean {psnr.mean():.1f} dB (min {psnr.min():.1f} dB)')
+
+
+class _IndexBatches(Dataset):
+    '''Dataset returning its indices, with a batch API as the training datasets'''
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple)):
+            return self.get_batch(index)
+        return torch.tensor(index)
+
+    def get_batch(self, indices):
+        return torch.tensor(indices)
+
+
+class _RandomChoiceBatches(_IndexBatches):
+    '''Dataset returning its indices and random draws of the worker, as VG samples the objects'''
+
+    def get_batch(self, indices):
+        draws = [(random.getrandbits(31), np.random.randint(2**31), torch.randint(2**31, ()).item())
+                 for _ in indices]
+        return torch.cat((torch.tensor(indices).unsqueeze(1), torch.tensor(draws)), dim=1)
+
+
+def resumable_sampler(args):
+    '''
+    Checks that resuming ResumableSampler in the middle of an epoch yields the remaining batches,
+    with the same random draws in the workers
+    '''
+    dataset = _RandomChoiceBatches(args.samples)
+    rng = random.Random(0)
+
+    def epoch_batches(state=None):
+        sampler = ResumableSampler(len(dataset), seed=args.seed)
+        if state is not None:
+            sampler.load_state_dict(state)
+        else:
+            sampler.set_epoch(args.epoch)
+        loader = get_batch_loader(dataset, args.batch_size, drop_last=True, sampler=sampler,
+                                  num_workers=args.num_workers)
+        return [batch.tolist() for batch in loader]
+
+    # without workers the draws come from the global generators, restored from the checkpoints
+    if args.num_workers == 0:
+        dataset = _IndexBatches(args.samples)
+
+    full = epoch_batches()
+    assert full == epoch_batches(), 'the order of an epoch is not reproducible'
+    indices = [sample if isinstance(sample, int) else sample[0] for batch in full for sample in batch]
+    assert sorted(indices) != indices, 'the samples are not shuffled'
+
+    sampler = ResumableSampler(len(dataset), seed=args.seed)
+    assert sampler.permutation(args.epoch).tolist() != sampler.permutation(args.epoch + 1).tolist(), \
+        'two epochs have the same order'
+
+    for iteration in [0, len(full) - 1, len(full)] + rng.sample(range(len(full)), min(args.trials, len(full))):
+        # state saved after iteration batches, e.g. in a checkpoint
+        sampler.set_epoch(args.epoch)
+        state = sampler.state_dict(iteration * args.batch_size)
+        assert epoch_batches(state) == full[iteration:], f'resuming after {iteration} batches differs'
+    print(f'{len(full)} batches of epoch {args.epoch}, resuming after {args.trials} random iterations '
+          f'and at the epoch boundaries yields the remaining batches')
+
+
+def checkpoint(args):
+    '''Checks that training resumed from an asynchronous checkpoint continues identically and times the saves'''
+    dataset = _IndexBatches(args.batch_size * args.iterations)
+
+    def make_training():
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(1, args.width), torch.nn.BatchNorm1d(args.width),
+                                    torch.nn.ReLU(), torch.nn.Linear(args.width, 1))
+        optimizer = torch.optim.Adam(model.parameters(), betas=(0.0, 0.999))
+        sampler = ResumableSampler(len(dataset), seed=0)
+        return model, optimizer, sampler
+
+    def train(model, optimizer, sampler, epochs, checkpoints=None, stop=None, start=(0, 0)):
+        losses = []
+        start_epoch, start_iteration = start
+        # the workers' seeds are drawn from their own generator, not the global one
+        loader = get_batch_loader(dataset, args.batch_size, drop_last=True, sampler=sampler,
+                                  generator=torch.Generator().manual_seed(0))
+        for epoch in range(start_epoch, epochs):
+            sampler.set_epoch(epoch, start_iteration * args.batch_size)
+            for idx, batch in enumerate(loader, start_iteration):
+                if (epoch, idx) == stop:
+                    return losses
+                inputs = batch.float().unsqueeze(1) / len(dataset) + torch.randn(len(batch), 1)
+                loss = model(inputs).pow(2).mean()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                losses.append(loss.item())
+                if checkpoints is not None and (idx + 1) % args.checkpoint_every == 0:
+                    checkpoints.save(epoch, idx + 1, {
+                        'epoch': epoch, 'iteration': idx + 1, 'model': model.state_dict(),
+                        'optimizer': optimizer.state_dict(),
+                        'sampler': sampler.state_dict((idx + 1) * args.batch_size, epoch), 'rng': get_rng_states()})
+            start_iteration = 0
+        return losses
+
+    reference = train(*make_training(), epochs=2)
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        # interrupted in the second epoch
+        checkpoints = CheckpointWriter(checkpoint_dir, keep_last=args.keep_last)
+        stop = (1, args.iterations - 1)
+        interrupted = train(*make_training(), epochs=2, checkpoints=checkpoints, stop=stop)
+        checkpoints.close()
+        assert len(list_checkpoints(checkpoint_dir)) == min(args.keep_last, 2 * args.iterations // args.checkpoint_every)
+
+        state = load_checkpoint(latest_checkpoint(checkpoint_dir))
+        model, optimizer, sampler = make_training()
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        sampler.load_state_dict(state['sampler'])
+        set_rng_states(state['rng'])
+        done = state['epoch'] * args.iterations + state['iteration']
+        resumed = train(model, optimizer, sampler, epochs=2, start=(state['epoch'], state['iteration']))
+
+    assert interrupted[:done] + resumed == reference, 'resumed training differs'
+    print(f'resumed after {done} of {len(reference)} iterations, the losses are identical')
+
+    # time the training loop waits for a save of a large state
+    state = {'weights': [torch.randn(args.state_mb * 2**18 // 8) for _ in range(8)]}
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        sync_us = timeit(lambda: save_checkpoint(Path(checkpoint_dir, 'sync.pth'), state), args.repeat)
+        checkpoints = CheckpointWriter(checkpoint_dir, keep_last=2, max_pending=args.repeat + 1)
+        iterations = iter(range(args.repeat + 1))
+        async_us = timeit(lambda: checkpoints.save(0, next(iterations), state), args.repeat)
+        checkpoints.close()
+    print(f'{args.state_mb} MB state: synchronous save {sync_us / 1e3:.1f} ms, '
+          f'training loop blocked by the asynchronous save {async_us / 1e3:.1f} ms')
+
+
+def metrics(args):
+    '''Checks the aggregated metrics written by MetricsAccumulator and compares its cost with .item() logging'''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    names = [f'loss_{i}' for i in range(args.metrics)]
+    torch.manual_seed(0)
+    losses = torch.rand(args.steps, args.metrics, device=device)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        jsonl, csv_path = Path(out_dir, 'metrics.jsonl'), Path(out_dir, 'metrics.csv')
+        accumulator = MetricsAccumulator([JsonlSink(jsonl), CsvSink(csv_path)], flush_every=args.flush_every)
+        for step in range(args.steps):
+            accumulator.add(step, epoch=step // 100 + 1, **dict(zip(names, losses[step])))
+        accumulator.close()
+
+        entries = [json.loads(line) for line in jsonl.read_text().splitlines()]
+        with open(csv_path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    expected = losses.cpu().double().split(args.flush_every)
+    assert len(entries) == len(rows) == len(expected)
+    for entry, row, values in zip(entries, rows, expected):
+        assert entry['step'] == int(row['step']) and entry['epoch'] == int(row['epoch']) == entry['step'] // 100 + 1
+        for i, name in enumerate(names):
+            for suffix, value in (('', values[:, i].mean()), ('_min', values[:, i].min()), ('_max', values[:, i].max())):
+                assert abs(entry[name + suffix] - value.item()) < 1e-6 and float(row[name + suffix]) == entry[name + suffix]
+    print(f'{len(entries)} aggregated entries of {args.steps} steps match in the JSONL and CSV files')
+
+    def log_items():
+        logged = []
+        for step in range(args.steps):
+            logged.append({name: value.item() for name, value in zip(names, losses[step] * 2)})
+
+    def log_accumulated():
+        accumulator = MetricsAccumulator([], flush_every=args.flush_every)
+        for step in range(args.steps):
+            accumulator.add(step, **dict(zip(names, losses[step] * 2)))
+        accumulator.close()
+
+    items_us = timeit(log_items, args.repeat)
+    accumulated_us = timeit(log_accumulated, args.repeat)
+    print(f'{device}: .item() per metric {items_us / args.steps:.1f} us/step, '
+          f'accumulated {accumulated_us / args.steps:.1f} us/step')
+
+
+def amp(args):
+    '''Checks the numerical sanity of a bf16 autocast training step of the generator on the CPU against fp32'''
+    from model.resnet_generator_v2 import ResnetGenerator128
+    from model.sync_batchnorm import SynchronizedBatchNorm2d
+    from torch.nn.utils.spectral_norm import SpectralNorm
+
+    torch.manual_seed(0)
+    reference = float32_spectral_norm(ResnetGenerator128(ch=args.ch, num_classes=args.num_classes))
+    z = torch.randn(args.batch_size, args.num_obj, 128)
+    z_im = torch.randn(args.batch_size, 128)
+    bbox = torch.rand(args.batch_size, args.num_obj, 4) * 0.5
+    y = torch.randint(0, args.num_classes, (args.batch_size, args.num_obj))
+    target = torch.rand(args.batch_size, 3, 128, 128) * 2 - 1
+
+    def step(precision):
+        netG = copy.deepcopy(reference)
+        netG.zero_grad()
+        with autocast(precision, 'cpu'):
+            fake_images = netG(z, bbox, z_im=z_im, y=y)
+            loss = torch.nn.functional.l1_loss(fake_images, target)
+        loss.backward()
+        grads = torch.cat([p.grad.flatten() for p in netG.parameters() if p.grad is not None])
+        return netG, fake_images.float(), loss.float(), grads
+
+    def relative_error(x, ref):
+        return ((x - ref).norm() / ref.norm()).item()
+
+    net32, images32, loss32, grads32 = step('fp32')
+    net16, images16, loss16, grads16 = step('bf16')
+    assert torch.isfinite(images16).all() and torch.isfinite(grads16).all(), 'non-finite bf16 outputs or gradients'
+
+    # the float32 islands keep the float32 state float32
+    for (name, m32), m16 in zip(net32.named_modules(), net16.modules()):
+        if isinstance(m16, SynchronizedBatchNorm2d):
+            assert m16.running_var.dtype == torch.float32
+            assert relative_error(m16.running_var, m32.running_var) < args.tolerance, name
+        for hook in m16._forward_pre_hooks.values():
+            if isinstance(getattr(hook, 'hook', None), SpectralNorm):
+                u16, u32 = getattr(m16, hook.name + '_u'), getattr(m32, hook.name + '_u')
+                assert u16.dtype == torch.float32 and relative_error(u16, u32) < args.tolerance, name
+
+    cosine = torch.nn.functional.cosine_similarity(grads16, grads32, dim=0).item()
+    print(f'bf16 vs fp32: images relative error {relative_error(images16, images32):.2e}, '
+          f'loss {loss16.item():.6f} vs {loss32.item():.6f}, gradients cosine similarity {cosine:.6f}')
+    assert relative_error(images16, images32) < args.tolerance and cosine > 1 - args.tolerance
+
+    fp32_us = timeit(lambda: step('fp32'), args.repeat)
+    bf16_us = timeit(lambda: step('bf16'), args.repeat)
+    print(f'cpu training step: fp32 {fp32_us / 1e6:.2f} s, bf16 {bf16_us / 1e6:.2f} s')
+
+
+def legacy_vgg_loss(vgg, weights, x, y):
+    x_vgg, y_vgg = vgg(x), vgg(y)
+    loss = 0
+
+    for i in range(len(x_vgg)):
+        loss += weights[i] * \
+            torch.nn.L1Loss()(x_vgg[i], y_vgg[i].detach())
+
+    return loss
+
+
+def vgg_loss(args):
+    '''Compares VGGLoss with the loss of the two separate VGG forward passes and times a forward and backward'''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    # the equivalence doesn't depend on the weights, the pretrained ones are a download
+    weights = [1.0 / 32, 1.0 / 16, 1.0 / 8, 1.0 / 4, 1.0]
+    legacy = Vgg19(pretrained=args.pretrained).to(device)
+    fake = torch.rand(args.batch_size, 3, args.size, args.size, device=device, requires_grad=True)
+    real = torch.rand(args.batch_size, 3, args.size, args.size, device=device)
+
+    def step(loss_fn):
+        fake.grad = None
+        loss = loss_fn(fake, real)
+        loss.backward()
+        return loss.detach(), fake.grad.clone()
+
+    reference, reference_grad = step(lambda x, y: legacy_vgg_loss(legacy, weights, x, y))
+    legacy_us = timeit(lambda: step(lambda x, y: legacy_vgg_loss(legacy, weights, x, y)), args.repeat)
+    print(f'{device}: two forward passes {legacy_us / 1e3:.0f} ms')
+
+    # same weights as the legacy copy, on a single device
+    for name, weights_, fuse in (('real under no_grad', weights, False), ('fused', weights, True),
+                                 ('up to relu3_1', weights[:3] + [0, 0], False)):
+        loss_fn = VGGLoss(weights_, device_ids=[], fuse=fuse, pretrained=False).to(device)
+        for i in range(loss_fn.vgg.num_slices):
+            getattr(loss_fn.vgg, f'slice{i + 1}').load_state_dict(getattr(legacy, f'slice{i + 1}').state_dict())
+
+        if weights_ == weights:
+            loss, grad = step(loss_fn)
+            assert torch.allclose(loss, reference, rtol=1e-5) and torch.allclose(grad, reference_grad, rtol=1e-4, atol=1e-9)
+        us = timeit(lambda: step(loss_fn), args.repeat)
+        print(f'{device}: {name} {us / 1e3:.0f} ms, {legacy_us / us:.2f}x')
+
+
+class _RandomImages(Dataset):
+    '''Dataset of random images in [-1, 1] determined by their index, with a batch API'''
+
+    def __init__(self, size, image_size):
+        self.size = size
+        self.image_size = image_size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple)):
+            return self.get_batch(index)
+        generator = torch.Generator().manual_seed(index)
+        return torch.rand(3, self.image_size, self.image_size, generator=generator) * 2 - 1
+
+    def get_batch(self, indices):
+        return torch.stack([self[index] for index in indices])
+
+
+def vgg_cache(args):
+    '''Checks the VGG losses computed from the cached real features and times them against the real VGG forward'''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    dataset = _RandomImages(args.samples, args.size)
+    loss_fn = VGGLoss(device_ids=[], pretrained=False).to(device)
+    shapes = vgg_feature_shapes((args.size, args.size))
+    sample_mb = sum(np.prod(shape) for shape in shapes) * 2 / 2**20
+
+    def fake_images(real):
+        return (real.flip(-1) * 0.5).requires_grad_()
+
+    def reference(real):
+        fake = fake_images(real)
+        loss = loss_fn(fake, real)
+        loss.backward()
+        return loss.item()
+
+    def epoch(loader, cache):
+        losses = []
+        for real, indices, features in loader:
+            real = real.to(device)
+            if features is None:
+                features = loss_fn.real_features(real)
+                cache.put(indices.numpy(), features)
+            else:
+                features = [f.to(device) for f in features]
+            fake = fake_images(real)
+            loss = loss_fn(fake, y_features=features)
+            loss.backward()
+            losses.append(loss.item())
+        return losses
+
+    references = [reference(real.to(device)) for real in get_batch_loader(dataset, args.batch_size)]
+    reference_us = timeit(lambda: [reference(real.to(device)) for real in get_batch_loader(dataset, args.batch_size)], 1)
+
+    for budget_mb in (None, args.budget_mb):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            max_bytes = None if budget_mb is None else int(budget_mb * 2**20)
+            cache = VGGFeatureCache(cache_dir, len(dataset), (args.size, args.size), max_bytes=max_bytes)
+            loader = get_batch_loader(CachedFeatureBatches(dataset, cache), args.batch_size,
+                                      num_workers=args.num_workers)
+
+            first = epoch(loader, cache)
+            assert first == references, 'the losses of the first epoch differ'
+            assert cache.cached(np.arange(len(dataset))).all()
+            cached = epoch(loader, cache)
+            error = max(abs(a - b) / b for a, b in zip(cached, references))
+            cached_us = timeit(lambda: epoch(loader, cache), 1)
+
+        print(f'{device}: {cache.num_slices} cached slices ({sample_mb:.2f} MB per image without budget): '
+              f'max relative loss error {error:.1e}, epoch {reference_us / 1e6:.2f} s -> {cached_us / 1e6:.2f} s, '
+              f'{reference_us / cached_us:.2f}x')
+        assert error < 1e-2
+
+
+def legacy_combine_discriminator(netD, images, bbox, label):
+    idx = torch.arange(start=0, end=images.size(0),
+                       device=images.device).view(images.size(0),
+                                                  1, 1).expand(-1, bbox.size(1), -1).float()
+    bbox[:, :, 2] = bbox[:, :, 2] + bbox[:, :, 0]
+    bbox[:, :, 3] = bbox[:, :, 3] + bbox[:, :, 1]
+    bbox = bbox * images.size(2)
+    bbox = torch.cat((idx, bbox.float()), dim=2)
+    bbox = bbox.view(-1, 5)
+    label = label.view(-1)
+
+    idx = (label != 0).nonzero().view(-1)
+    bbox = bbox[idx]
+    label = label[idx]
+    d_out_img, d_out_obj = netD.obD(images, label, bbox)
+    return d_out_img, d_out_obj
+
+
+def legacy_training_step(netG, netD, g_optimizer, d_optimizer, vgg_loss, real_images, label, bbox, z,
+                         lamb_obj=1.0, lamb_img=0.1):
+    # bbox is modified by each call, nn.DataParallel gave them their own copies
+    netD.zero_grad()
+    d_out_real, d_out_robj = legacy_combine_discriminator(netD, real_images, bbox.clone(), label)
+    d_loss_real = torch.nn.ReLU()(1.0 - d_out_real).mean()
+    d_loss_robj = torch.nn.ReLU()(1.0 - d_out_robj).mean()
+
+    fake_images = netG(z, bbox, y=label.squeeze(dim=-1))
+
+    d_out_fake, d_out_fobj = legacy_combine_discriminator(netD, fake_images.detach(), bbox.clone(), label)
+    d_loss_fake = torch.nn.ReLU()(1.0 + d_out_fake).mean()
+    d_loss_fobj = torch.nn.ReLU()(1.0 + d_out_fobj).mean()
+
+    d_loss = lamb_obj * (d_loss_robj + d_loss_fobj) + \
+        lamb_img * (d_loss_real + d_loss_fake)
+    d_loss.backward()
+    d_optimizer.step()
+
+    netG.zero_grad()
+    g_out_fake, g_out_obj = legacy_combine_discriminator(netD, fake_images, bbox.clone(), label)
+    g_loss_fake = - g_out_fake.mean()
+    g_loss_obj = - g_out_obj.mean()
+
+    pixel_loss = torch.nn.L1Loss()(fake_images, real_images).mean()
+    feat_loss = vgg_loss(fake_images, real_images).mean()
+
+    g_loss = g_loss_obj * lamb_obj + g_loss_fake * lamb_img + pixel_loss + feat_loss
+    g_loss.backward()
+    g_optimizer.step()
+    return d_loss.item(), g_loss.item()
+
+
+def training_step(args):
+    '''Checks TrainingStep against the legacy training iteration and times its G step schedules'''
+    from model.rcnn_discriminator import CombineDiscriminator128
+    from model.resnet_generator_v2 import ResnetGenerator128
+    from utils.training_step import TrainingStep
+
+    torch.manual_seed(0)
+    num_classes = 10
+    initial_G = ResnetGenerator128(ch=args.ch, num_classes=num_classes)
+    initial_D = CombineDiscriminator128(num_classes=num_classes)
+    vgg = VGGLoss(device_ids=[], pretrained=False)
+    batches = []
+    for _ in range(args.iterations):
+        label = torch.randint(0, num_classes, (args.batch_size, args.num_obj, 1))
+        label[:, -2:] = 0
+        batches.append((torch.rand(args.batch_size, 3, 128, 128) * 2 - 1, label,
+                        torch.rand(args.batch_size, args.num_obj, 4) * 0.5,
+                        torch.randn(args.batch_size, args.num_obj, 128)))
+
+    def make_training():
+        netG, netD = copy.deepcopy(initial_G), copy.deepcopy(initial_D)
+        g_optimizer = torch.optim.Adam(netG.parameters(), lr=1e-4, betas=(0.0, 0.999))
+        d_optimizer = torch.optim.Adam(netD.parameters(), lr=1e-4, betas=(0.0, 0.999))
+        return netG, netD, g_optimizer, d_optimizer
+
+    def parameters(*nets):
+        return torch.cat([p.detach().flatten() for net in nets for p in net.parameters()])
+
+    netG, netD, g_optimizer, d_optimizer = make_training()
+    torch.manual_seed(1)
+    reference = [legacy_training_step(netG, netD, g_optimizer, d_optimizer, vgg, *batch) for batch in batches]
+    reference_parameters = parameters(netG, netD)
+
+    netG, netD, g_optimizer, d_optimizer = make_training()
+    step = TrainingStep(netG, netD, g_optimizer, d_optimizer, vgg, torch.nn.L1Loss())
+    torch.manual_seed(1)
+    losses = []
+    for iteration, (real_images, label, bbox, z) in enumerate(batches):
+        original = bbox.clone()
+        d_losses, g_losses, _ = step(iteration, real_images, label, bbox, z)
+        assert torch.equal(bbox, original), 'the boxes were modified'
+        losses.append((d_losses['d_loss'].item(), g_losses['g_loss'].item()))
+    assert losses == reference and torch.equal(parameters(netG, netD), reference_parameters)
+    print(f'{args.iterations} iterations: the losses and parameters are identical to the legacy training step')
+
+    for g_every in (1, 2, 4):
+        netG, netD, g_optimizer, d_optimizer = make_training()
+        step = TrainingStep(netG, netD, g_optimizer, d_optimizer, vgg, torch.nn.L1Loss(), g_every=g_every)
+        iterations, cycle = itertools.count(), itertools.cycle(batches)
+
+        def train():
+            step(next(iterations), *next(cycle))
+
+        us = timeit(train, args.repeat * g_every)
+        print(f'g_every={g_every}: {us / 1e3:.0f} ms per iteration')
+
+
+def _distributed_worker(rank, world_size, port, out_dir, args):
+    from model.sync_batchnorm import SynchronizedBatchNorm2d, set_process_group
+    from utils.distributed import average_gradients, broadcast_module
+
+    torch.distributed.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}',
+                                         rank=rank, world_size=world_size)
+    images = torch.randn(args.samples, 3, 8, 8, generator=torch.Generator().manual_seed(0))
+    # a different initialization in each process, replaced by rank 0's
+    torch.manual_seed(rank)
+    model = set_process_group(_distributed_model(SynchronizedBatchNorm2d))
+    broadcast_module(model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2, betas=(0.0, 0.999))
+    sampler = ResumableSampler(args.samples, seed=0, num_replicas=world_size, rank=rank)
+    loader = get_batch_loader(_IndexBatches(args.samples), args.batch_size, drop_last=True, sampler=sampler)
+
+    batches = []
+    for epoch in range(args.epochs):
+        sampler.set_epoch(epoch)
+        for indices in loader:
+            loss = model(images[indices]).pow(2).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            average_gradients(model)
+            optimizer.step()
+            batches.append(indices)
+    torch.save({'batches': batches, 'state': model.state_dict()}, os.path.join(out_dir, f'rank{rank}.pth'))
+    torch.distributed.destroy_process_group()
+
+
+def _distributed_model(batch_norm):
+    return torch.nn.Sequential(torch.nn.utils.spectral_norm(torch.nn.Conv2d(3, 8, 3, padding=1, bias=False)), batch_norm(8),
+                               torch.nn.ReLU(), torch.nn.Conv2d(8, 1, 3, padding=1))
+
+
+def distributed(args):
+    '''
+    Checks that training in two gloo processes on the CPU, with sharded samplers, all-reduced
+    sync batch norm statistics and averaged gradients, matches one process on the concatenated batches
+    '''
+    import socket
+    import torch.multiprocessing as mp
+    from model.sync_batchnorm import SynchronizedBatchNorm2d
+
+    world_size = 2
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        mp.spawn(_distributed_worker, args=(world_size, port, out_dir, args), nprocs=world_size)
+        results = [torch.load(os.path.join(out_dir, f'rank{rank}.pth')) for rank in range(world_size)]
+
+    for key, value in results[0]['state'].items():
+        assert torch.equal(value, results[1]['state'][key]), f'{key} differs between the processes'
+    iterations = len(results[0]['batches'])
+    per_epoch = iterations // args.epochs
+    for epoch in range(args.epochs):
+        shards = [torch.cat(result['batches'][epoch * per_epoch:(epoch + 1) * per_epoch]) for result in results]
+        assert not set(shards[0].tolist()) & set(shards[1].tolist()), f'the shards of epoch {epoch} overlap'
+
+    # one process on the concatenated batches, with the initialization of rank 0
+    images = torch.randn(args.samples, 3, 8, 8, generator=torch.Generator().manual_seed(0))
+    torch.manual_seed(0)
+    model = _distributed_model(SynchronizedBatchNorm2d)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2, betas=(0.0, 0.999))
+    for batches in zip(*(result['batches'] for result in results)):
+        loss = model(images[torch.cat(batches)]).pow(2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    errors = {key: (value - results[0]['state'][key]).abs().max().item()
+              for key, value in model.state_dict().items() if value.is_floating_point()}
+    assert max(errors.values()) < 1e-4, errors
+    print(f'{iterations} iterations in {world_size} processes of {args.batch_size} images: parameters and running '
+          f'statistics match one process on batches of {world_size * args.batch_size} images '
+          f'(max abs difference {max(errors.values()):.1e})')
+
+
+def _sync_batchnorm_worker(rank, world_size, port, out_dir, args):
+    from model.sync_batchnorm import SynchronizedBatchNorm2d
+
+    torch.distributed.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}',
+                                         rank=rank, world_size=world_size)
+    group = torch.distributed.new_group(list(range(world_size)))
+    inputs, grads, checkpoint = _sync_batchnorm_data(world_size, args)
+    bn = SynchronizedBatchNorm2d(args.channels, process_group=group)
+    bn.load_state_dict(checkpoint)
+
+    outputs, input_grads = [], []
+    for x, grad in zip(inputs, grads):
+        x = x.chunk(world_size)[rank].requires_grad_()
+        output = bn(x)
+        output.backward(grad.chunk(world_size)[rank])
+        outputs.append(output.detach())
+        input_grads.append(x.grad)
+    bn.eval()
+    outputs.append(bn(inputs[0].chunk(world_size)[rank]).detach())
+
+    assert pickle.loads(pickle.dumps(bn))._process_group is None, 'the process group was pickled'
+    torch.save({'outputs': outputs, 'input_grads': input_grads, 'weight_grad': bn.weight.grad,
+                'bias_grad': bn.bias.grad, 'state': bn.state_dict()}, os.path.join(out_dir, f'rank{rank}.pth'))
+    torch.distributed.destroy_process_group()
+
+
+def _sync_batchnorm_data(world_size, args):
+    generator = torch.Generator().manual_seed(0)
+    shape = (world_size * args.batch_size, args.channels, args.size, args.size)
+    inputs = [torch.randn(shape, generator=generator) * 3 + 1 for _ in range(args.steps)]
+    grads = [torch.randn(shape, generator=generator) for _ in range(args.steps)]
+    # a checkpoint of a layer trained without process groups
+    checkpoint = torch.nn.BatchNorm2d(args.channels).state_dict()
+    for value in checkpoint.values():
+        if value.is_floating_point():
+            value.uniform_(0.5, 1.5, generator=generator)
+    return inputs, grads, checkpoint
+
+
+def sync_batchnorm(args):
+    '''
+    Checks SynchronizedBatchNorm2d synchronized across two gloo processes on the CPU against
+    a single process BatchNorm2d over the concatenated batch
+    '''
+    import socket
+    import torch.multiprocessing as mp
+
+    world_size = 2
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        mp.spawn(_sync_batchnorm_worker, args=(world_size, port, out_dir, args), nprocs=world_size)
+        results = [torch.load(os.path.join(out_dir, f'rank{rank}.pth')) for rank in range(world_size)]
+
+    inputs, grads, checkpoint = _sync_batchnorm_data(world_size, args)
+    bn = torch.nn.BatchNorm2d(args.channels)
+    bn.load_state_dict(checkpoint)
+    outputs, input_grads = [], []
+    for x, grad in zip(inputs, grads):
+        x = x.clone().requires_grad_()
+        output = bn(x)
+        output.backward(grad)
+        outputs.append(output.detach())
+        input_grads.append(x.grad)
+    bn.eval()
+    outputs.append(bn(inputs[0]).detach())
+
+    def max_error(synchronized, reference):
+        return (synchronized - reference).abs().max().item()
+
+    errors = {
+        'outputs': max(max_error(torch.cat(shards), reference)
+                       for *shards, reference in zip(*(result['outputs'] for result in results), outputs)),
+        'input_grads': max(max_error(torch.cat(shards), reference)
+                           for *shards, reference in zip(*(result['input_grads'] for result in results), input_grads)),
+        # the loss is the sum of the processes' losses
+        'weight_grad': max_error(sum(result['weight_grad'] for result in results), bn.weight.grad),
+        'bias_grad': max_error(sum(result['bias_grad'] for result in results), bn.bias.grad),
+    }
+    # num_batches_tracked is only counted by BatchNorm2d, the momentum is fixed
+    for key in ('running_mean', 'running_var', 'weight', 'bias'):
+        errors[key] = max(max_error(result['state'][key], bn.state_dict()[key]) for result in results)
+    assert set(results[0]['state']) == set(checkpoint), 'the state dict keys changed'
+    assert max(errors.values()) < 1e-4, errors
+    print(f'{args.steps} steps in {world_size} processes of {args.batch_size} images: outputs, gradients and '
+          f'running statistics match BatchNorm2d over the concatenated batch '
+          f'(max abs difference {max(errors.values()):.1e})')
+
+
+def clevr_boxes(args):
+    '''Checks the vectorized CLEVR box projection against the scalar one and compares their speed'''
+    if args.scenes_json is not None:
+        with open(args.scenes_json, 'r') as fj:
+            scenes = json.load(fj)['scenes']
+    else:
+        # random scenes in the ranges of the CLEVR coordinates
+        rng = np.random.default_rng(0)
+        scenes = []
+        for _ in range(args.scenes):
+            angle = rng.uniform(0, 2 * np.pi)
+            scenes.append({
+                'directions': {'right': [np.cos(angle), np.sin(angle), 0.0]},
+                'objects': [{'pixel_coords': [rng.uniform(0, 480), rng.uniform(0, 320), rng.uniform(7, 15)],
+                             '3d_coords': [rng.uniform(-3, 3), rng.uniform(-3, 3), rng.choice([0.35, 0.7])],
+                             'shape': rng.choice(['cube', 'sphere', 'cylinder'])}
+                            for _ in range(rng.integers(3, 11))]
+            })
+
+    objs = [(obj, scene['directions']['right']) for scene in scenes for obj in scene['objects']]
+
+    def run_scalar():
+        return np.array([project_bounding_box(obj, rotation) for obj, rotation in objs])
+
+    def to_arrays():
+        return (np.array([obj['pixel_coords'] for obj, _ in objs], dtype=np.float64),
+                np.array([obj['3d_coords'] for obj, _ in objs], dtype=np.float64),
+                np.array([rotation for _, rotation in objs], dtype=np.float64),
+                np.array([obj['shape'] for obj, _ in objs], dtype=str))
+
+    arrays = to_arrays()
+
+    def run_vectorized():
+        return project_bounding_boxes(*arrays)
+
+    scalar, vectorized = run_scalar(), run_vectorized()
+    difference = np.abs(scalar - vectorized).max() if len(objs) > 0 else 0.0
+    assert scalar.shape == vectorized.shape and np.allclose(scalar, vectorized, rtol=1e-12, atol=1e-12), \
+        f'max difference {difference:.2e}'
+    print(f'{len(objs)} boxes of {len(scenes)} scenes match, max difference {difference:.2e}')
+
+    scalar_us = timeit(run_scalar, args.repeat)
+    vectorized_us = timeit(run_vectorized, args.repeat)
+    arrays_us = timeit(to_arrays, args.repeat)
+    print(f'scalar {scalar_us / 1e3:.1f} ms, vectorized {vectorized_us / 1e3:.1f} ms ({scalar_us / vectorized_us:.1f}x), '
+          f'conversion of the objects to arrays {arrays_us / 1e3:.1f} ms')
+
+
+def run_preprocess_vg(script_args, out_dir, streaming):
+    '''Runs scripts/preprocess_vg.py, returns its wall time in seconds and peak RSS in MB'''
+    command = [sys.executable, str(Path(__file__).parent / 'scripts' / 'preprocess_vg.py'), *script_args,
+               '--output_vocab_json', os.path.join(out_dir, 'vocab.json'), '--output_h5_dir', out_dir,
+               '--streaming' if streaming else '--no-streaming']
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    # the rusage of the script only, the pool workers are its children
+    _, status, usage = os.wait4(process.pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0, f'{" ".join(command)} failed'
+    return time.perf_counter() - start, usage.ru_maxrss / 1024
+
+
+def preprocess_vg(args):
+    '''Checks that the streaming preprocess_vg.py writes the same files and compares time and memory'''
+    script_args = args.script_args[1:] if args.script_args[:1] == ['--'] else args.script_args
+
+    with tempfile.TemporaryDirectory() as legacy_dir, tempfile.TemporaryDirectory() as streaming_dir:
+        for streaming, out_dir in ((False, legacy_dir), (True, streaming_dir)):
+            seconds, peak = run_preprocess_vg(script_args, out_dir, streaming)
+            print(f'streaming={streaming}: {seconds:.1f} s, peak RSS {peak:.0f} MB')
+
+        with open(os.path.join(legacy_dir, 'vocab.json'), 'rb') as legacy, \
+                open(os.path.join(streaming_dir, 'vocab.json'), 'rb') as streaming:
+            assert legacy.read() == streaming.read(), 'vocab.json differs'
+
+        splits = sorted(name for name in os.listdir(legacy_dir) if name.endswith('.h5'))
+        assert splits == sorted(name for name in os.listdir(streaming_dir) if name.endswith('.h5'))
+        for split in splits:
+            with h5py.File(os.path.join(legacy_dir, split), 'r') as legacy, \
+                    h5py.File(os.path.join(streaming_dir, split), 'r') as streaming:
+                assert list(legacy.keys()) == list(streaming.keys()), f'{split}: datasets differ'
+                for name in legacy.keys():
+                    a, b = legacy[name], streaming[name]
+                    assert a.dtype == b.dtype and a.shape == b.shape, f'{split}/{name}: dtype or shape differs'
+                    assert np.array_equal(a[()], b[()]), f'{split}/{name}: values differ'
+                    # contiguous, memory-mapped by data/vg.py
+                    assert b.chunks is None, f'{split}/{name}: chunked dataset'
+            with open(os.path.join(legacy_dir, split), 'rb') as legacy, \
+                    open(os.path.join(streaming_dir, split), 'rb') as streaming:
+                assert legacy.read() == streaming.read(), f'{split}: file bytes differ'
+            print(f'{split}: identical file bytes')
+        assert not [name for name in os.listdir(streaming_dir) if name.endswith('.tmp')], 'temporary files left'
+        print('vocab.json identical')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_coco = subparsers.add_parser('coco_objects', help=coco_objects.__doc__)
+    parser_coco.add_argument('--mode', type=str, default='val',
+                             help='coco split to use')
+    parser_coco.add_argument('--samples', type=int, default=1000,
+                             help='number of images to assemble')
+    parser_coco.add_argument('--repeat', type=int, default=10,
+                             help='number of timed runs')
+    parser_coco.set_defaults(func=coco_objects)
+
+    parser_vg = subparsers.add_parser('vg_memory', help=vg_memory.__doc__)
+    parser_vg.add_argument('--mode', type=str, default='val',
+                           help='vg split to use')
+    parser_vg.add_argument('--samples', type=int, default=500,
+                           help='number of samples to compare and load')
+    parser_vg.add_argument('--num_workers', type=int, default=8,
+                           help='number of DataLoader workers')
+    parser_vg.set_defaults(func=vg_memory)
+
+    parser_depths = subparsers.add_parser('box_depths', help=box_depths.__doc__)
+    parser_depths.add_argument('--batch_size', type=int, default=32,
+                               help='number of depthmaps in a batch')
+    parser_depths.add_argument('--height', type=int, default=480,
+                               help='depthmap height')
+    parser_depths.add_argument('--width', type=int, default=640,
+                               help='depthmap width')
+    parser_depths.add_argument('--min_objects', type=int, default=8,
+                               help='minimum number of boxes per depthmap')
+    parser_depths.add_argument('--max_objects', type=int, default=31,
+                               help='maximum number of boxes per depthmap, the rest are dummies')
+    parser_depths.add_argument('--atol', type=float, default=1e-4,
+                               help='tolerance of the normalized depths with respect to float64 crop means')
+    parser_depths.add_argument('--repeat', type=int, default=5,
+                               help='number of timed runs')
+    parser_depths.add_argument('--mode', type=str, default=None,
+                               help='coco split to also build the box depth table of and load it back, '
+                                    'from its depthmaps in datasets/coco-depth/<mode>')
+    parser_depths.add_argument('--limit', type=int, default=200,
+                               help='number of images whose table depths are checked against the depthmaps')
+    parser_depths.add_argument('--num_workers', type=int, default=4,
+                               help='DataLoader workers building the table')
+    parser_depths.set_defaults(func=box_depths)
+
+    parser_scale = subparsers.add_parser('scale_boxes', help=scale_boxes_check.__doc__)
+    parser_scale.add_argument('--trials', type=int, default=200,
+                              help='number of random box sets to compare')
+    parser_scale.add_argument('--max_objects', type=int, default=31,
+                              help='maximum number of boxes per set')
+    parser_scale.add_argument('--repeat', type=int, default=1000,
+                              help='number of timed runs')
+    parser_scale.set_defaults(func=scale_boxes_check)
+
+    parser_layout = subparsers.add_parser('depth_layout', help=depth_layout.__doc__)
+    parser_layout.add_argument('--batch_size', type=int, default=128,
+                               help='number of layouts in a batch')
+    parser_layout.add_argument('--image_size', type=int, default=128,
+                               help='size of the layouts')
+    parser_layout.add_argument('--max_objects', type=int, default=8,
+                               help='maximum number of boxes per layout, the rest are dummies')
+    parser_layout.add_argument('--repeat', type=int, default=10,
+                               help='number of timed runs')
+    parser_layout.set_defaults(func=depth_layout)
+
+    parser_midas = subparsers.add_parser('depth_pipeline', help=depth_pipeline.__doc__)
+    parser_midas.add_argument('--mode', type=str, default='val',
+                              help='coco split to use')
+    parser_midas.add_argument('--image_size', type=int, default=128,
+                              help='size of the depthmaps')
+    parser_midas.add_argument('--limit', type=int, default=200,
+                              help='number of images to process')
+    parser_midas.add_argument('--batch_size', type=int, default=8,
+                              help='number of images in an inference batch')
+    parser_midas.add_argument('--num_workers', type=int, default=4,
+                              help='number of workers reading the images')
+    parser_midas.set_defaults(func=depth_pipeline)
+
+    parser_pack = subparsers.add_parser('depth_pack', help=depth_pack.__doc__)
+    parser_pack.add_argument('--mode', type=str, default='val',
+                             help='coco split to use, its .npy depthmaps must exist')
+    parser_pack.add_argument('--limit', type=int, default=500,
+                             help='number of depthmaps to pack')
+    parser_pack.add_argument('--max_sizes', type=int, nargs='+', default=[0, 256],
+                             help='maximum sizes of the longer side of the packed depthmaps to compare, 0 for full resolution')
+    parser_pack.add_argument('--dtypes', type=str, nargs='+', default=list(DTYPES), choices=DTYPES,
+                             help='storage types to compare')
+    parser_pack.add_argument('--repeat', type=int, default=3,
+                             help='number of timed runs')
+    parser_pack.set_defaults(func=depth_pack)
+
+    parser_decode = subparsers.add_parser('image_decode', help=image_decode.__doc__)
+    parser_decode.add_argument('--dataset', type=str, default='coco',
+                               help='dataset to load')
+    parser_decode.add_argument('--mode', type=str, default='val',
+                               help='split to use')
+    parser_decode.add_argument('--image_size', type=int, default=128,
+                               help='size of the images')
+    parser_decode.add_argument('--limit', type=int, default=500,
+                               help='number of samples to load')
+    parser_decode.add_argument('--repeat', type=int, default=3,
+                               help='number of timed runs')
+    parser_decode.set_defaults(func=image_decode)
+
+    parser_sampler = subparsers.add_parser('resumable_sampler', help=resumable_sampler.__doc__)
+    parser_sampler.add_argument('--samples', type=int, default=1000,
+                                help='size of the dataset')
+    parser_sampler.add_argument('--batch_size', type=int, default=32,
+                                help='number of samples in a batch')
+    parser_sampler.add_argument('--seed', type=int, default=0,
+                                help='seed of the sampler')
+    parser_sampler.add_argument('--epoch', type=int, default=3,
+                                help='epoch to check')
+    parser_sampler.add_argument('--trials', type=int, default=5,
+                                help='number of random iterations to resume from')
+    parser_sampler.add_argument('--num_workers', type=int, default=2,
+                                help='number of DataLoader workers')
+    parser_sampler.set_defaults(func=resumable_sampler)
+
+    parser_checkpoint = subparsers.add_parser('checkpoint', help=checkpoint.__doc__)
+    parser_checkpoint.add_argument('--iterations', type=int, default=20,
+                                   help='number of iterations per epoch of the toy training')
+    parser_checkpoint.add_argument('--batch_size', type=int, default=8,
+                                   help='number of samples in a batch')
+    parser_checkpoint.add_argument('--width', type=int, default=64,
+                                   help='width of the toy model')
+    parser_checkpoint.add_argument('--checkpoint_every', type=int, default=3,
+                                   help='number of iterations between two checkpoints')
+    parser_checkpoint.add_argument('--keep_last', type=int, default=3,
+                                   help='number of checkpoints to keep')
+    parser_checkpoint.add_argument('--state_mb', type=int, default=256,
+                                   help='size of the state of the timed saves')
+    parser_checkpoint.add_argument('--repeat', type=int, default=3,
+                                   help='number of timed saves')
+    parser_checkpoint.set_defaults(func=checkpoint)
+
+    parser_metrics = subparsers.add_parser('metrics', help=metrics.__doc__)
+    parser_metrics.add_argument('--steps', type=int, default=1000,
+                                help='number of logged steps')
+    parser_metrics.add_argument('--metrics', type=int, default=11,
+                                help='number of metrics per step')
+    parser_metrics.add_argument('--flush_every', type=int, default=50,
+                                help='number of steps aggregated in a log entry')
+    parser_metrics.add_argument('--repeat', type=int, default=3,
+                                help='number of timed runs')
+    parser_metrics.set_defaults(func=metrics)
+
+    parser_amp = subparsers.add_parser('amp', help=amp.__doc__)
+    parser_amp.add_argument('--batch_size', type=int, default=2,
+                            help='number of images in a batch')
+    parser_amp.add_argument('--num_obj', type=int, default=8,
+                            help='number of objects per image')
+    parser_amp.add_argument('--num_classes', type=int, default=10,
+                            help='number of object classes')
+    parser_amp.add_argument('--ch', type=int, default=16,
+                            help='channel multiplier of the generator, 64 in training')
+    parser_amp.add_argument('--tolerance', type=float, default=0.05,
+                            help='maximum relative error of bf16 against fp32')
+    parser_amp.add_argument('--repeat', type=int, default=2,
+                            help='number of timed training steps')
+    parser_amp.set_defaults(func=amp)
+
+    parser_vgg = subparsers.add_parser('vgg_loss', help=vgg_loss.__doc__)
+    parser_vgg.add_argument('--batch_size', type=int, default=4,
+                            help='number of fake and real images')
+    parser_vgg.add_argument('--size', type=int, default=128,
+                            help='image size')
+    parser_vgg.add_argument('--pretrained', action=argparse.BooleanOptionalAction, default=False,
+                            help='load the ImageNet weights of VGG19')
+    parser_vgg.add_argument('--repeat', type=int, default=3,
+                            help='number of timed steps')
+    parser_vgg.set_defaults(func=vgg_loss)
+
+    parser_vgg_cache = subparsers.add_parser('vgg_cache', help=vgg_cache.__doc__)
+    parser_vgg_cache.add_argument('--samples', type=int, default=32,
+                                  help='number of images of the dataset')
+    parser_vgg_cache.add_argument('--batch_size', type=int, default=4,
+                                  help='number of images in a batch')
+    parser_vgg_cache.add_argument('--size', type=int, default=128,
+                                  help='image size')
+    parser_vgg_cache.add_argument('--budget_mb', type=float, default=96,
+                                  help='size budget of the second cache, only its shallow slices fit')
+    parser_vgg_cache.add_argument('--num_workers', type=int, default=2,
+                                  help='number of DataLoader workers reading the cache')
+    parser_vgg_cache.set_defaults(func=vgg_cache)
+
+    parser_step = subparsers.add_parser('training_step', help=training_step.__doc__)
+    parser_step.add_argument('--iterations', type=int, default=3,
+                             help='number of compared iterations')
+    parser_step.add_argument('--batch_size', type=int, default=2,
+                             help='number of images in a batch')
+    parser_step.add_argument('--num_obj', type=int, default=8,
+                             help='number of objects per image, the last two are padding')
+    parser_step.add_argument('--ch', type=int, default=16,
+                             help='channel multiplier of the generator, 64 in training')
+    parser_step.add_argument('--repeat', type=int, default=2,
+                             help='number of timed G steps')
+    parser_step.set_defaults(func=training_step)
+
+    parser_distributed = subparsers.add_parser('distributed', help=distributed.__doc__)
+    parser_distributed.add_argument('--samples', type=int, default=64,
+                                    help='number of samples of the dataset')
+    parser_distributed.add_argument('--batch_size', type=int, default=8,
+                                    help='number of images in a batch of each process')
+    parser_distributed.add_argument('--epochs', type=int, default=2,
+                                    help='number of training epochs')
+    parser_distributed.set_defaults(func=distributed)
+
+    parser_sync_bn = subparsers.add_parser('sync_batchnorm', help=sync_batchnorm.__doc__)
+    parser_sync_bn.add_argument('--batch_size', type=int, default=4,
+                                help='number of images of each process')
+    parser_sync_bn.add_argument('--channels', type=int, default=16,
+                                help='number of channels')
+    parser_sync_bn.add_argument('--size', type=int, default=8,
+                                help='height and width of the inputs')
+    parser_sync_bn.add_argument('--steps', type=int, default=3,
+                                help='number of training steps')
+    parser_sync_bn.set_defaults(func=sync_batchnorm)
+
+    parser_clevr = subparsers.add_parser('clevr_boxes', help=clevr_boxes.__doc__)
+    parser_clevr.add_argument('--scenes_json', type=str, default=None,
+                              help='CLEVR scenes file to project, random scenes if not given')
+    parser_clevr.add_argument('--scenes', type=int, default=10000,
+                              help='number of random scenes')
+    parser_clevr.add_argument('--repeat', type=int, default=3,
+                              help='number of timed runs')
+    parser_clevr.set_defaults(func=clevr_boxes)
+
+    parser_prep = subparsers.add_parser('preprocess_vg', help=preprocess_vg.__doc__)
+    parser_prep.add_argument('script_args', nargs=argparse.REMAINDER,
+                             help='arguments of scripts/preprocess_vg.py after --, except the outputs and --streaming')
+    parser_prep.set_defaults(func=preprocess_vg)
+
+    args = parser.parse_args()
+    args.func(args)
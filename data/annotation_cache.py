@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+
+# bump when the layout of a cache changes, old entries are then ignored
+CACHE_VERSION = 1
+
+META_FILENAME = 'meta.json'
+
+
+def file_hash(path: Union[str, Path], chunk_size: int = 1 << 24) -> str:
+    '''Returns the sha1 of the file content, read in chunks'''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_key(files: list, **kwargs) -> str:
+    '''
+    Key for a cache entry built from the content of the source files and
+    the arguments used to process them, kwargs must be json serializable
+
+    Missing files (None or '') are part of the key as well.
+    '''
+    sha = hashlib.sha1()
+    sha.update(str(CACHE_VERSION).encode())
+    for path in files:
+        sha.update((file_hash(path) if path else 'None').encode())
+    sha.update(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def load_cache(cache_dir: Union[str, Path], key: str):
+    '''
+    Loads a cache entry saved by save_cache
+
+    Returns:
+        (arrays, meta): dict of read-only memory-mapped numpy arrays and the
+                        json metadata, or None if there is no entry for the key
+    '''
+    entry = Path(cache_dir, key)
+    if not Path(entry, META_FILENAME).is_file():
+        return None
+
+    with open(Path(entry, META_FILENAME), 'r') as fj:
+        meta = json.load(fj)
+
+    arrays = {name: np.load(Path(entry, name + '.npy'), mmap_mode='r')
+              for name in meta.pop('_arrays')}
+
+    return arrays, meta
+
+
+def save_cache(cache_dir: Union[str, Path], key: str, arrays: dict, meta: dict):
+    '''
+    Saves numpy arrays (one .npy per array) and json metadata as a cache entry
+
+    The entry is written in a temporary directory and renamed, so that
+    concurrent processes never see a partial entry.
+    '''
+    entry = Path(cache_dir, key)
+    tmp = Path(cache_dir, f'{key}.tmp{os.getpid()}')
+    os.makedirs(tmp, exist_ok=True)
+
+    for name, array in arrays.items():
+        np.save(Path(tmp, name + '.npy'), np.ascontiguousarray(array))
+
+    meta = dict(meta, _arrays=list(arrays.keys()))
+    with open(Path(tmp, META_FILENAME), 'w') as fj:
+        json.dump(meta, fj)
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another process saved the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,212 @@
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import (BatchSampler, DataLoader, Dataset, RandomSampler, Sampler, SequentialSampler,
+                              get_worker_info)
+from torch.utils.data._utils.collate import default_collate
+
+
+def batch_buffer(shape, dtype) -> torch.Tensor:
+    '''
+    Allocates an uninitialized batch tensor where the DataLoader needs it,
+    so that filling it is the only copy of the data:
+    - in a worker process, in shared memory, as default_collate does, so the
+      batch isn't copied again when it's sent to the main process
+    - in the main process, in pinned memory if CUDA is available, ready for
+      non_blocking transfers to the GPU
+    '''
+    if get_worker_info() is not None:
+        return torch.empty(shape, dtype=dtype).share_memory_()
+    return torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+
+
+def collate_batch(batch):
+    '''
+    Collate function of get_batch_loader: batches returned by a dataset's
+    get_batch are already collated, lists of samples are collated as usual
+    '''
+    if isinstance(batch, list):
+        return default_collate(batch)
+    return batch
+
+
+def get_batch_loader(dataset, batch_size: int, shuffle: bool = False, drop_last: bool = False,
+                     num_workers: int = 0, sampler=None, pin_memory: bool = None, **kwargs) -> DataLoader:
+    '''
+    DataLoader fetching whole batches: each worker receives the list of
+    indices of a batch and the dataset builds the batch at once, without
+    per-sample tensors and the default collate stacking
+
+    Datasets without a batch API (get_batch) are loaded sample by sample
+    and collated as usual.
+
+    With a ResumableSampler, the workers reseed their random generators
+    before each batch, from the position of the batch in the epoch, see
+    SeededBatches.
+
+    Args:
+        dataset: dataset, possibly implementing get_batch(indices) and
+                 dispatching lists of indices from __getitem__ to it
+        batch_size, shuffle, drop_last, num_workers: as for DataLoader
+        sampler: (optional) sampler of single indices, replaces shuffle
+        pin_memory: pin the batches, defaults to True if CUDA is available
+        kwargs: other DataLoader arguments
+    '''
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+
+    if isinstance(sampler, ResumableSampler):
+        return DataLoader(SeededBatches(dataset), sampler=SeededBatchSampler(sampler, batch_size, drop_last),
+                          batch_size=None, collate_fn=collate_batch, num_workers=num_workers,
+                          pin_memory=pin_memory, **kwargs)
+
+    if not hasattr(dataset, 'get_batch'):
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None,
+                          sampler=sampler, drop_last=drop_last, num_workers=num_workers,
+                          pin_memory=pin_memory, **kwargs)
+
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+
+    # batch_size=None disables automatic batching, so the dataset is indexed
+    # with the whole list of indices yielded by the batch sampler
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last),
+                      batch_size=None, collate_fn=collate_batch, num_workers=num_workers,
+                      pin_memory=pin_memory, **kwargs)
+
+
+class ResumableSampler(Sampler):
+    '''
+    Sampler whose order only depends on (seed, epoch), so that a training
+    run can be resumed in the middle of an epoch
+
+    The permutation of an epoch is drawn from a generator seeded with
+    (seed, epoch), and the samples already used are skipped by slicing it,
+    without replaying the DataLoader. Resuming at the start of a batch of a
+    BatchSampler yields exactly the batches that remained.
+
+    In distributed training, each of the num_replicas processes has its own
+    sampler and its own shard of the permutation, as DistributedSampler: the
+    permutation is padded with its first samples to a multiple of
+    num_replicas and replica rank takes every num_replicas-th sample from
+    its rank. Positions are then positions in the shard, the same in all the
+    processes, which take the same number of steps.
+
+    Args:
+        num_samples: size of the dataset
+        seed: seed of the permutations
+        shuffle: if False the samples are yielded in order, only skipped
+        num_replicas: number of processes sharing the epochs
+        rank: shard of this process, in [0, num_replicas)
+    '''
+
+    def __init__(self, num_samples: int, seed: int = 0, shuffle: bool = True, num_replicas: int = 1, rank: int = 0):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f'Invalid rank {rank}, expected a rank in [0, {num_replicas})')
+        self.num_samples = num_samples
+        self.seed = seed
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    @property
+    def shard_size(self) -> int:
+        '''Number of samples of an epoch in each shard'''
+        return -(-self.num_samples // self.num_replicas)
+
+    def permutation(self, epoch: int) -> np.ndarray:
+        '''Returns the order of the samples in an epoch'''
+        if not self.shuffle:
+            return np.arange(self.num_samples)
+        return np.random.default_rng([self.seed, epoch]).permutation(self.num_samples)
+
+    def set_epoch(self, epoch: int, start: int = 0):
+        '''Sets the epoch of the next iteration and the number of its samples to skip'''
+        self.epoch = epoch
+        self.start = start
+
+    def shard(self, epoch: int) -> np.ndarray:
+        '''Returns the order of the samples of this replica in an epoch'''
+        indices = self.permutation(epoch)
+        if self.num_replicas == 1:
+            return indices
+        padding = self.shard_size * self.num_replicas - len(indices)
+        indices = np.concatenate((indices, np.resize(indices, padding)))
+        return indices[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        indices = self.shard(self.epoch)[self.start:]
+        # the next iteration starts at the beginning of the epoch,
+        # unless set_epoch is called again
+        self.start = 0
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.shard_size - self.start
+
+    def state_dict(self, position: int, epoch: int = None) -> dict:
+        '''
+        Returns the state to resume from after the first position samples of
+        an epoch, e.g. iterations done * batch size. The sampler runs ahead of
+        the training loop because of the DataLoader prefetching, so the
+        position is given by the caller. epoch defaults to the current epoch.
+        '''
+        return {'seed': self.seed, 'epoch': self.epoch if epoch is None else epoch, 'start': position}
+
+    def load_state_dict(self, state: dict):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'], state['start'])
+
+
+class SeededIndices(list):
+    '''Indices of a batch and the seed of its random choices'''
+
+    def __init__(self, indices, seed: int):
+        super().__init__(indices)
+        self.seed = seed
+
+
+class SeededBatchSampler(BatchSampler):
+    '''
+    BatchSampler of a ResumableSampler yielding SeededIndices, whose seed is
+    derived from (seed, epoch, rank, position of the batch in the epoch)
+    '''
+
+    def __iter__(self):
+        entropy = (self.sampler.seed, self.sampler.epoch, self.sampler.rank)
+        position = self.sampler.start
+        for batch in super().__iter__():
+            yield SeededIndices(batch, int(np.random.SeedSequence(entropy + (position,)).generate_state(1)[0]))
+            position += len(batch)
+
+
+class SeededBatches(Dataset):
+    '''
+    Dataset indexed with the SeededIndices of a SeededBatchSampler
+
+    A worker seeds the random, numpy and torch generators with the seed of a
+    batch before loading it, so the random choices of the dataset, e.g. the
+    objects sampled by VG, only depend on the position of the batch, not on
+    the worker loading it or the batches it loaded before, and training
+    resumed in the middle of an epoch makes the same choices. Without
+    workers the batches are loaded with the global generators, whose states
+    are checkpointed with the training state.
+    '''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices: SeededIndices):
+        if get_worker_info() is not None:
+            random.seed(indices.seed)
+            np.random.seed(indices.seed)
+            torch.manual_seed(indices.seed)
+        if hasattr(self.dataset, 'get_batch'):
+            return self.dataset.get_batch(list(indices))
+        return default_collate([self.dataset[index] for index in indices])
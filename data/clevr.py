@@ -2,16 +2,25 @@ from cProfile import label
 import json
 from pathlib import Path
 from typing import Union
+import numpy as np
 import torch
 from torch.utils.data import Dataset
-from utils.util import normalize_tensor
 from PIL import Image
 import torchvision.transforms as T
 from torch.nn.functional import pad
+from data.annotation_cache import cache_key, load_cache, save_cache
+from data.image_decode import open_rgb_image
 
 
 class CLEVRDataset(Dataset):
-    def __init__(self, image_dir: Union[str, Path], scenes_json: Union[str, Path], image_size: tuple[int, int], max_objects_per_image=10, return_depth: bool = False, occlusions: bool = False) -> None:
+    def __init__(self, image_dir: Union[str, Path], scenes_json: Union[str, Path], image_size: tuple[int, int], max_objects_per_image=10, return_depth: bool = False, occlusions: bool = False, cache_dir: Union[str, Path] = None, decode_backend: str = 'pil') -> None:
+        '''
+        Args:
+            cache_dir: (optional) directory where the scene index built by
+                       parse_clevr_scenes is cached, keyed by the scenes json
+            decode_backend: see data.image_decode.open_rgb_image, 'draft' only
+                            reduces the decoding of JPEG images
+        '''
         super(Dataset, self).__init__()
 
         self.image_dir = image_dir
@@ -19,6 +28,7 @@ class CLEVRDataset(Dataset):
         self.image_size = image_size
         self.return_depth = return_depth
         self.occlusions = occlusions
+        self.decode_backend = decode_backend
 
         # 25 labels: color + shape
         self.idx2label = generate_label_map()
@@ -37,54 +47,57 @@ class CLEVRDataset(Dataset):
 
         self.transforms = T.Compose(transforms)
 
-        # load scenes data
-        with open(scenes_json, 'r') as fj:
-            self.scenes = json.load(fj)['scenes']
+        # labels, boxes and depths of every scene, the scenes json is parsed
+        # only if there is no cached index for it
+        cached = None
+        if cache_dir is not None:
+            key = cache_key([scenes_json], occlusions=occlusions)
+            cached = load_cache(cache_dir, key)
+
+        if cached is None:
+            arrays, meta = parse_clevr_scenes(scenes_json, self.idx2label, occlusions)
+            if cache_dir is not None:
+                save_cache(cache_dir, key, arrays, meta)
+        else:
+            arrays, meta = cached
+
+        # objects of scene i are obj_labels[obj_offsets[i]:obj_offsets[i+1]]
+        self.image_filenames = meta['image_filenames']
+        self.obj_offsets = arrays['obj_offsets']
+        self.obj_labels = arrays['obj_labels']
+        self.obj_boxes = arrays['obj_boxes']
+        self.obj_depths = arrays['obj_depths']
 
     def __getitem__(self, index):
-        scene = self.scenes[index]
-        objs = scene['objects']
-        image_path = Path(self.image_dir, scene['image_filename'])
+        start, end = self.obj_offsets[index:index + 2].tolist()
+        image_path = Path(self.image_dir, self.image_filenames[index])
 
         # load image
-        image = Image.open(image_path).convert('RGB')
+        image, _ = open_rgb_image(image_path, self.image_size, self.decode_backend)
         image = self.transforms(image)
 
         # clevr images are in [0,1]
         # normalize to [-1,1]
         image = (image * 2) - 1
 
-        if self.occlusions:
-            # read bounding boxes from annotations
-            bboxes, labels = parse_bounding_boxes(scene, self.idx2label)
-        else:
-            # extract bounding boxes from the objects' coordinates
-            bboxes, labels = extract_bounding_boxes(scene, self.idx2label)
+        num_dummies = max(self.max_objects_per_image - (end - start), 0)
 
         # add dummy objects to reach the desired number
-        for _ in range(len(labels), self.max_objects_per_image):
-            # label 0: dummy object __image__
-            labels.append(0)
-            bboxes.append((-0.6, -0.6, 0.5, 0.5))
-
-        # convert everything to tensors
-        labels = torch.tensor(labels)
-        bboxes = torch.tensor(bboxes)
+        # label 0: dummy object __image__
+        labels = pad(torch.tensor(self.obj_labels[start:end]), (0, num_dummies), value=0)
+        bboxes = torch.tensor(self.obj_boxes[start:end], dtype=torch.float)
+        bboxes = torch.cat((bboxes, torch.tensor([(-0.6, -0.6, 0.5, 0.5)]).expand(num_dummies, 4)))
 
         if self.return_depth:
-            # extract, invert and normalize depth values
-            depths = [-1*obj['pixel_coords'][2] for obj in objs]
-            depths = normalize_tensor(torch.tensor(depths), (0, 1))
-
             # set dummy objects depth to -0.5
-            depths = pad(depths, (0, self.max_objects_per_image-depths.shape[0]), value=-0.5)
+            depths = pad(torch.tensor(self.obj_depths[start:end]), (0, num_dummies), value=-0.5)
 
             return image, labels, bboxes, depths
 
         return image, labels, bboxes
 
     def __len__(self):
-        return len(self.scenes)
+        return len(self.image_filenames)
 
 
 def generate_label_map():
@@ -102,6 +115,76 @@ def generate_label_map():
     return names
 
 
+def parse_clevr_scenes(scenes_json: Union[str, Path], idx2label: list, occlusions: bool = False):
+    '''
+    Precomputes the labels, boxes and depths of every scene in scenes_json
+
+    Args:
+        scenes_json: CLEVR scenes json file
+        idx2label: label map of generate_label_map
+        occlusions: read the boxes from the annotations, as parse_bounding_boxes,
+                    instead of projecting the objects' coordinates
+    Returns:
+        (arrays, meta): numpy arrays, objects of scene i are in the range
+                        [obj_offsets[i], obj_offsets[i+1]) of obj_labels (int64),
+                        obj_boxes ((x, y, w, h) float64) and obj_depths (float32,
+                        inverted and normalized to [0, 1] in each scene), meta
+                        holds the scenes' image_filenames
+    '''
+    with open(scenes_json, 'r') as fj:
+        scenes = json.load(fj)['scenes']
+
+    label_to_idx = {label: idx for idx, label in enumerate(idx2label)}
+
+    obj_offsets = [0]
+    obj_labels = []
+    obj_boxes = []
+    rotations = []
+    for scene in scenes:
+        objs = scene['objects']
+        obj_offsets.append(obj_offsets[-1] + len(objs))
+        obj_labels.extend(label_to_idx[' '.join((obj['color'], obj['shape']))] for obj in objs)
+
+        if occlusions:
+            # read bounding boxes from annotations
+            obj_boxes.extend((obj['x'], obj['y'], obj['width'], obj['height']) for obj in objs)
+        else:
+            rotations.extend([scene['directions']['right']] * len(objs))
+
+    objs = [obj for scene in scenes for obj in scene['objects']]
+    pixel_coords = np.array([obj['pixel_coords'] for obj in objs], dtype=np.float64).reshape(-1, 3)
+
+    if not occlusions:
+        # extract bounding boxes from the objects' coordinates, all at once
+        obj_boxes = project_bounding_boxes(pixel_coords,
+                                           np.array([obj['3d_coords'] for obj in objs], dtype=np.float64).reshape(-1, 3),
+                                           np.array(rotations, dtype=np.float64).reshape(-1, 3),
+                                           np.array([obj['shape'] for obj in objs], dtype=str))
+
+    obj_offsets = np.array(obj_offsets, dtype=np.int64)
+    depths = (-1*pixel_coords[:, 2]).astype(np.float32)
+
+    # normalize the inverted depths of each scene to [0, 1], as normalize_tensor
+    obj_depths = np.empty_like(depths)
+    starts = obj_offsets[:-1][obj_offsets[1:] > obj_offsets[:-1]]
+    if len(starts) > 0:
+        counts = np.diff(np.append(starts, len(depths)))
+        min_ = np.repeat(np.minimum.reduceat(depths, starts), counts)
+        max_ = np.repeat(np.maximum.reduceat(depths, starts), counts)
+        obj_depths = (depths - min_) / np.maximum(max_ - min_, np.float32(1e-12))
+
+    arrays = {
+        'obj_offsets': obj_offsets,
+        'obj_labels': np.array(obj_labels, dtype=np.int64),
+        'obj_boxes': np.array(obj_boxes, dtype=np.float64).reshape(-1, 4),
+        'obj_depths': obj_depths.astype(np.float32),
+    }
+    meta = {
+        'image_filenames': [scene['image_filename'] for scene in scenes],
+    }
+    return arrays, meta
+
+
 def parse_bounding_boxes(scene, idx2label):
     bboxes = [(obj['x'], obj['y'], obj['width'], obj['height']) for obj in scene['objects']]
     labels = [idx2label.index(' '.join((obj['color'], obj['shape']))) for obj in scene['objects']]
@@ -123,36 +206,7 @@ def extract_bounding_boxes(scene, names):
     classes_text = []
 
     for _, obj in enumerate(objs):
-        [x, y, z] = obj['pixel_coords']
-
-        [x1, y1, z1] = obj['3d_coords']
-
-        cos_theta, sin_theta, _ = rotation
-
-        x1 = x1 * cos_theta + y1 * sin_theta
-        y1 = x1 * -sin_theta + y1 * cos_theta
-
-        height_d = 6.9 * z1 * (15 - y1) / 2.0
-        height_u = height_d
-        width_l = height_d
-        width_r = height_d
-
-        if obj['shape'] == 'cylinder':
-            d = 9.4 + y1
-            h = 6.4
-            s = z1
-
-            height_u *= (s*(h/d + 1)) / ((s*(h/d + 1)) - (s*(h-s)/d))
-            height_d = height_u * (h-s+d) / (h + s + d)
-
-            width_l *= 11/(10 + y1)
-            width_r = width_l
-
-        if obj['shape'] == 'cube':
-            height_u *= 1.3 * 10 / (10 + y1)
-            height_d = height_u
-            width_l = height_u
-            width_r = height_u
+        x, y, width, height = project_bounding_box(obj, rotation)
 
         obj_name = obj['size'] + ' ' + obj['color'] + \
             ' ' + obj['material'] + ' ' + obj['shape']
@@ -160,15 +214,108 @@ def extract_bounding_boxes(scene, names):
 
         classes.append(names.index(obj_name))
 
-        ymin.append((y - height_d)/320.0)
-        # ymax.append((y + height_u)/320.0)
-        xmin.append((x - width_l)/480.0)
-        # xmax.append((x + width_r)/480.0)
+        ymin.append(y)
+        xmin.append(x)
 
-        heights.append((height_u + height_d)/320.0)
-        widths.append((width_l + width_r)/480.0)
+        heights.append(height)
+        widths.append(width)
 
     bboxes = [(xmin[i], ymin[i], widths[i], heights[i])
               for i in range(len(xmin))]
 
     return bboxes, classes
+
+
+def project_bounding_box(obj, rotation):
+    '''
+    Approximates the bounding box of a CLEVR object from its coordinates
+
+    Args:
+        obj: object of a scene, with pixel_coords, 3d_coords and shape
+        rotation: the scene's directions['right']
+    Returns:
+        (x, y, w, h) box normalized by the 480x320 image size
+    '''
+    [x, y, z] = obj['pixel_coords']
+
+    [x1, y1, z1] = obj['3d_coords']
+
+    cos_theta, sin_theta, _ = rotation
+
+    x1 = x1 * cos_theta + y1 * sin_theta
+    y1 = x1 * -sin_theta + y1 * cos_theta
+
+    height_d = 6.9 * z1 * (15 - y1) / 2.0
+    height_u = height_d
+    width_l = height_d
+    width_r = height_d
+
+    if obj['shape'] == 'cylinder':
+        d = 9.4 + y1
+        h = 6.4
+        s = z1
+
+        height_u *= (s*(h/d + 1)) / ((s*(h/d + 1)) - (s*(h-s)/d))
+        height_d = height_u * (h-s+d) / (h + s + d)
+
+        width_l *= 11/(10 + y1)
+        width_r = width_l
+
+    if obj['shape'] == 'cube':
+        height_u *= 1.3 * 10 / (10 + y1)
+        height_d = height_u
+        width_l = height_u
+        width_r = height_u
+
+    ymin = (y - height_d)/320.0
+    # ymax = (y + height_u)/320.0
+    xmin = (x - width_l)/480.0
+    # xmax = (x + width_r)/480.0
+
+    return xmin, ymin, (width_l + width_r)/480.0, (height_u + height_d)/320.0
+
+
+def project_bounding_boxes(pixel_coords: np.ndarray, coords_3d: np.ndarray, rotations: np.ndarray,
+                           shapes: np.ndarray) -> np.ndarray:
+    '''
+    Vectorized project_bounding_box, for the objects of any number of scenes
+
+    Args:
+        pixel_coords: (N, 3) objects' pixel_coords
+        coords_3d: (N, 3) objects' 3d_coords
+        rotations: (N, 3) directions['right'] of each object's scene
+        shapes: (N,) objects' shape names
+    Returns:
+        (N, 4) float64 (x, y, w, h) boxes normalized by the 480x320 image size
+    '''
+    x, y = pixel_coords[:, 0], pixel_coords[:, 1]
+    x1, y1, z1 = coords_3d[:, 0], coords_3d[:, 1], coords_3d[:, 2]
+    cos_theta, sin_theta = rotations[:, 0], rotations[:, 1]
+
+    # y1 is rotated with the already rotated x1, as in project_bounding_box
+    x1 = x1 * cos_theta + y1 * sin_theta
+    y1 = x1 * -sin_theta + y1 * cos_theta
+
+    height_d = 6.9 * z1 * (15 - y1) / 2.0
+    height_u = height_d.copy()
+    width_l = height_d.copy()
+
+    cylinders = shapes == 'cylinder'
+    if cylinders.any():
+        d = 9.4 + y1[cylinders]
+        h = 6.4
+        s = z1[cylinders]
+
+        height_u[cylinders] *= (s*(h/d + 1)) / ((s*(h/d + 1)) - (s*(h-s)/d))
+        height_d[cylinders] = height_u[cylinders] * (h-s+d) / (h + s + d)
+        width_l[cylinders] *= 11/(10 + y1[cylinders])
+
+    cubes = shapes == 'cube'
+    if cubes.any():
+        height_u[cubes] *= 1.3 * 10 / (10 + y1[cubes])
+        height_d[cubes] = height_u[cubes]
+        width_l[cubes] = height_u[cubes]
+
+    # the boxes are symmetric horizontally, width_r == width_l
+    return np.stack(((x - width_l)/480.0, (y - height_d)/320.0,
+                     (2 * width_l)/480.0, (height_u + height_d)/320.0), axis=-1)
@@ -12,7 +12,12 @@ from skimage.transform import resize as imresize
 import pycocotools.mask as mask_utils
 from random import shuffle
 
-from utils.depth import get_bboxes_depths_from_depthmap
+from utils.depth import get_bboxes_depths_from_depthmap, load_box_depth_table
+from data.image_shards import PackedImageShards
+from data.image_decode import open_rgb_image
+from data.depth_pack import PackedDepthmaps
+from data.annotation_cache import cache_key, load_cache, save_cache
+from data.batching import batch_buffer
 
 
 class CocoSceneGraphDataset(Dataset):
@@ -22,7 +27,8 @@ class CocoSceneGraphDataset(Dataset):
                  include_relationships=True, min_object_size=0.02,
                  min_objects_per_image=3, max_objects_per_image=8, left_right_flip=False,
                  include_other=False, instance_whitelist=None, stuff_whitelist=None, 
-                 return_filenames=False, return_depth=False, depth_dir=None):
+                 return_filenames=False, return_depth=False, depth_dir=None,
+                 image_shards_dir=None, cache_dir=None, depth_pack_dir=None, decode_backend='pil'):
         """
         A PyTorch Dataset for loading Coco and Coco-Stuff annotations and converting
         them to scene graphs on the fly.
@@ -55,6 +61,19 @@ class CocoSceneGraphDataset(Dataset):
           list giving a whitelist of instance category names to use.
         - stuff_whitelist: None means use all stuff categories. Otherwise a list
           giving a whitelist of stuff category names to use.
+        - image_shards_dir: (optional) directory of images packed with
+          data.image_shards.pack_image_shards at image_size. If given, images
+          are read from the shards instead of decoding the original JPEGs.
+        - cache_dir: (optional) directory where the parsed annotations are cached
+          as numpy arrays, keyed by the json files' content and the filtering
+          arguments. If None the json files are parsed every time.
+        - depth_pack_dir: (optional) directory of depthmaps packed with
+          data.depth_pack. If given, depthmaps are read from the pack instead
+          of the .npy files in depth_dir, and the box depth table is kept
+          next to the pack.
+        - decode_backend: 'pil' to decode the images at full size, 'draft' to
+          let libjpeg decode them at a reduced size before the resize, see
+          data.image_decode.open_rgb_image.
         """
         super(Dataset, self).__init__()
 
@@ -73,134 +92,65 @@ class CocoSceneGraphDataset(Dataset):
         self.return_filenames = return_filenames
         self.return_depth = return_depth
         self.depth_dir = depth_dir
-
-        with open(instances_json, 'r') as f:
-            instances_data = json.load(f)
-
-        stuff_data = None
-        if stuff_json is not None and stuff_json != '':
-            with open(stuff_json, 'r') as f:
-                stuff_data = json.load(f)
-
-        self.image_ids = []
-        self.image_id_to_filename = {}
-        self.image_id_to_size = {}
-        for image_data in instances_data['images']:
-            image_id = image_data['id']
-            filename = image_data['file_name']
-            width = image_data['width']
-            height = image_data['height']
-            self.image_ids.append(image_id)
-            self.image_id_to_filename[image_id] = filename
-            self.image_id_to_size[image_id] = (width, height)
-
-        self.vocab = {
-            'object_name_to_idx': {},
-            'pred_name_to_idx': {},
-        }
-        object_idx_to_name = {}
-        all_instance_categories = []
-        for category_data in instances_data['categories']:
-            category_id = category_data['id']
-            category_name = category_data['name']
-            all_instance_categories.append(category_name)
-            object_idx_to_name[category_id] = category_name
-            self.vocab['object_name_to_idx'][category_name] = category_id
-        all_stuff_categories = []
-        if stuff_data:
-            for category_data in stuff_data['categories']:
-                category_name = category_data['name']
-                category_id = category_data['id']
-                all_stuff_categories.append(category_name)
-                object_idx_to_name[category_id] = category_name
-                self.vocab['object_name_to_idx'][category_name] = category_id
-
-        if instance_whitelist is None:
-            instance_whitelist = all_instance_categories
-        if stuff_whitelist is None:
-            stuff_whitelist = all_stuff_categories
-        category_whitelist = set(instance_whitelist) | set(stuff_whitelist)
-
-        # Add object data from instances
-        self.image_id_to_objects = defaultdict(list)
-        for object_data in instances_data['annotations']:
-            image_id = object_data['image_id']
-            _, _, w, h = object_data['bbox']
-            W, H = self.image_id_to_size[image_id]
-            box_area = (w * h) / (W * H)
-            # box_area = object_data['area'] / (W * H)
-            box_ok = box_area > min_object_size
-            object_name = object_idx_to_name[object_data['category_id']]
-            category_ok = object_name in category_whitelist
-            other_ok = object_name != 'other' or include_other
-            if box_ok and category_ok and other_ok and (object_data['iscrowd'] != 1):
-                self.image_id_to_objects[image_id].append(object_data)
-
-        # Add object data from stuff
-        if stuff_data:
-            image_ids_with_stuff = set()
-            for object_data in stuff_data['annotations']:
-                image_id = object_data['image_id']
-                image_ids_with_stuff.add(image_id)
-                _, _, w, h = object_data['bbox']
-                W, H = self.image_id_to_size[image_id]
-                box_area = (w * h) / (W * H)
-                # box_area = object_data['area'] / (W * H)
-                box_ok = box_area > min_object_size
-                object_name = object_idx_to_name[object_data['category_id']]
-                category_ok = object_name in category_whitelist
-                other_ok = object_name != 'other' or include_other
-                if box_ok and category_ok and other_ok and (object_data['iscrowd'] != 1):
-                    self.image_id_to_objects[image_id].append(object_data)
-
-            if stuff_only:
-                new_image_ids = []
-                for image_id in self.image_ids:
-                    if image_id in image_ids_with_stuff:
-                        new_image_ids.append(image_id)
-                self.image_ids = new_image_ids
-
-                all_image_ids = set(self.image_id_to_filename.keys())
-                image_ids_to_remove = all_image_ids - image_ids_with_stuff
-                for image_id in image_ids_to_remove:
-                    self.image_id_to_filename.pop(image_id, None)
-                    self.image_id_to_size.pop(image_id, None)
-                    self.image_id_to_objects.pop(image_id, None)
-
-        # COCO category labels start at 1, so use 0 for __image__
-        self.vocab['object_name_to_idx']['__image__'] = 0
-
-        # Build object_idx_to_name
-        name_to_idx = self.vocab['object_name_to_idx']
-        assert len(name_to_idx) == len(set(name_to_idx.values()))
-        max_object_idx = max(name_to_idx.values())
-        idx_to_name = ['NONE'] * (1 + max_object_idx)
-        for name, idx in self.vocab['object_name_to_idx'].items():
-            idx_to_name[idx] = name
-        self.vocab['object_idx_to_name'] = idx_to_name
-
-        # Prune images that have too few or too many objects
-        new_image_ids = []
-        total_objs = 0
-        for image_id in self.image_ids:
-            num_objs = len(self.image_id_to_objects[image_id])
-            total_objs += num_objs
-            if min_objects_per_image <= num_objs <= max_objects_per_image:
-                new_image_ids.append(image_id)
-        self.image_ids = new_image_ids
-
-        self.vocab['pred_idx_to_name'] = [
-            '__in_image__',
-            'left of',
-            'right of',
-            'above',
-            'below',
-            'inside',
-            'surrounding',
-        ]
-        self.vocab['pred_name_to_idx'] = {}
-        for idx, name in enumerate(self.vocab['pred_idx_to_name']):
-            self.vocab['pred_name_to_idx'][name] = idx
+        self.decode_backend = decode_backend
+
+        self.depth_pack = None
+        if depth_pack_dir is not None:
+            self.depth_pack = PackedDepthmaps(depth_pack_dir)
+
+        self.image_shards = None
+        if image_shards_dir is not None:
+            self.image_shards = PackedImageShards(image_shards_dir)
+            if self.image_shards.image_size != tuple(self.image_size):
+                raise ValueError(f'Shards in {image_shards_dir} have image size '
+                                 f'{self.image_shards.image_size}, expected {tuple(self.image_size)}')
+
+        filter_args = dict(stuff_only=stuff_only, min_object_size=min_object_size,
+                           min_objects_per_image=min_objects_per_image,
+                           max_objects_per_image=max_objects_per_image,
+                           include_other=include_other, instance_whitelist=instance_whitelist,
+                           stuff_whitelist=stuff_whitelist)
+
+        # parsing the COCO json files takes a while, reuse the cached arrays if possible
+        cached = None
+        if cache_dir is not None:
+            key = cache_key([instances_json, stuff_json], **filter_args)
+            cached = load_cache(cache_dir, key)
+
+        if cached is None:
+            arrays, meta = parse_coco_annotations(instances_json, stuff_json, **filter_args)
+            if cache_dir is not None:
+                save_cache(cache_dir, key, arrays, meta)
+        else:
+            arrays, meta = cached
+
+        self.vocab = meta['vocab']
+
+        all_image_ids = arrays['all_image_ids'].tolist()
+        self.image_id_to_filename = dict(zip(all_image_ids, meta['filenames']))
+        self.image_id_to_size = dict(zip(all_image_ids, zip(
+            arrays['widths'].tolist(), arrays['heights'].tolist())))
+
+        # objects of image_ids[i] are obj_labels[obj_offsets[i]:obj_offsets[i+1]]
+        # boxes are (x, y, w, h) normalized by the image size
+        self.image_ids = arrays['image_ids'].tolist()
+        self.obj_offsets = arrays['obj_offsets']
+        self.obj_labels = arrays['obj_labels']
+        self.obj_boxes = arrays['obj_boxes']
+
+        # dummy __image__ objects used to pad the layouts to max_objects_per_image
+        self._objs_template = np.full(max_objects_per_image, self.vocab['object_name_to_idx']['__image__'],
+                                      dtype=np.int64)
+        self._boxes_template = np.tile(np.array([-0.6, -0.6, 0.5, 0.5]), (max_objects_per_image, 1))
+        self._depths_template = np.full(max_objects_per_image, -0.5, dtype=np.float32)
+
+        # per-box depths precomputed by utils.depth.build_box_depth_table,
+        # if available the depthmaps are not loaded at all
+        self.box_depths = None
+        if return_depth:
+            self.box_depths = load_box_depth_table(self.box_depth_dir, self.obj_offsets, self.obj_boxes)
+            if self.box_depths is None:
+                print(f'No box depth table in {self.box_depth_dir}, depths will be computed from the depthmaps')
 
     def set_image_size(self, image_size):
         print('called set_image_size', image_size)
@@ -218,13 +168,10 @@ class CocoSceneGraphDataset(Dataset):
         self.image_size = image_size
 
     def total_objects(self):
-        total_objs = 0
-        for i, image_id in enumerate(self.image_ids):
-            if self.max_samples and i >= self.max_samples:
-                break
-            num_objs = len(self.image_id_to_objects[image_id])
-            total_objs += num_objs
-        return total_objs
+        num_images = len(self.image_ids)
+        if self.max_samples:
+            num_images = min(num_images, self.max_samples)
+        return int(self.obj_offsets[num_images] - self.obj_offsets[0])
 
     def __len__(self):
         if self.max_samples is None:
@@ -233,6 +180,185 @@ class CocoSceneGraphDataset(Dataset):
             return len(self.image_ids)
         return min(len(self.image_ids), self.max_samples)
 
+    def get_objects(self, index, flip=False):
+        """
+        Get the labels and boxes of image_ids[index], padded with dummy
+        __image__ objects to max_objects_per_image.
+
+        Returns a tuple of:
+        - objs: int64 array of shape (max_objects_per_image,)
+        - boxes: float64 array of shape (max_objects_per_image, 4) in
+          (x, y, w, h) format, in a [0, 1] coordinate system
+        """
+        start, end = self.obj_offsets[index], self.obj_offsets[index + 1]
+        num_objs = end - start
+
+        objs = self._objs_template.copy()
+        boxes = self._boxes_template.copy()
+        objs[:num_objs] = self.obj_labels[start:end]
+        boxes[:num_objs] = self.obj_boxes[start:end]
+
+        if flip:
+            boxes[:num_objs, 0] = 1 - (boxes[:num_objs, 0] + boxes[:num_objs, 2])
+
+        return objs, boxes
+
+    def _batch_positions(self, indices):
+        """
+        (batch row, object column, position in the flat arrays) of every real
+        object of the images, to gather them in (B, O) arrays
+        """
+        starts = self.obj_offsets[indices]
+        counts = self.obj_offsets[indices + 1] - starts
+
+        rows = np.repeat(np.arange(len(indices)), counts)
+        cols = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        src = np.repeat(starts, counts) + cols
+        return rows, cols, src
+
+    def get_objects_batch(self, indices, flips, objs_out=None, boxes_out=None):
+        """
+        Batched get_objects, gathers the objects of all the images at once.
+
+        Inputs:
+        - indices: int array of shape (B,) of image indices
+        - flips: bool array of shape (B,)
+        - objs_out, boxes_out: (optional) arrays of shape (B, O) and (B, O, 4)
+          to write the results in
+
+        Returns a tuple of:
+        - objs: int64 array of shape (B, max_objects_per_image)
+        - boxes: float64 array of shape (B, max_objects_per_image, 4)
+        """
+        B = len(indices)
+        rows, cols, src = self._batch_positions(indices)
+
+        objs = np.empty((B, self.max_objects_per_image), dtype=np.int64) if objs_out is None else objs_out
+        boxes = np.empty((B, self.max_objects_per_image, 4)) if boxes_out is None else boxes_out
+        objs[:] = self._objs_template
+        boxes[:] = self._boxes_template
+        objs[rows, cols] = self.obj_labels[src]
+        boxes[rows, cols] = self.obj_boxes[src]
+
+        flipped = flips[rows]
+        rows, cols = rows[flipped], cols[flipped]
+        boxes[rows, cols, 0] = 1 - (boxes[rows, cols, 0] + boxes[rows, cols, 2])
+
+        return objs, boxes
+
+    def load_image(self, image_id, flip=False):
+        """
+        Returns the transformed image as a FloatTensor of shape (C, H, W)
+        """
+        if self.image_shards is not None:
+            return self.image_shards.load(image_id, flip, self.normalize_images)
+
+        image_path = os.path.join(self.image_dir, self.image_id_to_filename[image_id])
+        image, _ = open_rgb_image(image_path, self.image_size, self.decode_backend, flip)
+        return self.transform(image)
+
+    def get_depths(self, index, flip, boxes):
+        """
+        Returns the depth of each box of image_ids[index] as a tensor of
+        shape (O,), -0.5 for dummy objects, from the box depth table if
+        there is one, otherwise from the depthmap
+        """
+        if self.box_depths is None:
+            filename = self.image_id_to_filename[self.image_ids[index]]
+            return self.load_depths(filename, flip, boxes)
+
+        start, end = self.obj_offsets[index], self.obj_offsets[index + 1]
+        depths = self._depths_template.copy()
+        depths[:end - start] = self.box_depths[start:end, int(flip)]
+        return torch.from_numpy(depths)
+
+    @property
+    def box_depth_dir(self):
+        """
+        Directory of the box depth table, next to the depthmaps it is computed from
+        """
+        return self.depth_dir if self.depth_pack is None else self.depth_pack.pack_dir
+
+    def load_depthmap(self, filename):
+        """
+        Returns the depthmap of an image as a FloatTensor of shape (H, W),
+        from the depth pack if there is one, otherwise from its .npy file
+        """
+        if self.depth_pack is not None:
+            return torch.from_numpy(self.depth_pack[filename])
+
+        if not Path(self.depth_dir).is_dir():
+            raise FileNotFoundError("Coudn't find the depth folder")
+
+        return torch.from_numpy(np.load(Path(self.depth_dir, filename + '.npy')))
+
+    def load_depths(self, filename, flip, boxes):
+        """
+        Computes the depth of each box from the depthmap as a tensor of
+        shape (O,), -0.5 for dummy objects
+        """
+        # load depthmap
+        depthmap = self.load_depthmap(filename)
+
+        if flip:
+            # flip the depthmap as the image is also flipped
+            depthmap = torch.fliplr(depthmap)
+
+        return get_bboxes_depths_from_depthmap(depthmap, torch.from_numpy(boxes))
+
+    def get_batch(self, indices):
+        """
+        Get a whole batch of samples, as default collation of __getitem__
+        would return it. The objects of the batch are gathered in one
+        vectorized step and every output is written directly in its batch
+        buffer, see data.batching.
+
+        Returns a tuple of:
+        - images: FloatTensor of shape (B, C, H, W)
+        - objs: LongTensor of shape (B, O)
+        - boxes: DoubleTensor of shape (B, O, 4)
+        - depths: (if return_depth) tensor of shape (B, O)
+        - filenames, flips: (if return_filenames) list of B filenames and
+          BoolTensor of shape (B,)
+        """
+        if self.image_size[0] is None:
+            raise ValueError('Batches need a fixed image size')
+
+        indices = np.asarray(indices, dtype=np.int64)
+        flips = indices >= len(self.image_ids)
+        indices = np.where(flips, indices - len(self.image_ids), indices)
+        B, O = len(indices), self.max_objects_per_image
+
+        objs = batch_buffer((B, O), torch.int64)
+        boxes = batch_buffer((B, O, 4), torch.float64)
+        self.get_objects_batch(indices, flips, objs.numpy(), boxes.numpy())
+
+        images = batch_buffer((B, 3, *self.image_size), torch.float32)
+        filenames = []
+        for i, (index, flip) in enumerate(zip(indices.tolist(), flips.tolist())):
+            image_id = self.image_ids[index]
+            images[i] = self.load_image(image_id, flip)
+            filenames.append(self.image_id_to_filename[image_id])
+
+        batch = (images, objs, boxes)
+
+        if self.return_depth:
+            depths = batch_buffer((B, O), torch.float32)
+            if self.box_depths is None:
+                for i, (filename, flip) in enumerate(zip(filenames, flips.tolist())):
+                    depths[i] = self.load_depths(filename, flip, boxes[i].numpy())
+            else:
+                rows, cols, src = self._batch_positions(indices)
+                depths_np = depths.numpy()
+                depths_np[:] = self._depths_template
+                depths_np[rows, cols] = self.box_depths[src, flips[rows].astype(np.int64)]
+            batch += (depths,)
+
+        if self.return_filenames:
+            batch += (filenames, torch.from_numpy(flips))
+
+        return batch
+
     def __getitem__(self, index):
         """
         Get the pixels of an image, and a random synthetic scene graph for that
@@ -252,6 +378,10 @@ class CocoSceneGraphDataset(Dataset):
         - triples: LongTensor of shape (T, 3) where triples[t] = [i, p, j]
           means that (objs[i], p, objs[j]) is a triple.
         """
+        if isinstance(index, (list, tuple)):
+            # a whole batch from data.batching.get_batch_loader
+            return self.get_batch(index)
+
         flip = False
         if index >= len(self.image_ids):
             index = index - len(self.image_ids)
@@ -259,67 +389,11 @@ class CocoSceneGraphDataset(Dataset):
         image_id = self.image_ids[index]
 
         filename = self.image_id_to_filename[image_id]
-        image_path = os.path.join(self.image_dir, filename)
-        with open(image_path, 'rb') as f:
-            with PIL.Image.open(f) as image:
-                if flip:
-                    image = PIL.ImageOps.mirror(image)
-                WW, HH = image.size
-                image = self.transform(image.convert('RGB'))
-
-        objs, boxes, masks = [], [], []
-        # obj_masks = []
-        for object_data in self.image_id_to_objects[image_id]:
-            objs.append(object_data['category_id'])
-            x, y, w, h = object_data['bbox']
-            x0 = x / WW
-            y0 = y / HH
-            x1 = (w) / WW
-            y1 = (h) / HH
-            if flip:
-                x0 = 1 - (x0 + x1)
-            boxes.append(np.array([x0, y0, x1, y1]))
-
-            # # This will give a numpy array of shape (HH, WW)
-            # mask = seg_to_mask(object_data['segmentation'], WW, HH)
-            # if flip:
-            #     mask = mask[:, ::-1]
-            #     x = WW - x - w
-            # # Crop the mask according to the bounding box, being careful to
-            # # ensure that we don't crop a zero-area region
-            # # mx0, mx1 = int(round(x)), int(round(x + w))
-            # # my0, my1 = int(round(y)), int(round(y + h))
-            # # mx1 = max(mx0 + 1, mx1)
-            # # my1 = max(my0 + 1, my1)
-            # # obj_mask = mask[my0:my1, mx0:mx1]
-            # # obj_mask = imresize(255.0 * obj_mask, (self.mask_size, self.mask_size),
-            # #                  mode='constant')
-            # # obj_mask = torch.from_numpy((obj_mask > 128).astype(np.int64))
-            # # obj_masks.append(obj_mask)
-            #
-            # mask = imresize(255.0 * mask, (self.image_size[0], self.image_size[1]),
-            #                 mode='constant')
-            # mask = torch.from_numpy((mask > 128).astype(np.int64))
-            # masks.append(mask)
-
-        # shuffle(objs)
-        # shuffle(boxes)
-        # shuffle(masks)
-        # Add dummy __image__ object
-        # objs.append(184)
-        # boxes.append(torch.FloatTensor([0, 0, 1, 1]))
-        # masks.append(torch.ones(self.mask_size, self.mask_size).long())
-
-        # add 0 for number of objects
-        # append dummy objects to reach the desired number of objs for image
-        for _ in range(len(objs), self.max_objects_per_image):
-            objs.append(self.vocab['object_name_to_idx']['__image__'])
-            boxes.append(np.array([-0.6, -0.6, 0.5, 0.5]))
-            # masks.append(torch.zeros((self.image_size[0], self.image_size[1])).long())
-            # obj_masks.append(torch.zeros((self.mask_size, self.mask_size)).long())
-
-        objs = torch.LongTensor(objs)
-        boxes = np.vstack(boxes)
+        image = self.load_image(image_id, flip)
+
+        # labels and boxes padded with dummy objects, boxes as a numpy array
+        objs, boxes = self.get_objects(index, flip)
+        objs = torch.from_numpy(objs)
         # masks = torch.stack(masks, dim=0)
         # obj_masks = torch.stack(obj_masks, dim=0)
         # b_map = self.get_bbox_map_p(boxes)
@@ -392,17 +466,7 @@ class CocoSceneGraphDataset(Dataset):
 
         
         if self.return_depth:
-            if not Path(self.depth_dir).is_dir:
-                raise FileNotFoundError("Coudn't find the depth folder")
-            
-            # load depthmap
-            depthmap = torch.from_numpy(np.load(Path(self.depth_dir, filename + '.npy')))
-
-            if flip:
-                # flip the depthmap as the image is also flipped
-                depthmap = torch.fliplr(depthmap)
-            
-            depths = get_bboxes_depths_from_depthmap(depthmap, torch.from_numpy(boxes))
+            depths = self.get_depths(index, flip, boxes)
 
             if self.return_filenames:
                 return image, objs, boxes, depths, filename, flip
@@ -429,6 +493,179 @@ class CocoSceneGraphDataset(Dataset):
         return mapping
 
 
+def parse_coco_annotations(instances_json, stuff_json=None, stuff_only=True,
+                           min_object_size=0.02, min_objects_per_image=3,
+                           max_objects_per_image=8, include_other=False,
+                           instance_whitelist=None, stuff_whitelist=None):
+    """
+    Parses and filters the COCO and COCO-Stuff annotations, see
+    CocoSceneGraphDataset for the meaning of the arguments.
+
+    Returns a tuple of:
+    - arrays: dict of numpy arrays
+      - all_image_ids, widths, heights: (I,) every image kept in the dataset
+      - image_ids: (N,) images with an accepted number of objects
+      - obj_offsets: (N + 1,) objects of image_ids[i] are in the range
+        [obj_offsets[i], obj_offsets[i + 1]) of obj_labels and obj_boxes
+      - obj_labels: (M,) category ids
+      - obj_boxes: (M, 4) boxes in (x, y, w, h) format normalized by the image size
+    - meta: dict with the vocab and the filenames of all_image_ids
+    """
+    with open(instances_json, 'r') as f:
+        instances_data = json.load(f)
+
+    stuff_data = None
+    if stuff_json is not None and stuff_json != '':
+        with open(stuff_json, 'r') as f:
+            stuff_data = json.load(f)
+
+    image_ids = []
+    image_id_to_filename = {}
+    image_id_to_size = {}
+    for image_data in instances_data['images']:
+        image_id = image_data['id']
+        filename = image_data['file_name']
+        width = image_data['width']
+        height = image_data['height']
+        image_ids.append(image_id)
+        image_id_to_filename[image_id] = filename
+        image_id_to_size[image_id] = (width, height)
+
+    vocab = {
+        'object_name_to_idx': {},
+        'pred_name_to_idx': {},
+    }
+    object_idx_to_name = {}
+    all_instance_categories = []
+    for category_data in instances_data['categories']:
+        category_id = category_data['id']
+        category_name = category_data['name']
+        all_instance_categories.append(category_name)
+        object_idx_to_name[category_id] = category_name
+        vocab['object_name_to_idx'][category_name] = category_id
+    all_stuff_categories = []
+    if stuff_data:
+        for category_data in stuff_data['categories']:
+            category_name = category_data['name']
+            category_id = category_data['id']
+            all_stuff_categories.append(category_name)
+            object_idx_to_name[category_id] = category_name
+            vocab['object_name_to_idx'][category_name] = category_id
+
+    if instance_whitelist is None:
+        instance_whitelist = all_instance_categories
+    if stuff_whitelist is None:
+        stuff_whitelist = all_stuff_categories
+    category_whitelist = set(instance_whitelist) | set(stuff_whitelist)
+
+    # Add object data from instances
+    image_id_to_objects = defaultdict(list)
+    for object_data in instances_data['annotations']:
+        image_id = object_data['image_id']
+        _, _, w, h = object_data['bbox']
+        W, H = image_id_to_size[image_id]
+        box_area = (w * h) / (W * H)
+        # box_area = object_data['area'] / (W * H)
+        box_ok = box_area > min_object_size
+        object_name = object_idx_to_name[object_data['category_id']]
+        category_ok = object_name in category_whitelist
+        other_ok = object_name != 'other' or include_other
+        if box_ok and category_ok and other_ok and (object_data['iscrowd'] != 1):
+            image_id_to_objects[image_id].append(object_data)
+
+    # Add object data from stuff
+    if stuff_data:
+        image_ids_with_stuff = set()
+        for object_data in stuff_data['annotations']:
+            image_id = object_data['image_id']
+            image_ids_with_stuff.add(image_id)
+            _, _, w, h = object_data['bbox']
+            W, H = image_id_to_size[image_id]
+            box_area = (w * h) / (W * H)
+            # box_area = object_data['area'] / (W * H)
+            box_ok = box_area > min_object_size
+            object_name = object_idx_to_name[object_data['category_id']]
+            category_ok = object_name in category_whitelist
+            other_ok = object_name != 'other' or include_other
+            if box_ok and category_ok and other_ok and (object_data['iscrowd'] != 1):
+                image_id_to_objects[image_id].append(object_data)
+
+        if stuff_only:
+            new_image_ids = []
+            for image_id in image_ids:
+                if image_id in image_ids_with_stuff:
+                    new_image_ids.append(image_id)
+            image_ids = new_image_ids
+
+            all_image_ids = set(image_id_to_filename.keys())
+            image_ids_to_remove = all_image_ids - image_ids_with_stuff
+            for image_id in image_ids_to_remove:
+                image_id_to_filename.pop(image_id, None)
+                image_id_to_size.pop(image_id, None)
+                image_id_to_objects.pop(image_id, None)
+
+    # COCO category labels start at 1, so use 0 for __image__
+    vocab['object_name_to_idx']['__image__'] = 0
+
+    # Build object_idx_to_name
+    name_to_idx = vocab['object_name_to_idx']
+    assert len(name_to_idx) == len(set(name_to_idx.values()))
+    max_object_idx = max(name_to_idx.values())
+    idx_to_name = ['NONE'] * (1 + max_object_idx)
+    for name, idx in vocab['object_name_to_idx'].items():
+        idx_to_name[idx] = name
+    vocab['object_idx_to_name'] = idx_to_name
+
+    # Prune images that have too few or too many objects
+    new_image_ids = []
+    for image_id in image_ids:
+        num_objs = len(image_id_to_objects[image_id])
+        if min_objects_per_image <= num_objs <= max_objects_per_image:
+            new_image_ids.append(image_id)
+    image_ids = new_image_ids
+
+    vocab['pred_idx_to_name'] = [
+        '__in_image__',
+        'left of',
+        'right of',
+        'above',
+        'below',
+        'inside',
+        'surrounding',
+    ]
+    vocab['pred_name_to_idx'] = {}
+    for idx, name in enumerate(vocab['pred_idx_to_name']):
+        vocab['pred_name_to_idx'][name] = idx
+
+    # flatten the objects of the kept images
+    obj_offsets = [0]
+    obj_labels = []
+    obj_boxes = []
+    for image_id in image_ids:
+        W, H = image_id_to_size[image_id]
+        for object_data in image_id_to_objects[image_id]:
+            x, y, w, h = object_data['bbox']
+            obj_labels.append(object_data['category_id'])
+            obj_boxes.append((x / W, y / H, w / W, h / H))
+        obj_offsets.append(len(obj_labels))
+
+    all_image_ids = list(image_id_to_filename.keys())
+    arrays = {
+        'all_image_ids': np.array(all_image_ids, dtype=np.int64),
+        'widths': np.array([image_id_to_size[i][0] for i in all_image_ids], dtype=np.int64),
+        'heights': np.array([image_id_to_size[i][1] for i in all_image_ids], dtype=np.int64),
+        'image_ids': np.array(image_ids, dtype=np.int64),
+        'obj_offsets': np.array(obj_offsets, dtype=np.int64),
+        'obj_labels': np.array(obj_labels, dtype=np.int64),
+        'obj_boxes': np.array(obj_boxes, dtype=np.float64).reshape(-1, 4),
+    }
+    meta = {
+        'vocab': vocab,
+        'filenames': [image_id_to_filename[i] for i in all_image_ids],
+    }
+    return arrays, meta
+
+
 def seg_to_mask(seg, width=1.0, height=1.0):
     """
     Tiny utility for decoding segmentation masks using the pycocotools API.
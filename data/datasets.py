@@ -15,7 +15,13 @@ IMAGE_EXTENSIONS = {'bmp', 'jpg', 'jpeg', 'pgm', 'png', 'ppm',
                     'tif', 'tiff', 'webp'}
 
 
-def get_dataset(dataset: str, img_size: int, mode: str = None, depth_dir: Union[str, Path] = None, num_obj: int = None, return_filenames: bool = False, return_depth: bool = False):
+def get_dataset(dataset: str, img_size: int, mode: str = None, depth_dir: Union[str, Path] = None, num_obj: int = None, return_filenames: bool = False, return_depth: bool = False, image_shards_dir: Union[str, Path] = None, memory_map: bool = False, depth_pack_dir: Union[str, Path] = None, decode_backend: str = 'pil'):
+
+    # packed image shards and depth packs are only built for coco
+    if dataset != 'coco' and image_shards_dir is not None:
+        raise ValueError(f'Image shards are only supported for coco, not {dataset}')
+    if dataset != 'coco' and depth_pack_dir is not None:
+        raise ValueError(f'Depth packs are only supported for coco, not {dataset}')
 
     if depth_dir is None:
         depth_dir = Path('datasets', dataset + '-depth', mode)
@@ -26,21 +32,26 @@ def get_dataset(dataset: str, img_size: int, mode: str = None, depth_dir: Union[
     coco_image_dir = f'./datasets/coco/images/{mode}2017/'
     coco_instances_json = f'./datasets/coco/annotations/instances_{mode}2017.json'
     coco_stuff_json = f'./datasets/coco/annotations/stuff_{mode}2017.json'
+    coco_cache_dir = './datasets/coco/annotations/cache/'
 
-    vg_h5_path = './datasets/vg/{mode}.h5'
+    vg_h5_path = f'./datasets/vg/{mode}.h5'
     vg_image_dir = './datasets/vg/images/'
 
     clevr_image_dir = f'./datasets/CLEVR_v1.0/images/{mode}'
     clevr_scenes_json = f'./datasets/CLEVR_v1.0/scenes/CLEVR_{mode}_scenes.json'
+    clevr_cache_dir = './datasets/CLEVR_v1.0/scenes/cache/'
 
     clevr_occs_image_dir = f'./datasets/CLEVR_occlusions/images/{mode}'
     clevr_occs_scenes_json = f'./datasets/CLEVR_occlusions/scenes/CLEVR_{mode}_scenes.json'
+    clevr_occs_cache_dir = './datasets/CLEVR_occlusions/scenes/cache/'
 
     clevr_occs2_image_dir = f'./datasets/CLEVR_occlusions2/images/{mode}'
     clevr_occs2_scenes_json = f'./datasets/CLEVR_occlusions2/scenes/CLEVR_{mode}_scenes.json'
+    clevr_occs2_cache_dir = './datasets/CLEVR_occlusions2/scenes/cache/'
 
     clevr_rubber_image_dir = f'./datasets/CLEVR_rubber/images/{mode}'
     clevr_rubber_scenes_json = f'./datasets/CLEVR_rubber/scenes/CLEVR_{mode}_scenes.json'
+    clevr_rubber_cache_dir = './datasets/CLEVR_rubber/scenes/cache/'
 
     if depth_dir is None:
         depth_dir = Path('datasets', f'{dataset}-depth', mode)
@@ -51,7 +62,11 @@ def get_dataset(dataset: str, img_size: int, mode: str = None, depth_dir: Union[
                                      stuff_json=coco_stuff_json,
                                      depth_dir=depth_dir,
                                      stuff_only=True, image_size=(img_size, img_size), left_right_flip=True,
-                                     return_filenames=return_filenames, return_depth=return_depth)
+                                     return_filenames=return_filenames, return_depth=return_depth,
+                                     image_shards_dir=image_shards_dir,
+                                     cache_dir=coco_cache_dir,
+                                     depth_pack_dir=depth_pack_dir,
+                                     decode_backend=decode_backend)
     elif dataset == 'vg':
         with open('./datasets/vg/vocab.json', 'r') as fj:
             vocab = json.load(fj)
@@ -61,26 +76,35 @@ def get_dataset(dataset: str, img_size: int, mode: str = None, depth_dir: Union[
 
         data = VgSceneGraphDataset(vocab=vocab, h5_path=vg_h5_path,
                                    image_dir=vg_image_dir,
-                                   image_size=(img_size, img_size), max_objects=num_obj-1, left_right_flip=True)
+                                   image_size=(img_size, img_size), max_objects=num_obj-1, left_right_flip=True,
+                                   memory_map=memory_map, decode_backend=decode_backend)
     elif dataset == 'clevr':
         data = CLEVRDataset(image_dir=clevr_image_dir,
                             scenes_json=clevr_scenes_json,
-                            image_size=(img_size, img_size), return_depth=return_depth)
+                            cache_dir=clevr_cache_dir,
+                            image_size=(img_size, img_size), return_depth=return_depth,
+                            decode_backend=decode_backend)
     elif dataset == 'clevr-occs':
         data = CLEVRDataset(image_dir=clevr_occs_image_dir,
                             scenes_json=clevr_occs_scenes_json,
+                            cache_dir=clevr_occs_cache_dir,
                             max_objects_per_image=num_obj,
-                            image_size=(img_size, img_size), return_depth=return_depth, occlusions=True)
+                            image_size=(img_size, img_size), return_depth=return_depth, occlusions=True,
+                            decode_backend=decode_backend)
     elif dataset == 'clevr-occs2':
         data = CLEVRDataset(image_dir=clevr_occs2_image_dir,
                             scenes_json=clevr_occs2_scenes_json,
+                            cache_dir=clevr_occs2_cache_dir,
                             max_objects_per_image=num_obj,
-                            image_size=(img_size, img_size), return_depth=return_depth, occlusions=True)
+                            image_size=(img_size, img_size), return_depth=return_depth, occlusions=True,
+                            decode_backend=decode_backend)
     elif dataset == 'clevr-rubber':
         data = CLEVRDataset(image_dir=clevr_rubber_image_dir,
                             scenes_json=clevr_rubber_scenes_json,
+                            cache_dir=clevr_rubber_cache_dir,
                             max_objects_per_image=num_obj,
-                            image_size=(img_size, img_size), return_depth=return_depth, occlusions=True)
+                            image_size=(img_size, img_size), return_depth=return_depth, occlusions=True,
+                            decode_backend=decode_backend)
 
     return data
 
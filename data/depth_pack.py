@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Union
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+
+INDEX_FILENAME = 'index.json'
+DATA_FILENAME = 'depthmaps.bin'
+
+DTYPES = ('uint16', 'float16')
+
+
+def encode_depthmap(depthmap: np.ndarray, max_size: int = None, dtype: str = 'uint16'):
+    '''
+    Reduces a depthmap to max_size and quantizes it
+
+    Args:
+        depthmap: float array of shape (H, W)
+        max_size: maximum size of the longer side, the depthmap is downscaled
+                  with area interpolation if larger, None keeps the full resolution
+        dtype: 'uint16' for 16 bit linear quantization between the min and max
+               of the depthmap, 'float16' for half precision values
+    Returns:
+        (data, min, scale): encoded depthmap of shape (h, w) and the parameters
+                            to decode it, data * scale + min, None for float16
+    '''
+    depthmap = np.asarray(depthmap, dtype=np.float32)
+    H, W = depthmap.shape
+
+    if max_size is not None and max(H, W) > max_size:
+        factor = max_size / max(H, W)
+        size = (max(1, round(W * factor)), max(1, round(H * factor)))
+        depthmap = cv2.resize(depthmap, size, interpolation=cv2.INTER_AREA)
+
+    if dtype == 'float16':
+        return depthmap.astype(np.float16), None, None
+
+    if dtype != 'uint16':
+        raise ValueError(f'Unsupported dtype {dtype}, expected one of {DTYPES}')
+
+    min_, max_ = float(depthmap.min()), float(depthmap.max())
+    scale = (max_ - min_) / 65535
+    if scale == 0:
+        return np.zeros(depthmap.shape, dtype=np.uint16), min_, 0.0
+
+    data = np.rint((depthmap - min_) / scale).clip(0, 65535).astype(np.uint16)
+    return data, min_, scale
+
+
+class PackedDepthmaps(object):
+    '''
+    Read-only access to depthmaps packed by DepthPackWriter
+
+    All depthmaps are stored one after the other in a single binary file,
+    with an index of their offset, size and quantization. The file is
+    mapped lazily, so that each DataLoader worker maps it on its own.
+    '''
+
+    def __init__(self, pack_dir: Union[str, Path]):
+        self.pack_dir = Path(pack_dir)
+
+        with open(Path(self.pack_dir, INDEX_FILENAME), 'r') as fj:
+            index = json.load(fj)
+
+        self.dtype = index['dtype']
+        self.max_size = index['max_size']
+
+        # filename -> (offset, height, width, min, scale)
+        self.depthmaps = index['depthmaps']
+
+        self._data = None
+
+    def __getstate__(self):
+        # don't send the mapped file to the workers, they will map it again
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __contains__(self, filename):
+        return filename in self.depthmaps
+
+    def __len__(self):
+        return len(self.depthmaps)
+
+    def __getitem__(self, filename) -> np.ndarray:
+        '''Returns the decoded (h, w) float32 depthmap of an image'''
+        if self._data is None:
+            self._data = np.memmap(Path(self.pack_dir, DATA_FILENAME), dtype=self.dtype, mode='r')
+
+        offset, H, W, min_, scale = self.depthmaps[filename]
+        data = self._data[offset:offset + H * W].reshape(H, W)
+
+        if self.dtype == 'float16':
+            return data.astype(np.float32)
+
+        return data.astype(np.float32) * np.float32(scale) + np.float32(min_)
+
+
+class DepthPackWriter(object):
+    '''
+    Writes depthmaps to a pack read by PackedDepthmaps
+
+    Depthmaps are appended to the data file and the index is saved every
+    flush_every depthmaps and on close. An existing pack is reopened and
+    extended, so an interrupted packing resumes from the last saved index,
+    data appended after it is discarded.
+
+    Args:
+        pack_dir: output directory for the data file and index.json
+        max_size: maximum size of the longer side of the stored depthmaps
+        dtype: 'uint16' or 'float16', see encode_depthmap
+        flush_every: number of depthmaps between two saves of the index
+    '''
+
+    def __init__(self, pack_dir: Union[str, Path], max_size: int = None, dtype: str = 'uint16',
+                 flush_every: int = 1000):
+        if dtype not in DTYPES:
+            raise ValueError(f'Unsupported dtype {dtype}, expected one of {DTYPES}')
+
+        self.pack_dir = Path(pack_dir)
+        self.max_size = max_size
+        self.dtype = dtype
+        self.flush_every = flush_every
+        self.depthmaps = {}
+        self.size = 0
+
+        os.makedirs(self.pack_dir, exist_ok=True)
+
+        if Path(self.pack_dir, INDEX_FILENAME).is_file():
+            with open(Path(self.pack_dir, INDEX_FILENAME), 'r') as fj:
+                index = json.load(fj)
+            if index['dtype'] != dtype or index['max_size'] != max_size:
+                raise ValueError(f'Pack in {pack_dir} has dtype {index["dtype"]} and max_size '
+                                 f'{index["max_size"]}, expected {dtype} and {max_size}')
+            self.depthmaps = index['depthmaps']
+            self.size = index['size']
+
+        self._file = open(Path(self.pack_dir, DATA_FILENAME), 'ab')
+        self._file.truncate(self.size * np.dtype(self.dtype).itemsize)
+        self._unflushed = 0
+
+    def __contains__(self, filename):
+        return filename in self.depthmaps
+
+    def __len__(self):
+        return len(self.depthmaps)
+
+    def add(self, filename: str, depthmap: np.ndarray):
+        '''Reduces, quantizes and appends the depthmap of an image'''
+        self.add_encoded(filename, *encode_depthmap(depthmap, self.max_size, self.dtype))
+
+    def add_encoded(self, filename: str, data: np.ndarray, min_: float, scale: float):
+        '''Appends a depthmap already encoded by encode_depthmap'''
+        H, W = data.shape
+        self._file.write(np.ascontiguousarray(data, dtype=self.dtype).tobytes())
+        self.depthmaps[filename] = (self.size, H, W, min_, scale)
+        self.size += H * W
+
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        '''Saves the index of the depthmaps written so far'''
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        # written under a temporary name and renamed, the index
+        # never refers to depthmaps that aren't in the data file
+        tmp = Path(self.pack_dir, f'{INDEX_FILENAME}.tmp')
+        with open(tmp, 'w') as fj:
+            json.dump({
+                'dtype': self.dtype,
+                'max_size': self.max_size,
+                'size': self.size,
+                'depthmaps': self.depthmaps
+            }, fj)
+        os.replace(tmp, Path(self.pack_dir, INDEX_FILENAME))
+        self._unflushed = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _EncodedDepthmaps(Dataset):
+    '''Loads and encodes .npy depthmaps for the packing step, in the DataLoader workers'''
+
+    def __init__(self, depth_dir, filenames, max_size, dtype):
+        self.depth_dir = depth_dir
+        self.filenames = filenames
+        self.max_size = max_size
+        self.dtype = dtype
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        filename = self.filenames[index]
+        depthmap = np.load(Path(self.depth_dir, filename + '.npy'))
+        return (filename, *encode_depthmap(depthmap, self.max_size, self.dtype))
+
+
+def pack_depthmaps(dataset, out_dir: Union[str, Path], max_size: int = 256, dtype: str = 'uint16',
+                   num_workers: int = 8):
+    '''
+    Packs the .npy depthmaps of a CocoSceneGraphDataset, saved by
+    utils.depth.depth_estimation in dataset.depth_dir, in a single file
+
+    Depthmaps already in the pack are skipped.
+
+    Args:
+        dataset: CocoSceneGraphDataset with depth_dir set
+        out_dir: output directory of the pack
+        max_size, dtype: see encode_depthmap
+        num_workers: DataLoader workers loading and encoding the depthmaps
+    '''
+    with DepthPackWriter(out_dir, max_size, dtype) as writer:
+        filenames = [dataset.image_id_to_filename[image_id] for image_id in dataset.image_ids]
+        filenames = [filename for filename in filenames if filename not in writer]
+
+        loader = DataLoader(_EncodedDepthmaps(dataset.depth_dir, filenames, max_size, dtype),
+                            batch_size=None, shuffle=False, num_workers=num_workers,
+                            collate_fn=lambda sample: sample)
+
+        for filename, data, min_, scale in tqdm(loader):
+            writer.add_encoded(filename, data, min_, scale)
+
+
+if __name__ == '__main__':
+    from data.datasets import get_dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='coco',
+                        help='dataset of the depthmaps, only coco is supported')
+    parser.add_argument('--mode', type=str, default='train',
+                        help='split to pack, train or val')
+    parser.add_argument('--max_size', type=int, default=256,
+                        help='maximum size of the longer side of the packed depthmaps')
+    parser.add_argument('--dtype', type=str, default='uint16', choices=DTYPES,
+                        help='storage type of the packed depthmaps')
+    parser.add_argument('--out_path', type=str, default=None,
+                        help='output directory, defaults to datasets/{dataset}-depth-pack/{mode}')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='number of workers encoding the depthmaps')
+    args = parser.parse_args()
+
+    if args.out_path is None:
+        args.out_path = Path('datasets', f'{args.dataset}-depth-pack', args.mode)
+
+    pack_depthmaps(get_dataset(args.dataset, None, args.mode), args.out_path,
+                   max_size=args.max_size, dtype=args.dtype, num_workers=args.num_workers)
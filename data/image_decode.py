@@ -0,0 +1,45 @@
+from pathlib import Path
+from typing import Union
+
+import PIL
+from PIL import Image, ImageOps
+
+
+# 'pil': full size decoding, 'draft': JPEG images are decoded at a reduced size
+DECODE_BACKENDS = ('pil', 'draft')
+
+
+def open_rgb_image(path: Union[str, Path], image_size: 'tuple[int, int]' = None, decode_backend: str = 'pil',
+                   flip: bool = False) -> 'tuple[PIL.Image.Image, tuple[int, int]]':
+    '''
+    Decodes an image as RGB, to be resized to image_size by the dataset's transform
+
+    With the 'draft' backend JPEG images are downscaled by libjpeg in the DCT
+    domain while decoding, by the largest factor among 1/2, 1/4 and 1/8 that
+    keeps them at least as large as image_size, so that the final resize
+    starts from a much smaller image. Other formats are decoded as usual.
+
+    Args:
+        path: image file
+        image_size: (H, W) size the image will be resized to, None or (None, None)
+                    if it's used at full size, then it's decoded at full size
+        decode_backend: one of DECODE_BACKENDS
+        flip: mirror the image horizontally
+    Returns:
+        (image, size): decoded RGB image and the (W, H) size of the original image
+    '''
+    if decode_backend not in DECODE_BACKENDS:
+        raise ValueError(f'Unsupported decode backend {decode_backend}, expected one of {DECODE_BACKENDS}')
+
+    with open(path, 'rb') as f:
+        with Image.open(f) as image:
+            size = image.size
+
+            if decode_backend == 'draft' and image_size is not None and image_size[0] is not None:
+                # no-op for formats other than JPEG
+                H, W = image_size
+                image.draft('RGB', (W, H))
+
+            if flip:
+                image = ImageOps.mirror(image)
+            return image.convert('RGB'), size
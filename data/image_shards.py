@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from PIL import Image
+from tqdm import tqdm
+
+
+INDEX_FILENAME = 'index.json'
+
+
+class PackedImageShards(object):
+    '''
+    Read-only access to images packed by pack_image_shards
+
+    The shards are (N, H, W, 3) uint8 .npy files opened with mmap, images are
+    returned as zero-copy torch views of the mapped memory. The shards are
+    opened lazily, so that each DataLoader worker maps them on its own.
+    '''
+
+    def __init__(self, shards_dir: Union[str, Path]):
+        self.shards_dir = Path(shards_dir)
+
+        with open(Path(self.shards_dir, INDEX_FILENAME), 'r') as fj:
+            index = json.load(fj)
+
+        self.image_size = tuple(index['image_size'])
+        self.shard_files = index['shards']
+
+        # image_id -> (shard number, position in the shard)
+        self.image_id_to_location = {
+            int(image_id): tuple(loc) for image_id, loc in index['images'].items()}
+
+        self._shards = None
+
+    def __getstate__(self):
+        # don't send mapped arrays to the workers, they will map the files again
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __contains__(self, image_id):
+        return image_id in self.image_id_to_location
+
+    def __len__(self):
+        return len(self.image_id_to_location)
+
+    def _open(self):
+        # copy-on-write mapping, pages are shared between processes
+        # and the arrays are writable, as torch.from_numpy expects
+        self._shards = [np.load(Path(self.shards_dir, filename), mmap_mode='c')
+                        for filename in self.shard_files]
+
+    def __getitem__(self, image_id) -> torch.Tensor:
+        '''Returns the (H, W, 3) uint8 image as a view of the shard'''
+        if self._shards is None:
+            self._open()
+
+        shard, position = self.image_id_to_location[image_id]
+        return torch.from_numpy(self._shards[shard][position])
+
+    def load(self, image_id, flip: bool = False, normalize: bool = True) -> torch.Tensor:
+        '''
+        Returns the image as a (3, H, W) float tensor, like ToTensor
+        (and imagenet_preprocess if normalize) would do on the PIL image
+        '''
+        image = self[image_id].permute(2, 0, 1).float().div_(255)
+
+        if flip:
+            image = image.flip(-1)
+
+        if normalize:
+            # same as imagenet_preprocess, mean and std 0.5
+            image = image.sub_(0.5).div_(0.5)
+
+        return image
+
+
+class _ResizedImages(Dataset):
+    '''Decodes and resizes images for the packing step, in the DataLoader workers'''
+
+    def __init__(self, image_paths, image_size):
+        self.image_paths = image_paths
+        # PIL size is (W, H)
+        self.size = (image_size[1], image_size[0])
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        with open(self.image_paths[index], 'rb') as f:
+            with Image.open(f) as image:
+                image = image.convert('RGB').resize(self.size, Image.BILINEAR)
+        return torch.from_numpy(np.asarray(image).copy())
+
+
+def pack_image_shards(dataset, out_dir: Union[str, Path], images_per_shard: int = 16384, num_workers: int = 8):
+    '''
+    Resizes every image of a CocoSceneGraphDataset once and writes them
+    in uint8 .npy shards, with an index keyed by image id
+
+    Only the unflipped images are stored, flipped indices are served by
+    flipping the image while converting it to float.
+
+    Args:
+        dataset: CocoSceneGraphDataset, its image_size is used for the shards
+        out_dir: output directory for the shards and index.json
+        images_per_shard: maximum number of images in a single shard
+        num_workers: DataLoader workers used to decode the images
+    '''
+    if dataset.image_size[0] is None:
+        raise ValueError('Images can only be packed at a fixed image size')
+
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    H, W = dataset.image_size
+    image_ids = sorted(dataset.image_id_to_filename.keys())
+    image_paths = [os.path.join(dataset.image_dir, dataset.image_id_to_filename[image_id])
+                   for image_id in image_ids]
+
+    loader = DataLoader(_ResizedImages(image_paths, (H, W)), batch_size=64,
+                        shuffle=False, num_workers=num_workers)
+
+    shard_files = []
+    locations = {}
+    shard = None
+    written = 0
+
+    for batch in tqdm(loader):
+        batch = batch.numpy()
+        start = 0
+
+        while start < batch.shape[0]:
+            position = written % images_per_shard
+
+            if position == 0:
+                # start a new shard
+                if shard is not None:
+                    shard.flush()
+                num = min(images_per_shard, len(image_ids) - written)
+                filename = f'images_{len(shard_files):03d}.npy'
+                shard = np.lib.format.open_memmap(
+                    Path(out_dir, filename), mode='w+', dtype=np.uint8, shape=(num, H, W, 3))
+                shard_files.append(filename)
+
+            count = min(batch.shape[0] - start, shard.shape[0] - position)
+            shard[position:position + count] = batch[start:start + count]
+
+            for i in range(count):
+                locations[image_ids[written + i]] = (len(shard_files) - 1, position + i)
+
+            start += count
+            written += count
+
+    if shard is not None:
+        shard.flush()
+
+    # the index is written last, a partial pack has no index
+    with open(Path(out_dir, INDEX_FILENAME), 'w') as fj:
+        json.dump({
+            'image_size': [H, W],
+            'shards': shard_files,
+            'images': locations
+        }, fj)
+
+
+if __name__ == '__main__':
+    from data.datasets import get_dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='coco',
+                        help='dataset to pack, only coco is supported')
+    parser.add_argument('--mode', type=str, default='train',
+                        help='split to pack, train or val')
+    parser.add_argument('--img_size', type=int, default=128,
+                        help='size of the packed images')
+    parser.add_argument('--out_path', type=str, default=None,
+                        help='output directory, defaults to datasets/{dataset}-shards/{mode}')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='number of workers decoding the images')
+    args = parser.parse_args()
+
+    if args.out_path is None:
+        args.out_path = Path('datasets', f'{args.dataset}-shards', args.mode)
+
+    pack_image_shards(get_dataset(args.dataset, args.img_size, args.mode),
+                      args.out_path, num_workers=args.num_workers)
@@ -27,12 +27,28 @@ import numpy as np
 import h5py
 import PIL
 
+from data.batching import batch_buffer
+from data.image_decode import open_rgb_image
+
 
 class VgSceneGraphDataset(Dataset):
     def __init__(self, vocab, h5_path, image_dir, image_size=(256, 256),
                  normalize_images=True, max_objects=10, max_samples=None,
                  include_relationships=True, use_orphaned_objects=True,
-                 left_right_flip=False):
+                 left_right_flip=False, memory_map=False, seed=None, decode_backend='pil'):
+        """
+        A PyTorch Dataset for loading the Visual Genome scene graphs
+        preprocessed by scripts/preprocess_vg.py.
+
+        With memory_map=True the HDF5 arrays are mapped from the file instead
+        of being copied in memory, and the image paths are kept in a single
+        numpy array instead of a list of python objects. Pages are then shared
+        between the DataLoader workers instead of being duplicated by
+        copy-on-write, so memory no longer scales with the number of workers.
+
+        If seed is given, the objects selected for each sample only depend on
+        the seed and the sample index.
+        """
         super(VgSceneGraphDataset, self).__init__()
 
         self.image_dir = image_dir
@@ -44,6 +60,12 @@ class VgSceneGraphDataset(Dataset):
         self.max_samples = max_samples
         self.left_right_flip = left_right_flip
         self.include_relationships = include_relationships
+        self.seed = seed
+        self.decode_backend = decode_backend
+
+        # padded layout, filled with the selected objects in get_objects
+        self._objs_template = torch.LongTensor(max_objects + 1).fill_(vocab['object_name_to_idx']['__image__'])
+        self._boxes_template = torch.FloatTensor([[-0.6, -0.6, 0.5, 0.5]]).repeat(max_objects + 1, 1)
 
         transform = [Resize(image_size), T.ToTensor()]
         if normalize_images:
@@ -54,7 +76,13 @@ class VgSceneGraphDataset(Dataset):
         with h5py.File(h5_path, 'r') as f:
             for k, v in f.items():
                 if k == 'image_paths':
-                    self.image_paths = list(v)
+                    if memory_map:
+                        # fixed length bytes, a single object for all the paths
+                        self.image_paths = np.asarray(v).astype(bytes)
+                    else:
+                        self.image_paths = list(v)
+                elif memory_map:
+                    self.data[k] = torch.from_numpy(memmap_h5_dataset(h5_path, v))
                 else:
                     self.data[k] = torch.IntTensor(np.asarray(v))
 
@@ -66,98 +94,137 @@ class VgSceneGraphDataset(Dataset):
             return num * 2
         return num
 
-    def __getitem__(self, index):
+    def _sample_rng(self, index, flip):
         """
-        Returns a tuple of:
-        - image: FloatTensor of shape (C, H, W)
-        - objs: LongTensor of shape (O,)
-        - boxes: FloatTensor of shape (O, 4) giving boxes for objects in
-          (x0, y0, x1, y1) format, in a [0, 1] coordinate system.
-        - triples: LongTensor of shape (T, 3) where triples[t] = [i, p, j]
-          means that (objs[i], p, objs[j]) is a triple.
+        Random generator used to select the objects of a sample. With a seed the
+        selection only depends on (seed, index, flip), otherwise it follows the
+        state of the random module, which the DataLoader seeds in every worker.
         """
-        flip = False
-        if index >= self.data['object_names'].size(0):
-            index = index - self.data['object_names'].size(0)
-            flip = True
+        if self.seed is not None:
+            return np.random.default_rng((self.seed, index, int(flip)))
+        return np.random.default_rng(random.getrandbits(64))
 
-        img_path = os.path.join(self.image_dir, self.image_paths[index].decode('utf-8'))
+    def get_objects(self, index, flip, size, rng):
+        """
+        Selects up to max_objects objects of the image, preferring the ones
+        that appear in relationships, and builds the padded layout.
+
+        Inputs:
+        - index: image index, flipped indices already mapped to their image
+        - flip: mirror the boxes horizontally
+        - size: (W, H) size of the image the boxes refer to
+        - rng: numpy random Generator used to sample the objects
 
-        with open(img_path, 'rb') as f:
-            with PIL.Image.open(f) as image:
-                if flip:
-                    image = PIL.ImageOps.mirror(image)
-                WW, HH = image.size
-                image = self.transform(image.convert('RGB'))
+        Returns a tuple of:
+        - objs: LongTensor of shape (max_objects + 1,), the real objects followed
+          by __image__ objects
+        - boxes: FloatTensor of shape (max_objects + 1, 4) in (x, y, w, h) format,
+          (0, 0, 1, 1) for the first __image__ object, then dummy boxes
+        """
+        num_objects = int(self.data['objects_per_image'][index])
+        num_rels = int(self.data['relationships_per_image'][index])
 
-        H, W = self.image_size
+        # these are indices to use in data['object_names'], not the actual objs labels
+        subjects = self.data['relationship_subjects'][index, :num_rels].numpy()
+        objects = self.data['relationship_objects'][index, :num_rels].numpy()
 
         # Figure out which objects appear in relationships and which don't
-        obj_idxs_with_rels = set()
-        obj_idxs_without_rels = set(range(self.data['objects_per_image'][index].item()))
-        for r_idx in range(self.data['relationships_per_image'][index]):
-            
-            # these are indices to use in data['object_names'], not the actual objs labels
-            s = self.data['relationship_subjects'][index, r_idx].item()
-            o = self.data['relationship_objects'][index, r_idx].item()
-            
-            obj_idxs_with_rels.add(s)
-            obj_idxs_with_rels.add(o)
-            obj_idxs_without_rels.discard(s)
-            obj_idxs_without_rels.discard(o)
-
-
-        obj_idxs = list(obj_idxs_with_rels)
-        obj_idxs_without_rels = list(obj_idxs_without_rels)
+        with_rels = np.zeros(self.data['object_names'].size(1), dtype=bool)
+        with_rels[subjects] = True
+        with_rels[objects] = True
+        obj_idxs = np.flatnonzero(with_rels)
+        obj_idxs_without_rels = np.flatnonzero(~with_rels[:num_objects])
 
         # if there are too many objects (with relationships) randomly sample some of them
         if len(obj_idxs) > self.max_objects - 1:
-            obj_idxs = random.sample(obj_idxs, self.max_objects)
+            obj_idxs = rng.choice(obj_idxs, self.max_objects, replace=False)
 
         # if there are too few, add come of the orphaned objects (objs without relationships)
         if len(obj_idxs) < self.max_objects - 1 and self.use_orphaned_objects:
             num_to_add = self.max_objects - 1 - len(obj_idxs)
             num_to_add = min(num_to_add, len(obj_idxs_without_rels))
-            obj_idxs += random.sample(obj_idxs_without_rels, num_to_add)
-        
-        # number of objs
+            obj_idxs = np.concatenate((obj_idxs, rng.choice(obj_idxs_without_rels, num_to_add, replace=False)))
+
+        # number of objs, including the __image__ object
         O = len(obj_idxs) + 1
+        obj_idxs = torch.from_numpy(obj_idxs)
 
-        # label tensor
-        objs = torch.LongTensor(self.max_objects+1).fill_(-1)
+        # labels, padded with __image__
+        objs = self._objs_template.clone()
+        objs[:O - 1] = self.data['object_names'][index, obj_idxs]
 
-        # bounding boxes
-        boxes = torch.FloatTensor([[0, 0, 1, 1]]).repeat(self.max_objects+1, 1)
+        # normalize the boxes, in double precision like python floats
+        WW, HH = size
+        obj_boxes = self.data['object_boxes'][index, obj_idxs].numpy() / np.array([WW, HH, WW, HH], dtype=np.float64)
+        if flip:
+            obj_boxes[:, 0] = 1 - (obj_boxes[:, 0] + obj_boxes[:, 2])
 
+        # the __image__ object covers the whole image, the rest are dummy boxes
+        boxes = self._boxes_template.clone()
+        boxes[:O - 1] = torch.from_numpy(obj_boxes)
+        boxes[O - 1] = torch.FloatTensor([0, 0, 1, 1])
 
-        # maps the object indices to their position in the label tensor
-        obj_idx_mapping = {}
+        return objs, boxes
 
-        for i, obj_idx in enumerate(obj_idxs):
+    def get_batch(self, indices):
+        """
+        Get a whole batch of samples, as default collation of __getitem__
+        would return it, writing every output directly in its batch buffer,
+        see data.batching.
+
+        Returns a tuple of:
+        - images: FloatTensor of shape (B, C, H, W)
+        - objs: LongTensor of shape (B, max_objects + 1)
+        - boxes: FloatTensor of shape (B, max_objects + 1, 4)
+        """
+        num = self.data['object_names'].size(0)
+        B, O = len(indices), self.max_objects + 1
 
-            # get the obj's label and bbox using its index
-            objs[i] = self.data['object_names'][index, obj_idx].item()
-            x, y, w, h = self.data['object_boxes'][index, obj_idx].tolist()
+        images = batch_buffer((B, 3, *self.image_size), torch.float32)
+        objs = batch_buffer((B, O), torch.int64)
+        boxes = batch_buffer((B, O, 4), torch.float32)
 
-            x0 = float(x) / WW
-            y0 = float(y) / HH
-            x1 = float(w) / WW
-            y1 = float(h) / HH
+        for i, index in enumerate(indices):
+            flip = index >= num
             if flip:
-                x0 = 1 - (x0 + x1)
-            boxes[i] = torch.FloatTensor([x0, y0, x1, y1])
-            obj_idx_mapping[obj_idx] = i
+                index = index - num
+
+            images[i], size = self.load_image(index, flip)
+            objs[i], boxes[i] = self.get_objects(index, flip, size, self._sample_rng(index, flip))
+
+        return images, objs, boxes
+
+    def load_image(self, index, flip=False):
+        """
+        Returns the transformed image as a FloatTensor of shape (C, H, W)
+        and the (W, H) size of the original image
+        """
+        img_path = os.path.join(self.image_dir, self.image_paths[index].decode('utf-8'))
+
+        image, size = open_rgb_image(img_path, self.image_size, self.decode_backend, flip)
+        return self.transform(image), size
+
+    def __getitem__(self, index):
+        """
+        Returns a tuple of:
+        - image: FloatTensor of shape (C, H, W)
+        - objs: LongTensor of shape (O,)
+        - boxes: FloatTensor of shape (O, 4) giving boxes for objects in
+          (x0, y0, x1, y1) format, in a [0, 1] coordinate system.
+        - triples: LongTensor of shape (T, 3) where triples[t] = [i, p, j]
+          means that (objs[i], p, objs[j]) is a triple.
+        """
+        if isinstance(index, (list, tuple)):
+            # a whole batch from data.batching.get_batch_loader
+            return self.get_batch(index)
 
-        # The last object will be the special __image__ object
-        objs[O - 1] = self.vocab['object_name_to_idx']['__image__']
+        flip = False
+        if index >= self.data['object_names'].size(0):
+            index = index - self.data['object_names'].size(0)
+            flip = True
 
-        # pad the labels and bboxes
-        # from the number of objects O to the maximum number of objs
-        for i in range(O, self.max_objects+1):
-            # objs.append(self.vocab['object_name_to_idx']['__image__'])
-            # boxes.append(np.array([-0.6, -0.6, 0.5, 0.5]))
-            objs[i] = self.vocab['object_name_to_idx']['__image__']
-            boxes[i] = torch.FloatTensor([-0.6, -0.6, 0.5, 0.5])
+        image, size = self.load_image(index, flip)
+        objs, boxes = self.get_objects(index, flip, size, self._sample_rng(index, flip))
 
         # triples = []
         # for r_idx in range(self.data['relationships_per_image'][index].item()):
@@ -180,6 +247,21 @@ class VgSceneGraphDataset(Dataset):
         return image, objs, boxes #, triples
 
 
+def memmap_h5_dataset(h5_path, dataset):
+    """
+    Maps a contiguous and uncompressed HDF5 dataset directly from the file.
+    Datasets that can't be mapped (chunked, compressed or empty) are read in memory.
+
+    The mapping is copy-on-write: the array is writable, as torch.from_numpy
+    expects, but it's never written back and its pages stay shared.
+    """
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None or dataset.size == 0:
+        return np.asarray(dataset)
+    return np.memmap(h5_path, dtype=dataset.dtype, mode='c',
+                     offset=offset, shape=dataset.shape)
+
+
 class Resize(object):
     def __init__(self, size, interp=PIL.Image.BILINEAR):
         if isinstance(size, tuple):
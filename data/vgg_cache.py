@@ -0,0 +1,188 @@
+import json
+import os
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data._utils.collate import default_collate
+
+from .batching import batch_buffer
+
+
+INDEX_FILENAME = 'index.json'
+CACHED_FILENAME = 'cached.bin'
+
+# channels and downscaling of the VGG19 slices of utils.util.Vgg19, relu1_1 to relu5_1
+VGG_SLICES = ((64, 1), (128, 2), (256, 4), (512, 8), (512, 16))
+
+
+def vgg_feature_shapes(image_size: 'tuple[int, int]', num_slices: int = 5) -> 'list[tuple[int, int, int]]':
+    '''Returns the (C, H, W) shapes of the features of the first num_slices VGG19 slices of an image'''
+    H, W = image_size
+    return [(C, H // scale, W // scale) for C, scale in VGG_SLICES[:num_slices]]
+
+
+def cached_slices(image_size: 'tuple[int, int]', num_samples: int, num_slices: int = 5, max_bytes: int = None) -> int:
+    '''
+    Returns the number of slices, from the shallowest, whose float16 features
+    of num_samples images fit in max_bytes, all of them if max_bytes is None
+    '''
+    if max_bytes is None:
+        return num_slices
+
+    size = 0
+    for i, shape in enumerate(vgg_feature_shapes(image_size, num_slices)):
+        size += int(np.prod(shape)) * 2 * num_samples
+        if size > max_bytes:
+            return i
+    return num_slices
+
+
+class VGGFeatureCache(object):
+    '''
+    On-disk cache of the VGG19 features of the real training images
+
+    Real images only depend on their dataset index, which also tells the
+    flipped copies apart (flipped images are indexed after the originals),
+    so their features are computed in the first epoch and read back in the
+    following ones. The features of each slice are stored in float16 in a
+    memory-mapped file, a sample at a time, with a flag per sample telling
+    whether it has been written.
+
+    VGG needs the slices in order, so only the first ones fit in a budget:
+    the deeper features are then computed from the deepest cached slice, see
+    utils.util.VGGLoss. The shallow slices are the largest, 2 MB per 128x128
+    image for relu1_1 out of 4 MB for all of them.
+
+    Args:
+        cache_dir: directory of the cache, created or reopened
+        num_samples: size of the dataset
+        image_size: (H, W) size of the images
+        num_slices: number of slices used by the loss
+        max_bytes: size budget of the cache, None for no limit
+        meta: description of the images and VGG weights, e.g. the dataset and
+              decode backend, a cache built for different ones can't be reopened
+    '''
+
+    def __init__(self, cache_dir: Union[str, Path], num_samples: int, image_size: 'tuple[int, int]',
+                 num_slices: int = 5, max_bytes: int = None, meta: dict = None):
+        self.cache_dir = Path(cache_dir)
+        self.num_samples = num_samples
+        self.image_size = tuple(image_size)
+        self.num_slices = cached_slices(self.image_size, num_samples, num_slices, max_bytes)
+        self.meta = meta or {}
+
+        if self.num_slices == 0:
+            raise ValueError(f'The relu1_1 features of {num_samples} images don\'t fit in {max_bytes} bytes')
+
+        index = {
+            'num_samples': num_samples,
+            'image_size': list(self.image_size),
+            'num_slices': self.num_slices,
+            'meta': self.meta
+        }
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index_path = Path(self.cache_dir, INDEX_FILENAME)
+        if index_path.is_file():
+            with open(index_path, 'r') as fj:
+                existing = json.load(fj)
+            if existing != index:
+                raise ValueError(f'VGG feature cache in {cache_dir} was built with {existing}, expected {index}')
+        else:
+            # sparse files, only the written samples take space
+            for filename, size in self._files():
+                with open(Path(self.cache_dir, filename), 'wb') as f:
+                    f.truncate(size)
+            with open(index_path, 'w') as fj:
+                json.dump(index, fj)
+
+        self._cached = None
+        self._features = None
+
+    def _files(self) -> 'list[tuple[str, int]]':
+        files = [(CACHED_FILENAME, self.num_samples)]
+        for i, shape in enumerate(self.shapes):
+            files.append((f'slice{i + 1}.bin', int(np.prod(shape)) * 2 * self.num_samples))
+        return files
+
+    @property
+    def shapes(self) -> 'list[tuple[int, int, int]]':
+        '''(C, H, W) shapes of the cached features of a sample'''
+        return vgg_feature_shapes(self.image_size, self.num_slices)
+
+    def __getstate__(self):
+        # don't send the mapped files to the workers, they will map them again
+        state = self.__dict__.copy()
+        state['_cached'] = None
+        state['_features'] = None
+        return state
+
+    def _map(self):
+        if self._cached is None:
+            self._cached = np.memmap(Path(self.cache_dir, CACHED_FILENAME), dtype=np.uint8, mode='r+')
+            self._features = [np.memmap(Path(self.cache_dir, f'slice{i + 1}.bin'), dtype=np.float16, mode='r+',
+                                        shape=(self.num_samples,) + shape)
+                              for i, shape in enumerate(self.shapes)]
+
+    def cached(self, indices) -> np.ndarray:
+        '''Returns whether the features of each sample are cached'''
+        self._map()
+        return self._cached[np.asarray(indices)].astype(bool)
+
+    def get(self, indices) -> 'list[torch.Tensor]':
+        '''
+        Returns the float16 (B, C, H, W) features of each cached slice of the
+        samples, None if any of them isn't cached
+        '''
+        if not self.cached(indices).all():
+            return None
+
+        # sorted reads, the batch indices are random
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        features = []
+        for data in self._features:
+            out = batch_buffer((len(indices),) + data.shape[1:], torch.float16)
+            out.numpy()[order] = data[indices[order]]
+            features.append(out)
+        return features
+
+    def put(self, indices, features: 'list[torch.Tensor]'):
+        '''Writes the features of the samples, features of deeper slices than the cached ones are ignored'''
+        self._map()
+        indices = np.asarray(indices)
+        for data, feature in zip(self._features, features):
+            data[indices] = feature.detach().to('cpu', torch.float16).numpy()
+        # the flags are only set once the features are written
+        self._cached[indices] = 1
+
+
+class CachedFeatureBatches(Dataset):
+    '''
+    Batches of a dataset along with their dataset indices and their cached
+    VGG features, which are read by the DataLoader workers with the images
+
+    Batches are (batch, indices, features), features being None until all
+    the samples of the batch are cached. Indexed with lists of indices by
+    data.batching.get_batch_loader.
+    '''
+
+    def __init__(self, dataset: Dataset, cache: VGGFeatureCache):
+        self.dataset = dataset
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def get_batch(self, indices):
+        if hasattr(self.dataset, 'get_batch'):
+            batch = self.dataset.get_batch(indices)
+        else:
+            batch = default_collate([self.dataset[index] for index in indices])
+        return batch, torch.as_tensor(indices), self.cache.get(indices)
+
+    def __getitem__(self, indices):
+        return self.get_batch(indices)
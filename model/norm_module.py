@@ -176,16 +176,24 @@ class SpatialAdaptiveSynBatchNorm2d(nn.Module):
         # standard batch norm synchronized across devices to normalize features
         output = self.batch_norm2d(x)
 
+        # projection matrices learned from the label + style vector, A in the paper
+        # calculate weight and bias, transformation parameters, Tau in the paper
+        weight, bias = self.weight_proj(vector), self.bias_proj(vector)
+
+        if any(t.dtype in (torch.float16, torch.bfloat16) for t in (output, weight, bbox)):
+            # under mixed precision the mask normalized weight and bias are computed
+            # in float32, the + 1e-6 would vanish next to the mask sums in float16
+            with torch.autocast(x.device.type, enabled=False):
+                return self._modulate(output.float(), weight.float(), bias.float(), bbox.float()).to(x.dtype)
+        return self._modulate(output, weight, bias, bbox)
+
+    def _modulate(self, output, weight, bias, bbox):
         b, o, bh, bw = bbox.size()
-        _, _, h, w = x.size()
+        _, _, h, w = output.size()
 
         # adapt the mask to have the same size as the input features
         if bh != h or bw != w:
             bbox = F.interpolate(bbox, size=(h, w), mode='bilinear')
-        
-        # projection matrices learned from the label + style vector, A in the paper
-        # calculate weight and bias, transformation parameters, Tau in the paper
-        weight, bias = self.weight_proj(vector), self.bias_proj(vector)
 
         # resize weight and bias
         # (batch, num_o, num_features), (batch, num_o, num_features)
@@ -260,26 +260,50 @@ class ResBlock(nn.Module):
         return self.residual(in_feat) + self.shortcut(in_feat)
 
 
+def prepare_rois(bbox, image_size):
+    """
+    Converts normalized (x, y, w, h) boxes to the (x1, y1, x2, y2) pixel boxes
+    of the ROI layers, in a new tensor, bbox isn't modified
+
+    Prepared once per batch, the rois can be shared by the discriminator
+    calls of a training step in place of bbox.
+    :param bbox: (b, o, 4)
+    :param image_size: size of the square images
+    :return: (b, o, 4) float rois
+    """
+    rois = torch.cat((bbox[:, :, :2], bbox[:, :, 2:] + bbox[:, :, :2]), dim=2) * image_size
+    return rois.float()
+
+
+def object_rois(images, rois, label):
+    """
+    ROIs of the objects with their image index, padding objects (label 0) left out
+    :param images: (b, 3, h, w)
+    :param rois: (b, o, 4) rois of prepare_rois
+    :param label: (b, o) or (b, o, 1)
+    :return: (n, 5) rois (image index, x1, y1, x2, y2) and (n,) labels
+    """
+    idx = torch.arange(start=0, end=images.size(0),
+                       device=images.device).view(images.size(0),
+                                                  1, 1).expand(-1, rois.size(1), -1).float()
+    rois = torch.cat((idx, rois), dim=2).view(-1, 5)
+    label = label.view(-1)
+
+    idx = (label != 0).nonzero().view(-1)
+    return rois[idx], label[idx]
+
+
 class CombineDiscriminator256(nn.Module):
     def __init__(self, num_classes=81):
         super(CombineDiscriminator256, self).__init__()
         self.obD = ResnetDiscriminator256(num_classes=num_classes, input_dim=3)
 
-    def forward(self, images, bbox, label, mask=None):
-        idx = torch.arange(start=0, end=images.size(0),
-                           device=images.device).view(images.size(0),
-                                                      1, 1).expand(-1, bbox.size(1), -1).float()
-        bbox[:, :, 2] = bbox[:, :, 2] + bbox[:, :, 0]
-        bbox[:, :, 3] = bbox[:, :, 3] + bbox[:, :, 1]
-        bbox = bbox * images.size(2)
-        bbox = torch.cat((idx, bbox.float()), dim=2)
-        bbox = bbox.view(-1, 5)
-        label = label.view(-1)
-
-        idx = (label != 0).nonzero().view(-1)
-        bbox = bbox[idx]
-        label = label[idx]
-        d_out_img, d_out_obj = self.obD(images, label, bbox)
+    def forward(self, images, bbox=None, label=None, mask=None, rois=None):
+        # bbox isn't modified, the rois of prepare_rois can be given in its place
+        if rois is None:
+            rois = prepare_rois(bbox, images.size(2))
+        rois, label = object_rois(images, rois, label)
+        d_out_img, d_out_obj = self.obD(images, label, rois)
         return d_out_img, d_out_obj
     
 
@@ -288,21 +312,12 @@ class CombineDiscriminator128(nn.Module):
         super(CombineDiscriminator128, self).__init__()
         self.obD = ResnetDiscriminator128(num_classes=num_classes, input_dim=3)
 
-    def forward(self, images, bbox, label, mask=None):
-        idx = torch.arange(start=0, end=images.size(0),
-                           device=images.device).view(images.size(0),
-                                                      1, 1).expand(-1, bbox.size(1), -1).float()
-        bbox[:, :, 2] = bbox[:, :, 2] + bbox[:, :, 0]
-        bbox[:, :, 3] = bbox[:, :, 3] + bbox[:, :, 1]
-        bbox = bbox * images.size(2)
-        bbox = torch.cat((idx, bbox.float()), dim=2)
-        bbox = bbox.view(-1, 5)
-        label = label.view(-1)
-
-        idx = (label != 0).nonzero().view(-1)
-        bbox = bbox[idx]
-        label = label[idx]
-        d_out_img, d_out_obj = self.obD(images, label, bbox)
+    def forward(self, images, bbox=None, label=None, mask=None, rois=None):
+        # bbox isn't modified, the rois of prepare_rois can be given in its place
+        if rois is None:
+            rois = prepare_rois(bbox, images.size(2))
+        rois, label = object_rois(images, rois, label)
+        d_out_img, d_out_obj = self.obD(images, label, rois)
         return d_out_img, d_out_obj
 
 
@@ -311,19 +326,10 @@ class CombineDiscriminator64(nn.Module):
         super(CombineDiscriminator64, self).__init__()
         self.obD = ResnetDiscriminator64(num_classes=num_classes, input_dim=3)
 
-    def forward(self, images, bbox, label, mask=None):
-        idx = torch.arange(start=0, end=images.size(0),
-                           device=images.device).view(images.size(0),
-                                                      1, 1).expand(-1, bbox.size(1), -1).float()
-        bbox[:, :, 2] = bbox[:, :, 2] + bbox[:, :, 0]
-        bbox[:, :, 3] = bbox[:, :, 3] + bbox[:, :, 1]
-        bbox = bbox * images.size(2)
-        bbox = torch.cat((idx, bbox.float()), dim=2)
-        bbox = bbox.view(-1, 5)
-        label = label.view(-1)
-
-        idx = (label != 0).nonzero().view(-1)
-        bbox = bbox[idx]
-        label = label[idx]
-        d_out_img, d_out_obj = self.obD(images, label, bbox)
+    def forward(self, images, bbox=None, label=None, mask=None, rois=None):
+        # bbox isn't modified, the rois of prepare_rois can be given in its place
+        if rois is None:
+            rois = prepare_rois(bbox, images.size(2))
+        rois, label = object_rois(images, rois, label)
+        d_out_img, d_out_obj = self.obD(images, label, rois)
         return d_out_img, d_out_obj
@@ -546,8 +546,8 @@ def bbox_mask(x, bbox, H, W):
     y0 = y0.contiguous().view(N, 1).expand(N, W)
     hh = hh.contiguous().view(N, 1).expand(N, W)
 
-    X = torch.linspace(0, 1, steps=W).view(1, W).expand(N, W).cuda(device=x.device)
-    Y = torch.linspace(0, 1, steps=H).view(1, H).expand(N, H).cuda(device=x.device)
+    X = torch.linspace(0, 1, steps=W).view(1, W).expand(N, W).to(x.device)
+    Y = torch.linspace(0, 1, steps=H).view(1, H).expand(N, H).to(x.device)
 
     X = (X - x0) / ww
     Y = (Y - y0) / hh
@@ -54,6 +54,13 @@ class ROIAlign(nn.Module):
         self.sampling_ratio = sampling_ratio
 
     def forward(self, input, rois):
+        # the kernels are float32 and float64 only, under mixed precision
+        # the features are aligned in float32
+        if input.dtype in (torch.float16, torch.bfloat16):
+            with torch.autocast(input.device.type, enabled=False):
+                return roi_align(
+                    input.float(), rois.float(), self.output_size, self.spatial_scale, self.sampling_ratio
+                ).to(input.dtype)
         return roi_align(
             input, rois, self.output_size, self.spatial_scale, self.sampling_ratio
         )
@@ -11,6 +11,7 @@
 import collections
 
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 
 from torch.nn.modules.batchnorm import _BatchNorm
@@ -18,7 +19,7 @@ from torch.nn.parallel._functions import ReduceAddCoalesced, Broadcast
 
 from .comm import SyncMaster
 
-__all__ = ['SynchronizedBatchNorm1d', 'SynchronizedBatchNorm2d', 'SynchronizedBatchNorm3d']
+__all__ = ['SynchronizedBatchNorm1d', 'SynchronizedBatchNorm2d', 'SynchronizedBatchNorm3d', 'set_process_group']
 
 
 def _sum_ft(tensor):
@@ -35,8 +36,25 @@ _ChildMessage = collections.namedtuple('_ChildMessage', ['sum', 'ssum', 'sum_siz
 _MasterMessage = collections.namedtuple('_MasterMessage', ['sum', 'inv_std'])
 
 
+class _AllReduce(torch.autograd.Function):
+    """Sum of a tensor over the processes of a group, whose backward sums the gradients over the processes."""
+
+    @staticmethod
+    def forward(ctx, tensor, process_group):
+        ctx.process_group = process_group
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, group=process_group)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output, group=ctx.process_group)
+        return grad_output, None
+
+
 class _SynchronizedBatchNorm(_BatchNorm):
-    def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True):
+    def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True, process_group=None):
         super(_SynchronizedBatchNorm, self).__init__(num_features, eps=eps, momentum=momentum, affine=affine)
 
         self._sync_master = SyncMaster(self._data_parallel_master)
@@ -45,9 +63,31 @@ class _SynchronizedBatchNorm(_BatchNorm):
         self._parallel_id = None
         self._slave_pipe = None
 
+        # torch.distributed group whose processes are synchronized, see set_process_group.
+        self._process_group = process_group
+
+    def __getstate__(self):
+        # Process groups only exist in the process that created them.
+        state = self.__dict__.copy()
+        state['_process_group'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Modules pickled before the process groups.
+        state.setdefault('_process_group', None)
+        super(_SynchronizedBatchNorm, self).__setstate__(state)
+
     def forward(self, input):
+        # Under mixed precision, compute the statistics and normalize in float32.
+        if input.dtype in (torch.float16, torch.bfloat16) and self.running_var is not None \
+                and self.running_var.dtype == torch.float32:
+            with torch.autocast(input.device.type, enabled=False):
+                return self._forward(input.float()).to(input.dtype)
+        return self._forward(input)
+
+    def _forward(self, input):
         # If it is not parallel computation or is in evaluation mode, use PyTorch's implementation.
-        if not (self._is_parallel and self.training):
+        if not ((self._is_parallel or self._process_group is not None) and self.training):
             return F.batch_norm(
                 input, self.running_mean, self.running_var, self.weight, self.bias,
                 self.training, self.momentum, self.eps)
@@ -61,8 +101,11 @@ class _SynchronizedBatchNorm(_BatchNorm):
         input_sum = _sum_ft(input)
         input_ssum = _sum_ft(input ** 2)
 
-        # Reduce-and-broadcast the statistics.
-        if self._parallel_id == 0:
+        # Reduce-and-broadcast the statistics, the master of DataParallel replicas all-reduces them
+        # across the processes.
+        if not self._is_parallel:
+            mean, inv_std = self._compute_mean_std(*self._all_reduce(input_sum, input_ssum, sum_size))
+        elif self._parallel_id == 0:
             mean, inv_std = self._sync_master.run_master(_ChildMessage(input_sum, input_ssum, sum_size))
         else:
             mean, inv_std = self._slave_pipe.run_slave(_ChildMessage(input_sum, input_ssum, sum_size))
@@ -100,6 +143,8 @@ class _SynchronizedBatchNorm(_BatchNorm):
 
         sum_size = sum([i[1].sum_size for i in intermediates])
         sum_, ssum = ReduceAddCoalesced.apply(target_gpus[0], 2, *to_reduce)
+        if self._process_group is not None:
+            sum_, ssum, sum_size = self._all_reduce(sum_, ssum, sum_size)
         mean, inv_std = self._compute_mean_std(sum_, ssum, sum_size)
 
         broadcasted = Broadcast.apply(target_gpus, mean, inv_std)
@@ -110,10 +155,19 @@ class _SynchronizedBatchNorm(_BatchNorm):
 
         return outputs
 
+    def _all_reduce(self, sum_, ssum, size):
+        """Sum the sum, square-sum and size over the process group in a single collective. Every
+        process then computes the same statistics and moving averages."""
+        stats = torch.cat((sum_, ssum, sum_.new_full((1,), size)))
+        stats = _AllReduce.apply(stats, self._process_group)
+        return stats.split((self.num_features, self.num_features, 1))
+
     def _compute_mean_std(self, sum_, ssum, size):
         """Compute the mean and standard-deviation with sum and square-sum. This method
         also maintains the moving average on the master device."""
-        assert size > 1, 'BatchNorm computes unbiased standard-deviation, which requires size > 1.'
+        # The all-reduced size is a tensor, checking it would wait for the device.
+        if not torch.is_tensor(size):
+            assert size > 1, 'BatchNorm computes unbiased standard-deviation, which requires size > 1.'
         mean = sum_ / size
         sumvar = ssum - sum_ * mean
         unbias_var = sumvar / (size - 1)
@@ -125,6 +179,24 @@ class _SynchronizedBatchNorm(_BatchNorm):
         return mean, bias_var.clamp(self.eps) ** -0.5
 
 
+def set_process_group(module, process_group=None):
+    """Synchronize the batch norms of a module across the processes of a torch.distributed group
+    instead of DataParallel replicas, e.g. in a process launched by torchrun.
+
+    :param module: module whose synchronized batch norms are set
+    :param process_group: process group, the default group if None
+    :return: module
+
+    The layers can also be created with a process_group. The state dicts are unchanged.
+    """
+    if process_group is None:
+        process_group = dist.group.WORLD
+    for m in module.modules():
+        if isinstance(m, _SynchronizedBatchNorm):
+            m._process_group = process_group
+    return module
+
+
 class SynchronizedBatchNorm1d(_SynchronizedBatchNorm):
     r"""Applies Synchronized Batch Normalization over a 2d or 3d input that is seen as a
     mini-batch.
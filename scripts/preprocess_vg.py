@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import argparse, json, os
+import argparse, json, multiprocessing, os, re
 from collections import Counter, defaultdict
 
 import numpy as np
@@ -73,6 +73,12 @@ parser.add_argument('--output_vocab_json',
     default=os.path.join(VG_DIR, 'vocab.json'))
 parser.add_argument('--output_h5_dir', default=VG_DIR)
 
+# Streaming mode: the json files are parsed incrementally and the graphs
+# are encoded in a process pool, the output is the same
+parser.add_argument('--streaming', action=argparse.BooleanOptionalAction, default=False)
+parser.add_argument('--num_workers', default=os.cpu_count(), type=int)
+parser.add_argument('--images_per_task', default=1000, type=int)
+
 
 def main(args):
   print('Loading image info from "%s"' % args.images_json)
@@ -508,6 +514,620 @@ def encode_graphs(args, splits, objects, relationships, vocab,
   return numpy_arrays
 
 
+################################################################################
+# Streaming mode
+#
+# Same steps as main, without keeping the json files in memory: each file is
+# parsed one image at a time, the vocabularies are counted in the same order
+# as main does, and only the fields needed to encode the graphs are kept, in
+# numpy arrays. The graphs of each split are then encoded by chunks of images
+# in a process pool and written to HDF5 chunk by chunk, the output is the same.
+################################################################################
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+def iter_json_array(path, chunk_size=1 << 24):
+  """
+  Yields the elements of the json array in path one at a time, reading the
+  file by chunks of chunk_size characters
+  """
+  decoder = json.JSONDecoder()
+  with open(path, 'r') as f:
+    buf, pos = '', 0
+    state = 'start'
+    while True:
+      pos = _WHITESPACE.match(buf, pos).end()
+      if pos == len(buf):
+        chunk = f.read(chunk_size)
+        if not chunk:
+          raise ValueError('Unexpected end of "%s"' % path)
+        buf, pos = buf[pos:] + chunk, 0
+        continue
+
+      char = buf[pos]
+      if state == 'start':
+        if char != '[':
+          raise ValueError('"%s" does not contain a json array' % path)
+        pos += 1
+        state = 'first'
+      elif char == ']' and state in ('first', 'separator'):
+        return
+      elif state == 'separator':
+        if char != ',':
+          raise ValueError('Expected "," in "%s", found "%s"' % (path, char))
+        pos += 1
+        state = 'value'
+      else:
+        try:
+          value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+          value, end = None, None
+        # an element at the end of the buffer may be incomplete
+        if end is None or end == len(buf):
+          chunk = f.read(chunk_size)
+          if chunk:
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+          if end is None:
+            decoder.raw_decode(buf, pos)
+        yield value
+        pos = end
+        state = 'separator'
+
+
+class ArrayBuilder(object):
+  """
+  Appends values to a list, converted to a numpy array every flush_size
+  values, so that long sequences of numbers aren't kept as python objects
+  """
+  def __init__(self, flush_size=1 << 20):
+    self.flush_size = flush_size
+    self.parts = []
+    self.values = []
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def append(self, value):
+    self.values.append(value)
+    self.size += 1
+    if len(self.values) >= self.flush_size:
+      self.flush()
+
+  def flush(self):
+    if self.values:
+      self.parts.append(np.asarray(self.values))
+      self.values = []
+
+  def array(self, empty_shape=(0,)):
+    self.flush()
+    if not self.parts:
+      return np.zeros(empty_shape, dtype=np.int64)
+    return np.concatenate(self.parts)
+
+
+def contains_sorted(sorted_values, values):
+  """ Returns a mask of the values found in the sorted array, and their positions """
+  values = np.asarray(values, dtype=np.int64)
+  positions = np.searchsorted(sorted_values, values)
+  found = positions < len(sorted_values)
+  found[found] = sorted_values[positions[found]] == values[found]
+  return found, positions
+
+
+def stream_objects(args, train_ids, split_ids, aliases):
+  """
+  Counts the object names of the training images, as create_object_vocab,
+  and keeps the objects of the images in the splits
+  """
+  name_counter = Counter()
+  name_to_code = {}
+  image_to_range = {}
+  object_ids, boxes = ArrayBuilder(), ArrayBuilder()
+  names, names_per_object = ArrayBuilder(), ArrayBuilder()
+
+  for image in iter_json_array(args.objects_json):
+    image_id = image['image_id']
+    if image_id in train_ids:
+      for obj in image['objects']:
+        obj_names = set()
+        for name in obj['names']:
+          obj_names.add(aliases.get(name, name))
+        name_counter.update(obj_names)
+
+    if image_id not in split_ids:
+      continue
+
+    start = len(object_ids)
+    for obj in image['objects']:
+      object_ids.append(obj['object_id'])
+      boxes.append([obj['x'], obj['y'], obj['w'], obj['h']])
+      for name in obj['names']:
+        name = aliases.get(name, name)
+        names.append(name_to_code.setdefault(name, len(name_to_code)))
+      names_per_object.append(len(obj['names']))
+    # as in encode_graphs the last entry of an image is used
+    image_to_range[image_id] = (start, len(object_ids))
+
+  return name_counter, {
+    'image_to_range': image_to_range,
+    'object_ids': object_ids.array(),
+    'boxes': boxes.array((0, 4)),
+    'names': names.array(),
+    'names_per_object': names_per_object.array(),
+    'name_to_code': name_to_code,
+  }
+
+
+def make_object_vocab(args, name_counter, vocab):
+  """ create_object_vocab from the counted names """
+  object_names = ['__image__']
+  for name, count in name_counter.most_common():
+    if count >= args.min_object_instances:
+      object_names.append(name)
+  print('Found %d object categories with >= %d training instances' %
+        (len(object_names), args.min_object_instances))
+
+  vocab['object_name_to_idx'] = {name: idx for idx, name in enumerate(object_names)}
+  vocab['object_idx_to_name'] = object_names
+
+
+def filter_object_arrays(args, objects, vocab):
+  """
+  filter_objects on the arrays of stream_objects, the kept objects are
+  returned as arrays sorted by object id instead of object_id_to_obj
+  """
+  # vocab index of every name code, -1 if not in the vocab
+  code_to_idx = np.full(len(objects['name_to_code']), -1, dtype=np.int64)
+  for name, code in objects['name_to_code'].items():
+    code_to_idx[code] = vocab['object_name_to_idx'].get(name, -1)
+
+  # the first name of each object in the vocab
+  name_idx = code_to_idx[objects['names']]
+  offsets = np.concatenate(([0], np.cumsum(objects['names_per_object']))).astype(np.int64)
+  positions = np.where(name_idx >= 0, np.arange(len(name_idx)), len(name_idx))
+  positions = np.append(positions, len(name_idx))
+  first = np.minimum.reduceat(positions, offsets[:-1]) if len(offsets) > 1 else np.zeros(0, dtype=np.int64)
+  has_name = first < offsets[1:]
+  final_name_idx = np.append(name_idx, -1)[first]
+
+  boxes = objects['boxes']
+  too_small = (boxes[:, 2] < args.min_object_size) | (boxes[:, 3] < args.min_object_size)
+  print('Skipped %d objects with size < %d' % (too_small.sum(), args.min_object_size))
+
+  # the last kept occurrence of an object id wins, as in object_id_to_obj
+  kept = np.flatnonzero(has_name & ~too_small)[::-1]
+  kept_ids, last = np.unique(objects['object_ids'][kept], return_index=True)
+  kept = kept[last]
+
+  return {
+    'ids': kept_ids,
+    'name_idx': final_name_idx[kept],
+    'boxes': boxes[kept],
+  }
+
+
+def stream_attributes(args, train_ids, split_ids):
+  """
+  Counts the attributes of the training images, as create_attribute_vocab,
+  and keeps the attributes of the images in the splits
+  """
+  attribute_name_counter = Counter()
+  name_to_code = {}
+  image_to_range = {}
+  object_ids, names, names_per_object = ArrayBuilder(), ArrayBuilder(), ArrayBuilder()
+
+  for image in iter_json_array(args.attributes_json):
+    image_id = image['image_id']
+    if image_id in train_ids:
+      for attribute in image['attributes']:
+        attribute_names = set()
+        try:
+          for name in attribute['attributes']:
+            attribute_names.add(name)
+          attribute_name_counter.update(attribute_names)
+        except KeyError:
+          pass
+
+    if image_id not in split_ids:
+      continue
+
+    start = len(object_ids)
+    for obj_attribute in image['attributes']:
+      # missing and empty attributes are encoded in the same way
+      attributes = obj_attribute.get('attributes', None) or []
+      object_ids.append(obj_attribute['object_id'])
+      for name in attributes:
+        names.append(name_to_code.setdefault(name, len(name_to_code)))
+      names_per_object.append(len(attributes))
+    image_to_range[image_id] = (start, len(object_ids))
+
+  return attribute_name_counter, {
+    'image_to_range': image_to_range,
+    'object_ids': object_ids.array(),
+    'names': names.array(),
+    'offsets': np.concatenate(([0], np.cumsum(names_per_object.array()))).astype(np.int64),
+    'name_to_code': name_to_code,
+  }
+
+
+def make_attribute_vocab(args, attribute_name_counter, vocab):
+  """ create_attribute_vocab from the counted attributes """
+  attribute_names = []
+  for name, count in attribute_name_counter.most_common():
+    if count >= args.min_attribute_instances:
+      attribute_names.append(name)
+  print('Found %d attribute categories with >= %d training instances' %
+        (len(attribute_names), args.min_attribute_instances))
+
+  vocab['attribute_name_to_idx'] = {name: idx for idx, name in enumerate(attribute_names)}
+  vocab['attribute_idx_to_name'] = attribute_names
+
+
+def stream_relationships(args, train_ids, split_ids, kept_objects, rel_aliases):
+  """
+  Counts the predicates of the training images, as create_rel_vocab, and
+  keeps the relationships of the images in the splits. As in main, only
+  the predicates counted for the vocab are normalized.
+  """
+  pred_counter = defaultdict(int)
+  pred_to_code = {}
+  image_to_range = {}
+  rel_ids, subjects, objects, preds = ArrayBuilder(), ArrayBuilder(), ArrayBuilder(), ArrayBuilder()
+
+  for image in iter_json_array(args.relationships_json):
+    image_id = image['image_id']
+    if image_id not in split_ids:
+      continue
+
+    rels = image['relationships']
+    found_subjects, _ = contains_sorted(kept_objects['ids'], [rel['subject']['object_id'] for rel in rels])
+    found_objects, _ = contains_sorted(kept_objects['ids'], [rel['object']['object_id'] for rel in rels])
+    count = image_id in train_ids
+
+    start = len(rel_ids)
+    for rel, found in zip(rels, (found_subjects & found_objects).tolist()):
+      pred = rel['predicate']
+      if count and found:
+        pred = pred.lower().strip()
+        pred = rel_aliases.get(pred, pred)
+        pred_counter[pred] += 1
+      rel_ids.append(rel['relationship_id'])
+      subjects.append(rel['subject']['object_id'])
+      objects.append(rel['object']['object_id'])
+      preds.append(pred_to_code.setdefault(pred, len(pred_to_code)))
+    image_to_range[image_id] = (start, len(rel_ids))
+
+  return pred_counter, {
+    'image_to_range': image_to_range,
+    'ids': rel_ids.array(),
+    'subjects': subjects.array(),
+    'objects': objects.array(),
+    'preds': preds.array(),
+    'pred_to_code': pred_to_code,
+  }
+
+
+def make_rel_vocab(args, pred_counter, vocab):
+  """ create_rel_vocab from the counted predicates """
+  pred_names = ['__in_image__']
+  for pred, count in pred_counter.items():
+    if count >= args.min_relationship_instances:
+      pred_names.append(pred)
+  print('Found %d relationship types with >= %d training instances'
+        % (len(pred_names), args.min_relationship_instances))
+
+  vocab['pred_name_to_idx'] = {name: idx for idx, name in enumerate(pred_names)}
+  vocab['pred_idx_to_name'] = pred_names
+
+
+def code_to_idx(name_to_code, name_to_idx):
+  """ Vocab index of every code of name_to_code, -1 if not in the vocab """
+  lookup = np.full(len(name_to_code), -1, dtype=np.int64)
+  for name, code in name_to_code.items():
+    lookup[code] = name_to_idx.get(name, -1)
+  return lookup
+
+
+# arrays needed by encode_images, set before the pool is forked
+_encode_state = {}
+
+
+def encode_images(image_ids):
+  """
+  encode_graphs for a chunk of the images of a split, returns the arrays of
+  the kept images and the skip stats
+  """
+  args = _encode_state['args']
+  kept, objects = _encode_state['kept_objects'], _encode_state['objects']
+  rels, attrs = _encode_state['relationships'], _encode_state['attributes']
+  pred_idx, attribute_idx = _encode_state['pred_idx'], _encode_state['attribute_idx']
+
+  skip_stats = defaultdict(int)
+  arrays = defaultdict(list)
+  object_attributes = []
+
+  for image_id in image_ids:
+    start, end = objects['image_to_range'][image_id]
+    object_ids = objects['object_ids'][start:end]
+    found, positions = contains_sorted(kept['ids'], object_ids)
+
+    image_object_ids = []
+    image_object_names = []
+    image_object_boxes = []
+    object_id_to_idx = {}
+    for object_id, is_kept, position in zip(object_ids.tolist(), found.tolist(), positions.tolist()):
+      if not is_kept:
+        continue
+      object_id_to_idx[object_id] = len(image_object_ids)
+      image_object_ids.append(object_id)
+      image_object_names.append(int(kept['name_idx'][position]))
+      image_object_boxes.append(kept['boxes'][position].tolist())
+    num_objects = len(image_object_ids)
+    if num_objects < args.min_objects_per_image:
+      skip_stats['too_few_objects'] += 1
+      continue
+    if num_objects > args.max_objects_per_image:
+      skip_stats['too_many_objects'] += 1
+      continue
+
+    image_rel_ids = []
+    image_rel_subs = []
+    image_rel_preds = []
+    image_rel_objs = []
+    start, end = rels['image_to_range'][image_id]
+    for relationship_id, code, sid, oid in zip(rels['ids'][start:end].tolist(), rels['preds'][start:end].tolist(),
+                                               rels['subjects'][start:end].tolist(),
+                                               rels['objects'][start:end].tolist()):
+      if pred_idx[code] < 0:
+        continue
+      sidx = object_id_to_idx.get(sid, None)
+      oidx = object_id_to_idx.get(oid, None)
+      if sidx is None or oidx is None:
+        continue
+      image_rel_ids.append(relationship_id)
+      image_rel_subs.append(sidx)
+      image_rel_preds.append(int(pred_idx[code]))
+      image_rel_objs.append(oidx)
+    num_relationships = len(image_rel_ids)
+    if num_relationships < args.min_relationships_per_image:
+      skip_stats['too_few_relationships'] += 1
+      continue
+    if num_relationships > args.max_relationships_per_image:
+      skip_stats['too_many_relationships'] += 1
+      continue
+
+    # the last attributes of an object win
+    obj_id_to_attributes = {}
+    start, end = attrs['image_to_range'][image_id]
+    for i, object_id in enumerate(attrs['object_ids'][start:end].tolist(), start):
+      obj_id_to_attributes[object_id] = attrs['names'][attrs['offsets'][i]:attrs['offsets'][i + 1]]
+    num_attributes = []
+    for object_id in image_object_ids:
+      attribute_ids = []
+      for idx in attribute_idx[obj_id_to_attributes.get(object_id, [])].tolist():
+        if idx >= 0:
+          attribute_ids.append(idx)
+        if len(attribute_ids) >= args.max_attributes_per_image:
+          break
+      num_attributes.append(len(attribute_ids))
+      object_attributes.append(attribute_ids + [-1] * (args.max_attributes_per_image - len(attribute_ids)))
+
+    # Pad object info out to max_objects_per_image
+    pad_len = args.max_objects_per_image - num_objects
+    image_object_ids += [-1] * pad_len
+    image_object_names += [-1] * pad_len
+    image_object_boxes += [[-1, -1, -1, -1]] * pad_len
+    num_attributes += [-1] * pad_len
+
+    # Pad relationship info out to max_relationships_per_image
+    pad_len = args.max_relationships_per_image - num_relationships
+    image_rel_ids += [-1] * pad_len
+    image_rel_subs += [-1] * pad_len
+    image_rel_preds += [-1] * pad_len
+    image_rel_objs += [-1] * pad_len
+
+    arrays['image_ids'].append(image_id)
+    arrays['object_ids'].append(image_object_ids)
+    arrays['object_names'].append(image_object_names)
+    arrays['object_boxes'].append(image_object_boxes)
+    arrays['objects_per_image'].append(num_objects)
+    arrays['relationship_ids'].append(image_rel_ids)
+    arrays['relationship_subjects'].append(image_rel_subs)
+    arrays['relationship_predicates'].append(image_rel_preds)
+    arrays['relationship_objects'].append(image_rel_objs)
+    arrays['relationships_per_image'].append(num_relationships)
+    arrays['attributes_per_object'].append(num_attributes)
+  arrays['object_attributes'] = object_attributes
+
+  # every array, even if all the images of the chunk are skipped
+  encoded = empty_arrays(args)
+  encoded.update((name, np.asarray(values)) for name, values in arrays.items() if len(values) > 0)
+  return encoded, dict(skip_stats)
+
+
+ARRAY_NAMES = [
+  'image_ids', 'object_ids', 'object_names', 'object_boxes', 'objects_per_image',
+  'relationship_ids', 'relationship_subjects', 'relationship_predicates',
+  'relationship_objects', 'relationships_per_image', 'attributes_per_object',
+  'object_attributes',
+]
+
+
+def empty_arrays(args):
+  """ Arrays of encode_images without any image, with the shapes of their rows """
+  O, R = args.max_objects_per_image, args.max_relationships_per_image
+  shapes = {
+    'image_ids': (0,), 'object_ids': (0, O), 'object_names': (0, O), 'object_boxes': (0, O, 4),
+    'objects_per_image': (0,), 'relationship_ids': (0, R), 'relationship_subjects': (0, R),
+    'relationship_predicates': (0, R), 'relationship_objects': (0, R), 'relationships_per_image': (0,),
+    'attributes_per_object': (0, O), 'object_attributes': (0, args.max_attributes_per_image),
+  }
+  return {name: np.zeros(shapes[name], dtype=np.int64) for name in ARRAY_NAMES}
+
+
+class H5ChunkWriter(object):
+  """
+  Writes the HDF5 file of a split from the arrays of encode_images, as main
+  writes the arrays of encode_graphs. Each chunk is appended to resizable
+  datasets of a temporary file as soon as it is encoded, so only one chunk
+  is in memory. The temporary file is then repacked, a block of rows at a
+  time, into contiguous datasets created in the order of main, so the file
+  is the same as main's, and its arrays can be memory-mapped by
+  data/vg.py.
+  """
+  def __init__(self, h5_path, image_id_to_image, copy_rows=1 << 16):
+    self.h5_path = h5_path
+    self.tmp_path = h5_path + '.tmp'
+    self.tmp_file = h5py.File(self.tmp_path, 'w')
+    self.image_id_to_image = image_id_to_image
+    self.copy_rows = copy_rows
+
+  def _append(self, name, ary, dtype=None):
+    if name not in self.tmp_file:
+      dtype = dtype or ary.dtype
+      self.tmp_file.create_dataset(name, (0,) + ary.shape[1:], dtype=dtype, maxshape=(None,) + ary.shape[1:])
+    dset = self.tmp_file[name]
+    start = len(dset)
+    dset.resize(start + len(ary), axis=0)
+    dset[start:] = ary
+
+  def write(self, arrays):
+    for name in ARRAY_NAMES:
+      ary = arrays[name]
+      if len(ary) == 0:
+        continue
+      if ary.dtype == np.int64:
+        ary = ary.astype(np.int32)
+      self._append(name, ary)
+    if len(arrays['image_ids']) > 0:
+      image_paths = get_image_paths(self.image_id_to_image, arrays['image_ids'].tolist())
+      self._append('image_paths', np.asarray(image_paths, dtype=object), h5py.special_dtype(vlen=str))
+
+  def close(self):
+    try:
+      self._repack()
+    finally:
+      self.tmp_file.close()
+      os.remove(self.tmp_path)
+
+  def _repack(self):
+    print('Writing file "%s"' % self.h5_path)
+    with h5py.File(self.h5_path, 'w') as h5_file:
+      for name in ARRAY_NAMES:
+        if name not in self.tmp_file:
+          # as np.asarray([]) in encode_graphs
+          ary = np.asarray([])
+          print('Creating datset: ', name, ary.shape, ary.dtype)
+          h5_file.create_dataset(name, data=ary)
+          continue
+        part = self.tmp_file[name]
+        print('Creating datset: ', name, part.shape, part.dtype)
+        dset = h5_file.create_dataset(name, part.shape, dtype=part.dtype)
+        for start in range(0, len(part), self.copy_rows):
+          dset[start:start + self.copy_rows] = part[start:start + self.copy_rows]
+
+      # one path at a time, as main writes them
+      print('Writing image paths')
+      paths = self.tmp_file['image_paths'].asstr() if 'image_paths' in self.tmp_file else []
+      path_dtype = h5py.special_dtype(vlen=str)
+      path_dset = h5_file.create_dataset('image_paths', (len(paths),), dtype=path_dtype)
+      for start in range(0, len(paths), self.copy_rows):
+        for i, p in enumerate(paths[start:start + self.copy_rows], start):
+          path_dset[i] = p
+    print()
+
+
+def main_streaming(args):
+  print('Loading image info from "%s"' % args.images_json)
+  image_id_to_image = {i['image_id']: i for i in iter_json_array(args.images_json)}
+
+  with open(args.splits_json, 'r') as f:
+    splits = json.load(f)
+
+  # Filter images for being too small
+  splits = remove_small_images(args, image_id_to_image, splits)
+
+  obj_aliases = load_aliases(args.object_aliases)
+  rel_aliases = load_aliases(args.relationship_aliases)
+
+  train_ids = set(splits[args.train_split])
+  split_ids = set()
+  for image_ids in splits.values():
+    split_ids |= set(image_ids)
+
+  # Vocab for objects and relationships
+  vocab = {}
+  print('Streaming objects from "%s"' % args.objects_json)
+  print('Making object vocab from %d training images' % len(train_ids))
+  name_counter, objects = stream_objects(args, train_ids, split_ids, obj_aliases)
+  make_object_vocab(args, name_counter, vocab)
+
+  # Vocab for attributes
+  print('Streaming attributes from "%s"' % args.attributes_json)
+  print('Making attribute vocab from %d training images' % len(train_ids))
+  attribute_name_counter, attributes = stream_attributes(args, train_ids, split_ids)
+  make_attribute_vocab(args, attribute_name_counter, vocab)
+
+  kept_objects = filter_object_arrays(args, objects, vocab)
+  print('After filtering there are %d object instances'
+        % len(kept_objects['ids']))
+
+  print('Streaming relationships from "%s"' % args.relationships_json)
+  pred_counter, relationships = stream_relationships(args, train_ids, split_ids, kept_objects, rel_aliases)
+  make_rel_vocab(args, pred_counter, vocab)
+
+  _encode_state.update({
+    'args': args,
+    'objects': objects,
+    'kept_objects': kept_objects,
+    'relationships': relationships,
+    'attributes': attributes,
+    'pred_idx': code_to_idx(relationships['pred_to_code'], vocab['pred_name_to_idx']),
+    'attribute_idx': code_to_idx(attributes['name_to_code'], vocab['attribute_name_to_idx']),
+  })
+
+  print('Encoding objects and relationships with %d workers ...' % args.num_workers)
+  # the workers are forked after _encode_state is set and inherit the arrays
+  pool = None
+  if args.num_workers > 1:
+    pool = multiprocessing.get_context('fork').Pool(args.num_workers)
+
+  try:
+    for split_name, image_ids in splits.items():
+      tasks = [image_ids[i:i + args.images_per_task]
+               for i in range(0, len(image_ids), args.images_per_task)]
+      results = pool.imap(encode_images, tasks) if pool is not None else map(encode_images, tasks)
+
+      writer = H5ChunkWriter(os.path.join(args.output_h5_dir, '%s.h5' % split_name), image_id_to_image)
+      skip_stats = defaultdict(int)
+      try:
+        for arrays, chunk_stats in results:
+          writer.write(arrays)
+          for stat, count in chunk_stats.items():
+            skip_stats[stat] += count
+      finally:
+        writer.close()
+
+      print('Skip stats for split "%s"' % split_name)
+      for stat, count in skip_stats.items():
+        print(stat, count)
+      print()
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  print('Writing vocab to "%s"' % args.output_vocab_json)
+  with open(args.output_vocab_json, 'w') as f:
+    json.dump(vocab, f)
+
+
 if __name__ == '__main__':
   args = parser.parse_args()
-  main(args)
+  if args.streaming:
+    main_streaming(args)
+  else:
+    main(args)
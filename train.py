@@ -14,9 +14,17 @@ from data.cocostuff_loader import *
 from data.vg import *
 from model.resnet_generator_v2 import *
 from model.rcnn_discriminator import *
-from model.sync_batchnorm import DataParallelWithCallback
+from model.sync_batchnorm import DataParallelWithCallback, set_process_group
 from utils.logger import setup_logger
+from utils.metrics import MetricsAccumulator, StdoutSink, WandbSink, file_sink
+from utils.checkpoint import CheckpointWriter, get_rng_states, latest_checkpoint, load_checkpoint, set_rng_states
+from utils.amp import PRECISIONS, autocast, float32_spectral_norm, grad_scaler
+from utils.training_step import TrainingStep
+from utils.distributed import broadcast_module, init_distributed
 from data.datasets import get_dataset, get_num_classes_and_objects
+from data.batching import ResumableSampler, get_batch_loader
+from data.image_decode import DECODE_BACKENDS
+from data.vgg_cache import CachedFeatureBatches, VGGFeatureCache
 import utils.depth as udpt
 import wandb
 
@@ -29,9 +37,21 @@ def main(args):
     lamb_img = 0.1
     num_classes, num_obj = get_num_classes_and_objects(args.dataset)
 
+    # one process per GPU launched by torchrun, each training on its part
+    # of the batch, rank 0 logs and saves, see utils/distributed.py
+    rank, local_rank, world_size = 0, 0, 1
+    if args.distributed:
+        rank, local_rank, world_size = init_distributed(
+            timeout=datetime.timedelta(minutes=args.distributed_timeout))
+        if args.batch_size % world_size != 0:
+            raise ValueError(f'batch_size {args.batch_size} is not divisible by the {world_size} processes')
+        # different latents in each process
+        torch.manual_seed(torch.initial_seed() + rank)
+    batch_size = args.batch_size // world_size
+
     # depth layouts / maps to visualize
     disp_depth = 6
-    disp_depth = disp_depth if disp_depth < args.batch_size else args.batch_size
+    disp_depth = disp_depth if disp_depth < batch_size else batch_size
 
     # output directory
     args.out_path = os.path.join(
@@ -51,7 +71,7 @@ def main(args):
             'lamb_obj': lamb_obj,
             'lamb_img': lamb_img
         },
-        mode='disabled' if args.dw else None
+        mode='disabled' if args.dw or rank != 0 else None
     )
     wandb.config.update(args)
 
@@ -61,18 +81,53 @@ def main(args):
     # data loader
     train_data = get_dataset(args.dataset, img_size, mode='train',
                              num_obj=num_obj,
-                             return_depth=args.use_depth)
+                             return_depth=args.use_depth,
+                             image_shards_dir=os.path.join(args.shards_path, 'train') if args.shards_path else None,
+                             depth_pack_dir=os.path.join(args.depth_pack_path, 'train') if args.depth_pack_path else None,
+                             decode_backend=args.decode_backend)
 
     val_data = get_dataset(args.dataset, img_size, mode='val',
                            num_obj=num_obj,
-                           return_depth=args.use_depth)
-
-    dataloader = torch.utils.data.DataLoader(
-        train_data, batch_size=args.batch_size,
-        drop_last=True, shuffle=True, num_workers=8)
+                           return_depth=args.use_depth,
+                           image_shards_dir=os.path.join(args.shards_path, 'val') if args.shards_path else None,
+                           depth_pack_dir=os.path.join(args.depth_pack_path, 'val') if args.depth_pack_path else None,
+                           decode_backend=args.decode_backend)
+
+    # VGG features of the real images, computed in the first epoch and
+    # read with the batches afterwards, see data/vgg_cache.py
+    vgg_cache = None
+    if args.vgg_cache_dir:
+        # created by rank 0 and reopened by the other processes, which
+        # write the features of their own samples
+        if rank != 0:
+            torch.distributed.barrier()
+        vgg_cache = VGGFeatureCache(
+            args.vgg_cache_dir, len(train_data), (img_size, img_size),
+            max_bytes=int(args.vgg_cache_gb * 2**30) if args.vgg_cache_gb else None,
+            meta={'dataset': args.dataset, 'decode_backend': args.decode_backend,
+                  'image_shards': bool(args.shards_path)})
+        if rank == 0 and args.distributed:
+            torch.distributed.barrier()
+
+    # the order of the samples only depends on the seed and the epoch, so
+    # training can resume in the middle of an epoch, see data/batching.py
+    sampler = ResumableSampler(len(train_data), seed=args.seed, num_replicas=world_size, rank=rank)
+
+    # whole batches are built by the dataset, see data/batching.py
+    dataloader = get_batch_loader(
+        train_data if vgg_cache is None else CachedFeatureBatches(train_data, vgg_cache),
+        batch_size=batch_size,
+        drop_last=True, sampler=sampler, num_workers=8,
+        # the workers' seeds are drawn from their own generator, so that
+        # creating the iterator doesn't change the restored global RNG state
+        generator=torch.Generator().manual_seed(args.seed + rank))
+
+    # position to start training from
+    start_epoch, start_iteration = 0, 0
 
     # log fake images and loss every n iterations, about 10 times per epoch
-    log_every = floor(len(dataloader)/10)
+    iterations_per_epoch = len(dataloader)
+    log_every = floor(iterations_per_epoch/10)
 
     # validate and log metrics every n epochs
     val_every = 3
@@ -86,8 +141,21 @@ def main(args):
         netG = ResnetGenerator128(num_classes=num_classes, output_dim=3).cuda()
         netD = CombineDiscriminator128(num_classes=num_classes).cuda()
 
-    parallel = True
-    if parallel:
+    if args.precision != 'fp32':
+        # spectral norm power iterations out of autocast, see utils/amp.py
+        float32_spectral_norm(netG)
+        float32_spectral_norm(netD)
+
+    if args.distributed:
+        # same initialization in all the processes, batch norm statistics
+        # all-reduced across them, gradients averaged by the training step;
+        # the single device wrappers keep the state dict keys of DataParallel
+        broadcast_module(netG)
+        broadcast_module(netD)
+        set_process_group(netG)
+        netG = DataParallelWithCallback(netG, device_ids=[local_rank])
+        netD = nn.DataParallel(netD, device_ids=[local_rank])
+    else:
         netG = DataParallelWithCallback(netG)
         netD = nn.DataParallel(netD)
 
@@ -115,26 +183,105 @@ def main(args):
     # discriminator optimizer
     d_optimizer = torch.optim.Adam(dis_parameters, betas=(0, 0.999))
 
+    # loss scaling of the fp16 backward passes, disabled otherwise
+    g_scaler, d_scaler = grad_scaler(args.precision), grad_scaler(args.precision)
+
     # make dirs
-    if not os.path.exists(args.out_path):
+    if rank == 0 and not os.path.exists(args.out_path):
         os.mkdir(args.out_path)
-    if not os.path.exists(os.path.join(args.out_path, 'model/')):
+    if rank == 0 and not os.path.exists(os.path.join(args.out_path, 'model/')):
         os.mkdir(os.path.join(args.out_path, 'model/'))
 
-    logger = setup_logger("lostGAN", args.out_path, 0)
+    logger = setup_logger("lostGAN", args.out_path, rank)
     logger.info(netG)
     logger.info(netD)
+    if vgg_cache is not None:
+        logger.info("Caching {} VGG slices in {}".format(vgg_cache.num_slices, args.vgg_cache_dir))
+
+    def rng_states():
+        # the processes draw different latents, each one resumes from its own states
+        if not args.distributed:
+            return get_rng_states()
+        states = [None] * world_size
+        torch.distributed.all_gather_object(states, get_rng_states())
+        return states
+
+    def training_state(epoch, iteration):
+        # everything needed to resume training at the given iteration of an
+        # epoch, sync batchnorm running stats are buffers of the state dicts
+        return {
+            'epoch': epoch,
+            'iteration': iteration,
+            'netG': netG.state_dict(),
+            'netD': netD.state_dict(),
+            'g_optimizer': g_optimizer.state_dict(),
+            'd_optimizer': d_optimizer.state_dict(),
+            'g_scaler': g_scaler.state_dict(),
+            'd_scaler': d_scaler.state_dict(),
+            'sampler': sampler.state_dict(iteration * batch_size, epoch),
+            'rng': rng_states()
+        }
+
+    # losses are aggregated on the device and written in the background
+    metrics_file = args.metrics_file or os.path.join(args.out_path, 'metrics.jsonl')
+    metrics = MetricsAccumulator([WandbSink(), file_sink(metrics_file), StdoutSink()] if rank == 0 else [],
+                                 flush_every=args.metrics_every)
+
+    # full training state, written in the background by rank 0
+    checkpoint_dir = os.path.join(args.out_path, 'checkpoints')
+    checkpoints = CheckpointWriter(checkpoint_dir, keep_last=args.keep_checkpoints) if rank == 0 else None
+
+    def save_training_state(epoch, iteration):
+        # all the processes gather their RNG states, rank 0 saves them
+        state = training_state(epoch, iteration)
+        if checkpoints is not None:
+            checkpoints.save(epoch, iteration, state)
+
+    if args.resume:
+        checkpoint_path = latest_checkpoint(checkpoint_dir)
+        if checkpoint_path is None:
+            logger.info("No checkpoint in {}, training from scratch".format(checkpoint_dir))
+        else:
+            logger.info("Resuming from {}".format(checkpoint_path))
+            state = load_checkpoint(checkpoint_path)
+            netG.load_state_dict(state['netG'])
+            netD.load_state_dict(state['netD'])
+            g_optimizer.load_state_dict(state['g_optimizer'])
+            d_optimizer.load_state_dict(state['d_optimizer'])
+            g_scaler.load_state_dict(state['g_scaler'])
+            d_scaler.load_state_dict(state['d_scaler'])
+            sampler.load_state_dict(state['sampler'])
+            set_rng_states(state['rng'][rank] if isinstance(state['rng'], list) else state['rng'])
+            start_epoch, start_iteration = state['epoch'], state['iteration']
+            del state
 
     start_time = time.time()
-    vgg_loss = VGGLoss()
-    vgg_loss = nn.DataParallel(vgg_loss)
-    l1_loss = nn.DataParallel(nn.L1Loss())
+    # persistent VGG copies on every GPU, see utils/util.py
+    if args.distributed:
+        vgg_loss = VGGLoss(device_ids=[local_rank], fuse=args.fuse_vgg)
+        l1_loss = nn.L1Loss()
+    else:
+        vgg_loss = VGGLoss(fuse=args.fuse_vgg)
+        l1_loss = nn.DataParallel(nn.L1Loss())
+
+    training_step = TrainingStep(netG, netD, g_optimizer, d_optimizer, vgg_loss, l1_loss,
+                                 lamb_obj=lamb_obj, lamb_img=lamb_img, precision=args.precision,
+                                 g_scaler=g_scaler, d_scaler=d_scaler, g_every=args.g_every,
+                                 distributed=args.distributed)
 
-    for epoch in range(args.total_epoch):
+    # last losses of the D and G steps, for the periodic log
+    losses = {}
+
+    for epoch in range(start_epoch, args.total_epoch):
         netG.train()
         netD.train()
 
-        for idx, data in enumerate(dataloader):
+        # skip the batches already used in this epoch
+        sampler.set_epoch(epoch, start_iteration * batch_size)
+
+        for idx, data in enumerate(dataloader, start_iteration):
+            if vgg_cache is not None:
+                data, sample_indices, real_features = data
 
             if args.use_depth:
                 real_images, label, bbox, depths = data
@@ -145,89 +292,52 @@ def main(args):
             real_images, label, bbox = real_images.cuda(
             ), label.long().cuda().unsqueeze(-1), bbox.float()
 
-            # update D network
-            netD.zero_grad()
-            real_images, label = real_images.cuda(), label.long().cuda()
-            d_out_real, d_out_robj = netD(real_images, bbox, label)
-            d_loss_real = torch.nn.ReLU()(1.0 - d_out_real).mean()
-            d_loss_robj = torch.nn.ReLU()(1.0 - d_out_robj).mean()
-
             # z_obj, random latent object appearance
             z = torch.randn(real_images.size(0), num_obj, z_dim).cuda()
 
-            if args.use_depth:
-                fake_images = netG(
-                    z, bbox, y=label.squeeze(dim=-1), depths=depths)
-            else:
-                fake_images = netG(z, bbox, y=label.squeeze(dim=-1))
-
-            d_out_fake, d_out_fobj = netD(fake_images.detach(), bbox, label)
-            d_loss_fake = torch.nn.ReLU()(1.0 + d_out_fake).mean()
-            d_loss_fobj = torch.nn.ReLU()(1.0 + d_out_fobj).mean()
-
-            d_loss = lamb_obj * (d_loss_robj + d_loss_fobj) + \
-                lamb_img * (d_loss_real + d_loss_fake)
-            d_loss.backward()
-            d_optimizer.step()
-
-            # print and log losses
-            wandb.log({
-                "epoch": epoch+1,
-                "d_loss": d_loss.item(),
-                "d_loss_real": d_loss_real.item(),
-                "d_loss_fake": d_loss_fake.item(),
-                "d_loss_robj": d_loss_robj.item(),
-                "d_loss_fobj": d_loss_fobj.item()
-            })
-
-            print(f"Epoch: {epoch+1}, d_loss: {d_loss}")
-
-            # update G network
-            if (idx % 1) == 0:
-                netG.zero_grad()
-                g_out_fake, g_out_obj = netD(fake_images, bbox, label)
-                g_loss_fake = - g_out_fake.mean()
-                g_loss_obj = - g_out_obj.mean()
-
-                pixel_loss = l1_loss(fake_images, real_images).mean()
-                feat_loss = vgg_loss(fake_images, real_images).mean()
-
-                g_loss = g_loss_obj * lamb_obj + g_loss_fake * lamb_img + pixel_loss + feat_loss
-                g_loss.backward()
-                g_optimizer.step()
-
-                # print and log losses
-                wandb.log({
-                    "epoch": epoch+1,
-                    "g_loss_fake": g_loss_fake.item(),
-                    "g_loss_obj": g_loss_obj.item(),
-                    "g_loss": g_loss.item(),
-                    "pixel_loss": pixel_loss.item(),
-                    "feat_loss": feat_loss.item(),
-                    "g_lr": g_optimizer.param_groups[0]['lr'],
-                    "d_lr": d_optimizer.param_groups[0]['lr']
-                })
-
-                print(f"Epoch: {epoch+1}, g_loss: {g_loss}")
-
-            if (idx+1) % log_every == 0:
+            if vgg_cache is not None and real_features is None:
+                # not cached yet, the features are stored for the next epochs
+                with autocast(args.precision):
+                    real_features = vgg_loss.real_features(real_images)
+                vgg_cache.put(sample_indices.numpy(), real_features)
+            elif vgg_cache is not None:
+                real_features = [f.cuda(non_blocking=True) for f in real_features]
+
+            # D step and, every args.g_every iterations, G step
+            step = epoch * iterations_per_epoch + idx
+            d_losses, g_losses, fake_images = training_step(
+                step, real_images, label, bbox, z,
+                depths=depths if args.use_depth else None,
+                real_features=real_features if vgg_cache is not None else None)
+            losses.update(d_losses)
+
+            # accumulate losses, logged every args.metrics_every steps
+            metrics.add(step, epoch=epoch+1, **d_losses)
+            if g_losses is not None:
+                losses.update(g_losses)
+                metrics.add(step,
+                            g_lr=g_optimizer.param_groups[0]['lr'],
+                            d_lr=d_optimizer.param_groups[0]['lr'],
+                            **g_losses)
+
+            if (idx+1) % log_every == 0 and rank == 0:
                 elapsed = time.time() - start_time
                 elapsed = str(datetime.timedelta(seconds=elapsed))
                 logger.info("Time Elapsed: [{}]".format(elapsed))
                 logger.info("Step[{}/{}], d_out_real: {:.4f}, d_out_fake: {:.4f}, g_out_fake: {:.4f} ".format(
                     epoch + 1,
                     idx + 1,
-                    d_loss_real.item(),
-                    d_loss_fake.item(),
-                    g_loss_fake.item())
+                    losses['d_loss_real'].item(),
+                    losses['d_loss_fake'].item(),
+                    losses['g_loss_fake'].item())
                 )
                 logger.info("             d_obj_real: {:.4f}, d_obj_fake: {:.4f}, g_obj_fake: {:.4f} ".format(
-                    d_loss_robj.item(),
-                    d_loss_fobj.item(),
-                    g_loss_obj.item())
+                    losses['d_loss_robj'].item(),
+                    losses['d_loss_fobj'].item(),
+                    losses['g_loss_obj'].item())
                 )
                 logger.info("             pixel_loss: {:.4f}, feat_loss: {:.4f}".format(
-                    pixel_loss.item(), feat_loss.item())
+                    losses['pixel_loss'].item(), losses['feat_loss'].item())
                 )
 
                 # log image ranges
@@ -245,7 +355,7 @@ def main(args):
                 # all images are in [-1,1]
                 # normalize to [0,1] for visualization
                 real_grid = make_grid(((real_images + 1) / 2).cpu(), nrow=4)
-                fake_grid = make_grid(((fake_images + 1) / 2).cpu(), nrow=4)
+                fake_grid = make_grid(((fake_images.float() + 1) / 2).cpu(), nrow=4)
 
                 wandb.log({
                     "real_images": wandb.Image(real_grid),
@@ -255,10 +365,17 @@ def main(args):
                 if args.use_depth:
                     depth_results = []
 
+                    # boxes with xmax and ymax for the displayed images
+                    coord_boxes = scale_boxes(
+                        bbox[:disp_depth], train_data.image_size, 'coordinates', dtype=torch.int)
+
+                    # depth layouts of the displayed images
+                    depth_layouts = udpt.get_depth_layouts(
+                        depths[:disp_depth], train_data.image_size, bbox[:disp_depth]).cpu()
+
                     # visualize the first disp_depth images and their depth layouts
                     for jdx in range(disp_depth):
-                        coord_box = scale_boxes(
-                            bbox[jdx], train_data.image_size, 'coordinates', dtype=torch.int)
+                        coord_box = coord_boxes[jdx]
 
                         # normalize form [-1,1] to [0,255]
                         ann_img = (
@@ -266,18 +383,16 @@ def main(args):
                         # draw boxes
                         ann_img = draw_bounding_boxes(ann_img, coord_box)
 
-                        # get depth layout
-                        depth_layout = udpt.get_depth_layout(
-                            depths[jdx], train_data.image_size, bbox[jdx]).unsqueeze(0)
+                        depth_layout = depth_layouts[jdx].unsqueeze(0)
 
                         depth_results.extend([
                             # normalize from [0,255] to [0,1]
                             ann_img.type(torch.float32) / 255,
                             # already in [0,1]
                             torch.cat((depth_layout, depth_layout,
-                                       depth_layout), 0).cpu(),
+                                       depth_layout), 0),
                             # from [-1,1] to [0,1]
-                            ((fake_images[jdx] + 1) / 2).cpu()
+                            ((fake_images[jdx].float() + 1) / 2).cpu()
                         ])
 
                     depth_grid = make_grid(depth_results, nrow=3)
@@ -286,7 +401,10 @@ def main(args):
                         "depth_results": wandb.Image(depth_grid)
                     })
 
-        if epoch % val_every == 0 or epoch == args.total_epoch - 1:
+            if (idx+1) % args.checkpoint_every == 0:
+                save_training_state(epoch, idx+1)
+
+        if rank == 0 and (epoch % val_every == 0 or epoch == args.total_epoch - 1):
             # compute metrics on validation set
             sample_test(netG, val_data, num_obj, sample_path)
             
@@ -300,12 +418,25 @@ def main(args):
             print(metrics_dict)
             wandb.log(metrics_dict)
 
+        if args.distributed:
+            # the other processes wait for the validation of rank 0
+            torch.distributed.barrier()
+
+        start_iteration = 0
+
         # save model
-        if (epoch + 1) % 5 == 0:
+        if rank == 0 and (epoch + 1) % 5 == 0:
             torch.save(netG.state_dict(), os.path.join(
                 args.out_path, 'model/', 'G_%d.pth' % (epoch+1)))
 
+        save_training_state(epoch+1, 0)
+
+    metrics.close()
+    if checkpoints is not None:
+        checkpoints.close()
     wandb.finish()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
 
 
 if __name__ == "__main__":
@@ -323,11 +454,45 @@ if __name__ == "__main__":
     parser.add_argument('--out_path', type=str, default='./outputs/',
                         help='path to output files')
     parser.add_argument('--use_depth', action=argparse.BooleanOptionalAction,
-                        default=False, help='use depth information')
+                        default=False, help='use depth information, build the box depth table of each split '
+                             'first with python -m utils.depth --box_depths --mode <split> to skip loading the depthmaps')
     parser.add_argument('--model', type=str, default='baseline',
                         help='short model name, it will also be used as run name')
     parser.add_argument('--dw', action=argparse.BooleanOptionalAction,
                         default=False, help='disable wandb, defaults to False')
+    parser.add_argument('--shards_path', type=str, default=None,
+                        help='directory with train/ and val/ packed image shards (coco only), see data/image_shards.py')
+    parser.add_argument('--depth_pack_path', type=str, default=None,
+                        help='directory with train/ and val/ depth packs (coco only), see data/depth_pack.py')
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=False,
+                        help='resume training from the latest checkpoint in the output directory')
+    parser.add_argument('--checkpoint_every', type=int, default=1000,
+                        help='number of iterations between two checkpoints of the training state, which are also saved after each epoch')
+    parser.add_argument('--keep_checkpoints', type=int, default=3,
+                        help='number of checkpoints of the training state to keep')
+    parser.add_argument('--metrics_every', type=int, default=50,
+                        help='number of iterations whose losses are aggregated (mean, min, max) in a log entry')
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help='.jsonl or .csv file the losses are logged to, defaults to metrics.jsonl in the output directory')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the order of the training samples in each epoch')
+    parser.add_argument('--decode_backend', type=str, default='pil', choices=DECODE_BACKENDS,
+                        help='pil decodes images at full size, draft decodes JPEGs at a reduced size, see data/image_decode.py')
+    parser.add_argument('--precision', type=str, default='fp32', choices=list(PRECISIONS),
+                        help='fp16 or bf16 train with autocast mixed precision, fp16 with loss scaling, see utils/amp.py')
+    parser.add_argument('--fuse_vgg', action=argparse.BooleanOptionalAction, default=False,
+                        help='compute the VGG features of the fake and real images in a single batch, faster but keeps the real activations')
+    parser.add_argument('--g_every', type=int, default=1,
+                        help='number of D steps per G step, the G step is skipped in the others, see utils/training_step.py')
+    parser.add_argument('--vgg_cache_dir', type=str, default=None,
+                        help='directory of an on-disk cache of the VGG features of the real images, see data/vgg_cache.py')
+    parser.add_argument('--vgg_cache_gb', type=float, default=None,
+                        help='size budget of the VGG feature cache in GiB, only the shallowest slices that fit are cached')
+    parser.add_argument('--distributed', action=argparse.BooleanOptionalAction, default=False,
+                        help='one process per GPU, launched with torchrun --nproc_per_node=<GPUs> train.py --distributed, '
+                             'batch_size is split among the processes, resume with the same number of processes')
+    parser.add_argument('--distributed_timeout', type=float, default=120,
+                        help='timeout in minutes of the collectives of the processes, it must cover the validation, which only rank 0 runs')
     args = parser.parse_args()
 
     # train params
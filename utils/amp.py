@@ -0,0 +1,80 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.spectral_norm import SpectralNorm
+
+
+# training precisions and their autocast dtype, fp32 disables autocast
+PRECISIONS = {
+    'fp32': None,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+# device-generic since torch 2.3, torch.cuda.amp.GradScaler is deprecated there
+GradScaler = getattr(getattr(torch, 'amp', None), 'GradScaler', None) or torch.cuda.amp.GradScaler
+
+
+def autocast(precision: str, device_type: str = 'cuda') -> torch.autocast:
+    '''
+    Mixed precision context of the forward passes and the losses
+
+    Args:
+        precision: one of PRECISIONS
+        device_type: 'cuda' or 'cpu'
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unsupported precision {precision}, expected one of {tuple(PRECISIONS)}')
+    if PRECISIONS[precision] is None:
+        return torch.autocast(device_type, enabled=False)
+    return torch.autocast(device_type, dtype=PRECISIONS[precision])
+
+
+def grad_scaler(precision: str) -> GradScaler:
+    '''
+    Loss scaler of a network, only enabled for fp16, whose gradients would
+    underflow, bf16 has the exponent range of fp32. G and D each need their
+    own, they are stepped at different times and their losses have different
+    scales.
+    '''
+    if GradScaler is torch.cuda.amp.GradScaler:
+        return GradScaler(enabled=precision == 'fp16')
+    return GradScaler('cuda', enabled=precision == 'fp16')
+
+
+class Float32SpectralNorm(object):
+    '''
+    Forward pre-hook running a SpectralNorm hook with autocast disabled
+
+    Under autocast the power iteration would compute u, v and sigma in half
+    precision and write them into the float32 buffers, the normalized weight
+    is computed in float32 and cast by the layers that use it.
+    '''
+
+    def __init__(self, hook: SpectralNorm):
+        self.hook = hook
+
+    def __call__(self, module: nn.Module, inputs):
+        weight = getattr(module, self.hook.name + '_orig')
+        with torch.autocast(weight.device.type, enabled=False):
+            return self.hook(module, inputs)
+
+    def __getattr__(self, name):
+        # attributes of the wrapped hook, e.g. name and n_power_iterations
+        if name == 'hook':
+            raise AttributeError(name)
+        return getattr(self.hook, name)
+
+
+def float32_spectral_norm(module: nn.Module) -> nn.Module:
+    '''
+    Runs the power iterations of all the spectral normalized layers of module
+    in float32, see Float32SpectralNorm. The state dicts are unchanged.
+
+    Returns:
+        module
+    '''
+    for submodule in module.modules():
+        for key, hook in submodule._forward_pre_hooks.items():
+            if isinstance(hook, SpectralNorm):
+                submodule._forward_pre_hooks[key] = Float32SpectralNorm(hook)
+    return module
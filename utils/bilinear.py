@@ -37,8 +37,8 @@ def crop_bbox(feats, bbox, HH, WW=None, backend='cudnn'):
     x0, y0 = 2 * bbox[:, 0] - 1, 2 * bbox[:, 1] - 1
     x1, y1 = 2 * (bbox[:, 2] + bbox[:, 0]) - 1, 2 * (bbox[:, 3] + bbox[:, 1]) - 1
 
-    X = tensor_linspace(x0, x1, steps=WW).view(N, 1, WW).expand(N, HH, WW).cuda(device=feats.device)
-    Y = tensor_linspace(y0, y1, steps=HH).view(N, HH, 1).expand(N, HH, WW).cuda(device=feats.device)
+    X = tensor_linspace(x0, x1, steps=WW).view(N, 1, WW).expand(N, HH, WW).to(feats.device)
+    Y = tensor_linspace(y0, y1, steps=HH).view(N, HH, 1).expand(N, HH, WW).to(feats.device)
 
     if backend == 'jj':
         return bilinear_sample(feats, X, Y)
@@ -152,7 +152,7 @@ def masks_to_layout(boxes, masks, H, W=None):
     
     # batch*num_o = total number of masks
     # (batch*num_o, H, W, 2), where the last dimension are mask pixel coordinates x, y
-    grid = _boxes_to_grid(boxes.view(b*num_o, -1), H, W).float().cuda(device=masks.device)
+    grid = _boxes_to_grid(boxes.view(b*num_o, -1), H, W).float().to(masks.device)
     
     # resize masks to (batch*num_o, 1, M, M)
     img_in = masks.float().view(b*num_o, 1, M, M)
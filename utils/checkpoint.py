@@ -0,0 +1,149 @@
+import inspect
+import os
+import queue
+import random
+import re
+import threading
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import torch
+
+
+CHECKPOINT_PATTERN = re.compile(r'checkpoint_(\d+)_(\d+)\.pth')
+
+
+def checkpoint_name(epoch: int, iteration: int) -> str:
+    '''Name of the checkpoint to resume from the given iteration of an epoch'''
+    return f'checkpoint_{epoch}_{iteration}.pth'
+
+
+def list_checkpoints(checkpoint_dir: Union[str, Path]) -> 'list[Path]':
+    '''Returns the checkpoints in checkpoint_dir, from the oldest to the latest training position'''
+    if not Path(checkpoint_dir).is_dir():
+        return []
+
+    checkpoints = []
+    for path in Path(checkpoint_dir).iterdir():
+        match = CHECKPOINT_PATTERN.fullmatch(path.name)
+        if match is not None:
+            checkpoints.append(((int(match.group(1)), int(match.group(2))), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(checkpoint_dir: Union[str, Path]) -> Path:
+    '''Returns the latest checkpoint in checkpoint_dir, None if there is none'''
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def snapshot(state):
+    '''
+    Copies the tensors of a (nested) state to the CPU, so that it can be
+    serialized while training goes on and modifies the originals
+    '''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def get_rng_states() -> dict:
+    '''Returns the states of the python, numpy, torch and CUDA random generators'''
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_states(states: dict):
+    '''Restores the random generators from get_rng_states'''
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def save_checkpoint(path: Union[str, Path], state: dict):
+    '''Saves a checkpoint atomically, an interrupted save never replaces or leaves a partial file'''
+    tmp = Path(f'{path}.tmp')
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path: Union[str, Path]) -> dict:
+    '''Loads a checkpoint on the CPU'''
+    # the RNG states aren't tensors, newer versions of torch.load
+    # only accept them with weights_only=False
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    return torch.load(path, map_location='cpu')
+
+
+class CheckpointWriter(threading.Thread):
+    '''
+    Saves training checkpoints in the background
+
+    save() copies the state to the CPU and returns, the copy is serialized
+    and written by a thread, so that the training loop only waits for the
+    device to host copy. Only the last keep_last checkpoints are kept.
+
+    Args:
+        checkpoint_dir: output directory of the checkpoints
+        keep_last: number of checkpoints to keep, None keeps all of them
+        max_pending: number of snapshots waiting to be written before save() blocks
+    '''
+
+    def __init__(self, checkpoint_dir: Union[str, Path], keep_last: int = 3, max_pending: int = 1):
+        super().__init__(daemon=True)
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.keep_last = keep_last
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                name, state = item
+                save_checkpoint(Path(self.checkpoint_dir, name), state)
+                self.prune()
+            except Exception as error:
+                self.error = error
+
+    def prune(self):
+        if self.keep_last is None:
+            return
+        checkpoints = list_checkpoints(self.checkpoint_dir)
+        for path in checkpoints[:max(len(checkpoints) - self.keep_last, 0)]:
+            path.unlink()
+
+    def save(self, epoch: int, iteration: int, state: dict):
+        '''Saves the state to resume training from the given iteration of an epoch'''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((checkpoint_name(epoch, iteration), snapshot(state)))
+
+    def close(self):
+        '''Waits for the pending checkpoints to be written'''
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
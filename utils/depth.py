@@ -1,48 +1,131 @@
-from operator import itemgetter
+from collections import defaultdict
+import argparse
+import hashlib
 import os
+import queue
+import threading
 from pathlib import Path
 import cv2
 import numpy as np
 import torch
+from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
+from data.annotation_cache import load_cache, save_cache
+from data.depth_pack import DTYPES, DepthPackWriter
 # from data.datasets import get_dataset
 import matplotlib.pyplot as plt
-from utils.util import normalize_tensor, scale_boxes
+from utils.util import scale_boxes
 # from torchvision.utils import draw_bounding_boxes
-from torchvision.transforms.functional import crop
-from torch.nn.functional import pad
 
 device = torch.device(
     "cuda") if torch.cuda.is_available() else torch.device("cpu")
 
 
-def depth_estimation(dataset, ds, mode, visualize=True, save=False, limit=None):
+class _DepthInputs(Dataset):
+    '''Reads and transforms the images for depth_estimation, in the DataLoader workers'''
+
+    def __init__(self, indices, image_paths, transform):
+        self.indices = indices
+        self.image_paths = image_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        image = cv2.imread(str(self.image_paths[i]))
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        # the transform returns a batch of one image
+        return self.indices[i], self.transform(image).squeeze(0)
+
+
+def _save_depthmap(path, depthmap: np.ndarray):
+    # written under a temporary name and renamed, so that
+    # an interrupted run never leaves a partial depthmap
+    tmp = Path(f'{path}.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, depthmap)
+    os.replace(tmp, path)
+
+
+class _DepthWriter(threading.Thread):
+    '''Saves depthmaps in the background with save(*item), so that inference doesn't wait for the disk'''
+
+    def __init__(self, save, max_pending: int = 64):
+        super().__init__(daemon=True)
+        self.save = save
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.save(*item)
+            except Exception as error:
+                self.error = error
+
+    def put(self, *item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def depth_estimation(dataset, ds, mode, visualize=True, save=False, limit=None, batch_size=8,
+                     num_workers=4, model=None, transform=None, save_path=None, pack_writer=None):
     '''
     Use MiDaS Large to estimate depth from each image in the dataset and save
     the depthmaps as .npy files, currently works for coco
 
+    The images are read and transformed in DataLoader workers, images with the
+    same transformed size go through the model in batches and the depthmaps
+    are saved by a background thread. Images whose depthmap is already saved
+    are skipped, so an interrupted run resumes where it stopped.
+
     Args:
-        dataset: Dataset object from get_dataset, returning the images' filenames
+        dataset: CocoSceneGraphDataset from get_dataset, depthmaps have its image size
+                 or the original image size if it has none
         ds: name of the dataset, coco or vg
         mode: train or val
         visualize: visualize the resulting depthmaps
         save: save depthmaps
         limit: how many images to process 
+        batch_size: number of images in an inference batch
+        num_workers: DataLoader workers reading and transforming the images
+        model: depth model taking (B, 3, h, w) images and returning (B, h, w) depths,
+               with transform, the transform of a (H, W, 3) RGB image to a (1, 3, h, w)
+               tensor, defaults to MiDaS Large, a small model can stand in on CPU
+        save_path: output directory, defaults to datasets/{ds}-depth/{mode}
+        pack_writer: (optional) data.depth_pack.DepthPackWriter, if given with save
+                     the depthmaps are added to the pack instead of saved as .npy files
     '''
 
     # # load dataset
     # dataset = get_dataset(ds, None, mode, return_filenames=True)
 
-    save_path = Path('datasets', ds + '-depth', mode)
+    if save_path is None:
+        save_path = Path('datasets', ds + '-depth', mode)
 
     # create dir structure
-    if save and not save_path.is_dir():
+    if save and pack_writer is None and not Path(save_path).is_dir():
         os.makedirs(save_path)
 
-    # Intel MiDaS Large
-    model = torch.hub.load("intel-isl/MiDaS", 'DPT_Large')
-    midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
-    transform = midas_transforms.dpt_transform
+    if model is None:
+        # Intel MiDaS Large
+        model = torch.hub.load("intel-isl/MiDaS", 'DPT_Large')
+        midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
+        transform = midas_transforms.dpt_transform
 
     model.to(device)
     model.eval()
@@ -50,104 +133,313 @@ def depth_estimation(dataset, ds, mode, visualize=True, save=False, limit=None):
     if limit is None:
         limit = len(dataset)
 
-    for index in tqdm(range(limit)):
-        image, _, _, filename, flip = dataset[index]
-        o_image = torch.clone(image)
-
-        if not flip:
-            # apply transforms to resize and normalize the image
-            image = cv2.imread(str(Path(dataset.image_dir, filename)))
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = transform(image).to(device)
-
-            # predict depth
-            with torch.no_grad():
-                predicted_depth = model(image)
-
-                # interpolate to original size
-                prediction = torch.nn.functional.interpolate(
-                    predicted_depth.unsqueeze(1),
-                    size=o_image.shape[-2:],
-                    mode="bicubic",
-                    align_corners=False,
-                )
-                prediction = prediction.squeeze().cpu().numpy()
-
+    # flipped indices have the same depthmap flipped, only unflipped images are processed
+    indices = range(min(limit, len(dataset.image_ids)))
+    filenames = [dataset.image_id_to_filename[dataset.image_ids[index]] for index in indices]
+
+    if save and pack_writer is not None:
+        # skip the depthmaps packed by a previous run
+        indices = [index for index in indices if filenames[index] not in pack_writer]
+    elif save:
+        # skip the depthmaps saved by a previous run
+        indices = [index for index in indices
+                   if not Path(save_path, filenames[index] + '.npy').is_file()]
+
+    loader = DataLoader(_DepthInputs(indices, [Path(dataset.image_dir, filenames[index]) for index in indices],
+                                     transform),
+                        batch_size=None, shuffle=False, num_workers=num_workers,
+                        pin_memory=torch.cuda.is_available())
+
+    writer = None
+    if save and pack_writer is not None:
+        writer = _DepthWriter(pack_writer.add)
+    elif save:
+        writer = _DepthWriter(_save_depthmap)
+
+    def output_size(index):
+        # size of the dataset images, as (H, W)
+        if dataset.image_size[0] is not None:
+            return tuple(dataset.image_size)
+        W, H = dataset.image_id_to_size[dataset.image_ids[index]]
+        return (H, W)
+
+    def predict(batch):
+        images = torch.stack([image for _, image in batch]).to(device, non_blocking=True)
+
+        # predict depth
+        with torch.no_grad():
+            predicted_depth = model(images)
+
+            # interpolate to original size
+            predictions = torch.nn.functional.interpolate(
+                predicted_depth.unsqueeze(1),
+                size=output_size(batch[0][0]),
+                mode="bicubic",
+                align_corners=False,
+            )
+            predictions = predictions.squeeze(1).cpu().numpy()
+
+        for (index, _), prediction in zip(batch, predictions):
             # visualize
             if visualize:
+                o_image = dataset[index][0]
                 _, axs = plt.subplots(1, 2)
                 axs[0].imshow(o_image.permute(1, 2, 0) * 0.5 + 0.5)
                 axs[1].imshow(prediction, cmap='gray')
                 plt.show()
 
             # save depthmap
-            if save:
-                np.save(Path(save_path, filename + '.npy'), prediction)
+            if save and pack_writer is not None:
+                writer.put(filenames[index], prediction)
+            elif save:
+                writer.put(Path(save_path, filenames[index] + '.npy'), prediction)
+
+    # images waiting for a batch, by transformed size and output size
+    pending = defaultdict(list)
+
+    try:
+        for index, image in tqdm(loader):
+            key = (tuple(image.shape), output_size(index))
+            pending[key].append((index, image))
+
+            if len(pending[key]) == batch_size:
+                predict(pending.pop(key))
+
+        for batch in pending.values():
+            predict(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def box_depth_table_key(obj_offsets: np.ndarray, obj_boxes: np.ndarray) -> str:
+    '''
+    Key of a box depth table, the depths are only valid for the exact same
+    objects in the exact same order
+    '''
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(obj_offsets, dtype=np.int64).tobytes())
+    sha.update(np.ascontiguousarray(obj_boxes, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def load_box_depth_table(depth_dir, obj_offsets: np.ndarray, obj_boxes: np.ndarray):
+    '''
+    Loads the table built by build_box_depth_table for these objects
+
+    Returns:
+        memory-mapped float32 array of shape (M, 2), depths of each object
+        of the flat arrays unflipped and flipped, or None if there is no table
+    '''
+    cached = load_cache(Path(depth_dir, 'box_depths'), box_depth_table_key(obj_offsets, obj_boxes))
+    if cached is None:
+        return None
+    return cached[0]['depths']
+
+
+class _BoxDepths(Dataset):
+    '''Depths of the real objects of each image, for both flips, from the depthmaps'''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset.image_ids)
+
+    def __getitem__(self, index):
+        ds = self.dataset
+        filename = ds.image_id_to_filename[ds.image_ids[index]]
+        num_o = int(ds.obj_offsets[index + 1] - ds.obj_offsets[index])
+
+        depthmap = ds.load_depthmap(filename)
+
+        # unflipped and flipped depthmaps and boxes as a batch of two
+        depthmaps = torch.stack((depthmap, torch.fliplr(depthmap)))
+        boxes = torch.from_numpy(np.stack([ds.get_objects(index, flip)[1] for flip in (False, True)]))
+
+        return get_bboxes_depths_from_depthmaps(depthmaps, boxes)[:, :num_o].t()
+
+
+def build_box_depth_table(dataset, num_workers: int = 8):
+    '''
+    Computes once the depth of every box of a CocoSceneGraphDataset, unflipped
+    and flipped, from its depthmaps (.npy files in dataset.depth_dir or its
+    depth pack), and saves them in box_depths next to the depthmaps, so that
+    training doesn't load the depthmaps anymore
+
+    The table is tied to the dataset's objects (filtering arguments), a
+    dataset with different objects needs its own table.
+
+    Args:
+        dataset: CocoSceneGraphDataset with depth_dir or depth_pack_dir set
+        num_workers: DataLoader workers loading the depthmaps
+    '''
+    loader = DataLoader(_BoxDepths(dataset), batch_size=None, shuffle=False, num_workers=num_workers)
+    depths = torch.cat([d for d in tqdm(loader)], dim=0).float().numpy()
+
+    save_cache(Path(dataset.box_depth_dir, 'box_depths'),
+               box_depth_table_key(dataset.obj_offsets, dataset.obj_boxes),
+               {'depths': depths}, {'num_images': len(dataset.image_ids)})
 
 
 def get_bboxes_depths_from_depthmap(depthmap: torch.Tensor, boxes: torch.Tensor) -> torch.Tensor:
     '''
     Computes depth values for each bounding box from the depthmap
     '''
+    return get_bboxes_depths_from_depthmaps(depthmap.unsqueeze(0), boxes.unsqueeze(0))[0]
 
-    # save number of boxes
-    num_o = boxes.shape[0]
 
-    # exclude dummy objects
-    # always in the last rows of the tensor
-    boxes = boxes[boxes[:, 0] >= 0]
+def get_bboxes_depths_from_depthmaps(depthmaps: torch.Tensor, boxes: torch.Tensor) -> torch.Tensor:
+    '''
+    Computes depth values for each bounding box of a batch of depthmaps, all
+    boxes at once: the sum of a box is rows^T @ depthmap @ cols, with rows and
+    cols the indicator vectors of the box rows and columns, so the depthmap
+    is read once by a single batched matmul
+
+    Args:
+        depthmaps: tensor of shape (B, H, W)
+        boxes: tensor of shape (B, O, 4) in the (x, y, w, h) format, in the range (0,1),
+               dummy objects have negative coordinates
+    Returns:
+        depths: float tensor of shape (B, O), box depths normalized to (0,1) within
+                each depthmap, -0.5 for dummy objects
+    '''
+    B, H, W = depthmaps.shape
 
     # scale boxes to image size
-    # boxes with width and height
-    size_boxes = scale_boxes(
-        boxes, depthmap.shape[-2:], 'inverse_size', dtype=torch.int)
+    left, top, width, height = scale_boxes(boxes, (H, W), 'size', dtype=torch.long).unbind(-1)
 
-    # crop the boxes from the depthmap
-    crops = [crop(depthmap, *(box.tolist()))
-             for box in size_boxes]
+    # indicators of the columns (B, O, W) and rows (B, O, H) of each box
+    # inside the depthmap, the crop is zero-padded outside of it
+    columns = torch.arange(W, device=depthmaps.device)
+    columns = (columns >= left.unsqueeze(-1)) & (columns < (left + width).unsqueeze(-1))
+    rows = torch.arange(H, device=depthmaps.device)
+    rows = (rows >= top.unsqueeze(-1)) & (rows < (top + height).unsqueeze(-1))
 
-    # compute mean depth for each crop
-    depths = torch.tensor([crop_.mean() for crop_ in crops])
+    # sums of the rows of each box (B, O, H), then of the boxes,
+    # rows are summed in float64 to keep the precision of large boxes
+    strips = torch.bmm(depthmaps, columns.to(depthmaps.dtype).transpose(1, 2)).transpose(1, 2)
+    sums = (strips.double() * rows).sum(dim=-1)
 
-    # normalize depths
-    depths = normalize_tensor(depths, (0, 1))
+    # mean depth of each crop, the zero padding counts in the area
+    depths = (sums / (width * height)).float()
 
-    # set -0.5 depth to dummy objects
-    # since they are in the last rows
-    # simply append them
-    depths = pad(depths, (0, num_o-depths.shape[0]), value=-0.5)
+    # exclude dummy objects
+    real = boxes[..., 0] >= 0
+
+    # normalize depths to (0,1) within each depthmap, as normalize_tensor
+    min_ = depths.masked_fill(~real, float('inf')).amin(dim=1, keepdim=True)
+    max_ = depths.masked_fill(~real, float('-inf')).amax(dim=1, keepdim=True)
+    depths = (depths - min_) * 1.0 / (max_ - min_).clamp(min=1e-12) + 0.0
 
-    return depths
+    # set -0.5 depth to dummy objects
+    return depths.masked_fill(~real, -0.5)
 
 
 def get_depth_layout(depths: torch.Tensor, size: tuple[int, int], boxes: torch.Tensor) -> torch.Tensor:
     '''
     Puts all bounding boxes depths in depth order in a single tensor to be visualized
     '''
+    return get_depth_layouts(depths.unsqueeze(0), size, boxes.unsqueeze(0))[0]
 
-    # compose new depthmap for visualization
-    # depths as list of tuples (box index, depth value)
-    # excluding dummy objects with negative depth
-    boxes_depths = [(i, d) for i, d in enumerate(depths[depths >= 0])]
-    # sort tuples by depth value, itemgetter gets the depth (position 1) from each tuple
-    boxes_depths = sorted(boxes_depths, key=itemgetter(1))
-
-    # boxes with xmax and ymax
-    coord_boxes = scale_boxes(
-        boxes, size, 'coordinates', dtype=torch.int)
-
-    # add bboxes depths to an empty depthmap in depth order
-    depth_layout = torch.zeros(size)
-
-    for i, d in boxes_depths:
-        # get bounding box coordinates
-        x, y, xmax, ymax = coord_boxes[i]
 
-        # create a tensor with every element equal to the bbox depth
-        # of the same shape of the bounding box
-        patch = d.clone().repeat(depth_layout[..., y:ymax, x:xmax].shape)
+def get_depth_layouts(depths: torch.Tensor, size: tuple[int, int], boxes: torch.Tensor) -> torch.Tensor:
+    '''
+    Renders the depth layouts of a batch at once: each pixel takes the depth of
+    the deepest box covering it, as painting the boxes in increasing depth order
+    would do, and 0 where there are no boxes, so the boxes don't need sorting
 
-        # write the new values
-        depth_layout[..., y:ymax, x:xmax] = patch
+    Args:
+        depths: tensor of shape (B, O), dummy objects have negative depth
+        size: tuple (height, width) of the layouts
+        boxes: tensor of shape (B, O, 4) in the (x, y, w, h) format, in the range (0,1),
+               moved to the device of depths, e.g. CPU boxes and CUDA depths in train.py
+    Returns:
+        depth_layouts: float tensor of shape (B, height, width) on the device of depths
+    '''
+    H, W = size
+    boxes = boxes.to(depths.device)
 
-    return depth_layout
+    # boxes with xmax and ymax
+    x0, y0, x1, y1 = scale_boxes(boxes, size, 'coordinates', dtype=torch.long).unbind(-1)
+
+    def slice_bounds(start, stop, length):
+        # bounds of the slice [start:stop] of a dimension of the given length
+        start = torch.where(start < 0, start + length, start).clamp(0, length)
+        stop = torch.where(stop < 0, stop + length, stop).clamp(0, length)
+        return start, stop
+
+    x0, x1 = slice_bounds(x0, x1, W)
+    y0, y1 = slice_bounds(y0, y1, H)
+
+    # rows and columns covered by each box (B, O, H) and (B, O, W)
+    rows = torch.arange(H, device=boxes.device)
+    columns = torch.arange(W, device=boxes.device)
+    rows = (rows >= y0.unsqueeze(-1)) & (rows < y1.unsqueeze(-1))
+    columns = (columns >= x0.unsqueeze(-1)) & (columns < x1.unsqueeze(-1))
+
+    # excluding dummy objects with negative depth, since depths are not
+    # negative the background is 0 and the deepest box is painted last
+    depths = torch.where(depths >= 0, depths, depths.new_zeros(()))
+
+    # paint one box of every layout at a time, keeping the maximum depth
+    layouts = depths.new_zeros(depths.shape[0], H, W)
+    for o in range(depths.shape[1]):
+        box_layouts = (rows[:, o] * depths[:, o, None]).unsqueeze(-1) * columns[:, o].unsqueeze(-2)
+        torch.maximum(layouts, box_layouts, out=layouts)
+
+    return layouts
+
+
+if __name__ == '__main__':
+    from data.datasets import get_dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='coco',
+                        help='dataset to estimate depth for, only coco is supported')
+    parser.add_argument('--mode', type=str, default='train',
+                        help='split to process, train or val')
+    parser.add_argument('--img_size', type=int, default=None,
+                        help='size of the depthmaps, defaults to the original image size')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='number of images to process')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='number of images in an inference batch')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='number of workers reading the images')
+    parser.add_argument('--pack_path', type=str, default=None,
+                        help='write the depthmaps to a depth pack in this directory instead of .npy files, '
+                             'with --box_depths read them from it')
+    parser.add_argument('--max_size', type=int, default=256,
+                        help='maximum size of the longer side of the packed depthmaps')
+    parser.add_argument('--dtype', type=str, default='uint16', choices=DTYPES,
+                        help='storage type of the packed depthmaps')
+    parser.add_argument('--box_depths', action=argparse.BooleanOptionalAction, default=False,
+                        help='instead of estimating depth, build the box depth table of the split from its '
+                             'depthmaps, training then reads the table instead of the depthmaps')
+    parser.add_argument('--depth_dir', type=str, default=None,
+                        help='directory of the .npy depthmaps read with --box_depths, '
+                             'defaults to datasets/<dataset>-depth/<mode>')
+    args = parser.parse_args()
+
+    if args.box_depths:
+        # the boxes are normalized, the table doesn't depend on the image size
+        dataset = get_dataset(args.dataset, args.img_size or 128, args.mode, depth_dir=args.depth_dir,
+                              return_depth=True, depth_pack_dir=args.pack_path)
+        build_box_depth_table(dataset, num_workers=args.num_workers)
+        print(f'Box depth table of {len(dataset.image_ids)} images saved in '
+              f'{Path(dataset.box_depth_dir, "box_depths")}')
+        raise SystemExit
+
+    pack_writer = None
+    if args.pack_path is not None:
+        pack_writer = DepthPackWriter(args.pack_path, args.max_size, args.dtype)
+
+    try:
+        depth_estimation(get_dataset(args.dataset, args.img_size, args.mode), args.dataset, args.mode,
+                         visualize=False, save=True, limit=args.limit,
+                         batch_size=args.batch_size, num_workers=args.num_workers,
+                         pack_writer=pack_writer)
+    finally:
+        if pack_writer is not None:
+            pack_writer.close()
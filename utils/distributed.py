@@ -0,0 +1,58 @@
+import datetime
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+def init_distributed(timeout: datetime.timedelta = None) -> 'tuple[int, int, int]':
+    '''
+    Initializes the default process group of a process launched by torchrun,
+    from the RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT
+    environment variables. Processes use NCCL and their local GPU if CUDA is
+    available, gloo on the CPU otherwise.
+
+    Args:
+        timeout: timeout of the collectives, torch's default if None, it must
+                 cover the work rank 0 does alone, e.g. validation
+    Returns:
+        (rank, local_rank, world_size)
+    '''
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group('nccl', **kwargs)
+    else:
+        dist.init_process_group('gloo', **kwargs)
+    return dist.get_rank(), local_rank, dist.get_world_size()
+
+
+def broadcast_module(module: nn.Module, src: int = 0):
+    '''Copies the parameters and buffers of src's module to the other processes, e.g. their random initialization'''
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+def average_gradients(module: nn.Module):
+    '''
+    Averages the gradients of module across the processes, in a single
+    all-reduce of the flattened gradients
+
+    Called between the backward pass and the optimizer step, instead of
+    DistributedDataParallel's hooks: D runs several forward passes per
+    backward and the G loss backpropagates through D, so the gradients are
+    averaged once they are complete, as StyleGAN2-ADA does. The gradients of
+    a process are in the scale of its GradScaler, which all processes keep in
+    sync: an inf or nan gradient is averaged into all of them, so they all
+    skip the step and lower the scale.
+    '''
+    grads = [p.grad for p in module.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([grad.flatten() for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for grad, averaged in zip(grads, flat.split([grad.numel() for grad in grads])):
+        grad.copy_(averaged.view_as(grad))
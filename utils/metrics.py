@@ -0,0 +1,170 @@
+import csv
+import json
+import numbers
+import queue
+import threading
+from pathlib import Path
+from typing import Union
+
+import torch
+
+
+class StdoutSink(object):
+    '''Prints the aggregated metrics'''
+
+    def __call__(self, step: int, values: dict):
+        print(f'step {step}: ' + ', '.join(f'{name}: {value:.4g}' for name, value in values.items()))
+
+
+class JsonlSink(object):
+    '''Appends the aggregated metrics to a JSON lines file, one line per flush'''
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def __call__(self, step: int, values: dict):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(dict(values, step=step)) + '\n')
+
+
+class CsvSink(object):
+    '''
+    Appends the aggregated metrics to a CSV file, the columns are the metrics
+    of the first flush, metrics added later are left out
+    '''
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.fields = None
+
+    def __call__(self, step: int, values: dict):
+        values = dict(values, step=step)
+        with open(self.path, 'a', newline='') as f:
+            if self.fields is None:
+                self.fields = list(values.keys())
+                if f.tell() == 0:
+                    csv.writer(f).writerow(self.fields)
+            csv.DictWriter(f, self.fields, extrasaction='ignore').writerow(values)
+
+
+class WandbSink(object):
+    '''Logs the aggregated metrics to the current wandb run, with the step as a metric'''
+
+    def __call__(self, step: int, values: dict):
+        import wandb
+        wandb.log(dict(values, step=step))
+
+
+def file_sink(path: Union[str, Path]):
+    '''CsvSink for .csv files, JsonlSink otherwise'''
+    return CsvSink(path) if Path(path).suffix == '.csv' else JsonlSink(path)
+
+
+class MetricsAccumulator(object):
+    '''
+    Aggregates training metrics without synchronizing with the device
+
+    Tensor metrics are accumulated where they are, as running sums, minimums
+    and maximums, without .item(). Every flush_every steps the accumulated
+    tensors are handed to a background thread, which copies them to the CPU,
+    waiting for the device in its place, and writes the mean, min and max
+    of each metric (name, name_min, name_max) to the sinks. Python numbers,
+    e.g. the epoch or the learning rate, are logged with their last value.
+
+    Args:
+        sinks: callables receiving (step, values) at each flush, e.g.
+               StdoutSink, JsonlSink, CsvSink or WandbSink
+        flush_every: number of steps aggregated in a flush
+        max_pending: number of flushes waiting to be written before flush() blocks
+    '''
+
+    def __init__(self, sinks: list, flush_every: int = 50, max_pending: int = 8):
+        self.sinks = sinks
+        self.flush_every = flush_every
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+
+        # group of metrics added together -> [count, sum, min, max]
+        self.groups = {}
+        self.last_values = {}
+        self.steps = 0
+        self.step = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, step: int, **metrics):
+        '''
+        Accumulates metrics of a training step, tensors must be scalars, the
+        metrics are flushed when a new step reaches flush_every steps
+        '''
+        if step != self.step:
+            if self.step is not None:
+                self.steps += 1
+                if self.steps >= self.flush_every:
+                    self.flush()
+            self.step = step
+
+        names = tuple(name for name, value in metrics.items() if isinstance(value, torch.Tensor))
+        for name, value in metrics.items():
+            if isinstance(value, numbers.Number):
+                self.last_values[name] = value
+        if not names:
+            return
+
+        # a single stacked tensor per group, three operations per step
+        values = torch.stack([metrics[name].detach() for name in names]).float()
+        group = self.groups.get(names)
+        if group is None:
+            self.groups[names] = [1, values, values, values]
+        else:
+            group[0] += 1
+            group[1] = group[1] + values
+            group[2] = torch.minimum(group[2], values)
+            group[3] = torch.maximum(group[3], values)
+
+    def flush(self):
+        '''Hands the metrics accumulated so far to the background thread'''
+        if self.error is not None:
+            raise self.error
+        if self.step is None:
+            return
+
+        groups = [(names, count, torch.stack((sum_ / count, min_, max_)))
+                  for names, (count, sum_, min_, max_) in self.groups.items()]
+        self.queue.put((self.step, groups, dict(self.last_values)))
+
+        # new tensors, the ones handed over are never modified
+        self.groups = {}
+        self.steps = 0
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                step, groups, last_values = item
+                values = dict(last_values)
+                for names, _, stats in groups:
+                    # waits for the device here instead of in the training loop
+                    means, mins, maxs = stats.tolist()
+                    for name, mean, min_, max_ in zip(names, means, mins, maxs):
+                        values[name] = mean
+                        values[f'{name}_min'] = min_
+                        values[f'{name}_max'] = max_
+                for sink in self.sinks:
+                    sink(step, values)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        '''Flushes the remaining metrics and waits for them to be written'''
+        if self.groups:
+            self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,150 @@
+import torch
+import torch.nn as nn
+
+from model.rcnn_discriminator import prepare_rois
+from utils.amp import GradScaler, autocast, grad_scaler
+from utils.distributed import average_gradients
+
+
+class TrainingStep(object):
+    '''
+    A LostGAN training iteration: a D step on the real and generated images
+    and, every g_every iterations, a G step
+
+    The ROI boxes of the batch are prepared once, as a new tensor that no
+    discriminator call modifies, and shared by the three netD calls (real,
+    detached fake and fake), see model.rcnn_discriminator.prepare_rois.
+
+    With g_every > 1 the G step is only taken every g_every iterations, on
+    the images generated for that iteration's D step, in the spirit of lazy
+    regularization: the D steps in between skip the G backward, the fake
+    netD forward with gradients and the feature matching losses. g_every=1
+    is the usual alternating schedule.
+
+    In distributed training each process trains on its part of the batch
+    with unwrapped networks, their gradients are averaged across the
+    processes before each optimizer step, see utils.distributed.
+
+    Args:
+        netG, netD: generator and discriminator, e.g. wrapped in DataParallel
+        g_optimizer, d_optimizer: their optimizers
+        vgg_loss: utils.util.VGGLoss
+        l1_loss: pixel loss
+        lamb_obj, lamb_img: weights of the object and image adversarial losses
+        precision: autocast precision, see utils.amp.PRECISIONS
+        g_scaler, d_scaler: gradient scalers, see utils.amp.grad_scaler
+        g_every: number of D steps per G step
+        distributed: average the gradients across the processes of the default group
+    '''
+
+    def __init__(self, netG: nn.Module, netD: nn.Module, g_optimizer: torch.optim.Optimizer,
+                 d_optimizer: torch.optim.Optimizer, vgg_loss: nn.Module, l1_loss: nn.Module,
+                 lamb_obj: float = 1.0, lamb_img: float = 0.1, precision: str = 'fp32',
+                 g_scaler: GradScaler = None, d_scaler: GradScaler = None,
+                 g_every: int = 1, distributed: bool = False):
+        self.netG = netG
+        self.netD = netD
+        self.g_optimizer = g_optimizer
+        self.d_optimizer = d_optimizer
+        self.vgg_loss = vgg_loss
+        self.l1_loss = l1_loss
+        self.lamb_obj = lamb_obj
+        self.lamb_img = lamb_img
+        self.precision = precision
+        self.g_scaler = g_scaler or grad_scaler('fp32')
+        self.d_scaler = d_scaler or grad_scaler('fp32')
+        self.g_every = g_every
+        self.distributed = distributed
+
+    def generate(self, z, bbox, label, depths=None) -> torch.Tensor:
+        if depths is not None:
+            return self.netG(z, bbox, y=label.squeeze(dim=-1), depths=depths)
+        return self.netG(z, bbox, y=label.squeeze(dim=-1))
+
+    def d_step(self, real_images, label, bbox, rois, z, depths=None) -> 'tuple[dict, torch.Tensor]':
+        '''Updates D, returns its losses and the generated images'''
+        self.netD.zero_grad()
+        with autocast(self.precision):
+            d_out_real, d_out_robj = self.netD(real_images, label=label, rois=rois)
+            d_loss_real = torch.nn.ReLU()(1.0 - d_out_real).mean()
+            d_loss_robj = torch.nn.ReLU()(1.0 - d_out_robj).mean()
+
+            fake_images = self.generate(z, bbox, label, depths)
+
+            d_out_fake, d_out_fobj = self.netD(fake_images.detach(), label=label, rois=rois)
+            d_loss_fake = torch.nn.ReLU()(1.0 + d_out_fake).mean()
+            d_loss_fobj = torch.nn.ReLU()(1.0 + d_out_fobj).mean()
+
+            d_loss = self.lamb_obj * (d_loss_robj + d_loss_fobj) + \
+                self.lamb_img * (d_loss_real + d_loss_fake)
+        self.d_scaler.scale(d_loss).backward()
+        if self.distributed:
+            average_gradients(self.netD)
+        self.d_scaler.step(self.d_optimizer)
+        self.d_scaler.update()
+
+        losses = {
+            'd_loss': d_loss,
+            'd_loss_real': d_loss_real,
+            'd_loss_fake': d_loss_fake,
+            'd_loss_robj': d_loss_robj,
+            'd_loss_fobj': d_loss_fobj
+        }
+        return losses, fake_images
+
+    def g_step(self, fake_images, real_images, label, rois, real_features=None) -> dict:
+        '''
+        Updates G, returns its losses. real_features are the VGG features of
+        the real images, e.g. from data.vgg_cache, computed by vgg_loss if None
+        '''
+        self.netG.zero_grad()
+        with autocast(self.precision):
+            g_out_fake, g_out_obj = self.netD(fake_images, label=label, rois=rois)
+            g_loss_fake = - g_out_fake.mean()
+            g_loss_obj = - g_out_obj.mean()
+
+            pixel_loss = self.l1_loss(fake_images, real_images).mean()
+            if real_features is None:
+                feat_loss = self.vgg_loss(fake_images, real_images)
+            else:
+                feat_loss = self.vgg_loss(fake_images, y_features=real_features)
+
+            g_loss = g_loss_obj * self.lamb_obj + g_loss_fake * self.lamb_img + pixel_loss + feat_loss
+        self.g_scaler.scale(g_loss).backward()
+        if self.distributed:
+            average_gradients(self.netG)
+        self.g_scaler.step(self.g_optimizer)
+        self.g_scaler.update()
+
+        return {
+            'g_loss_fake': g_loss_fake,
+            'g_loss_obj': g_loss_obj,
+            'g_loss': g_loss,
+            'pixel_loss': pixel_loss,
+            'feat_loss': feat_loss
+        }
+
+    def __call__(self, iteration: int, real_images, label, bbox, z, depths=None,
+                 real_features=None) -> 'tuple[dict, dict, torch.Tensor]':
+        '''
+        Trains on a batch
+
+        Args:
+            iteration: index of the iteration, the G step is taken if it's a multiple of g_every
+            real_images: (B, 3, H, W) images
+            label: (B, O, 1) labels, 0 for padding
+            bbox: (B, O, 4) normalized (x, y, w, h) boxes, not modified
+            z: (B, O, z_dim) latent object appearances
+            depths: (optional) object depths of the depth generator
+            real_features: (optional) VGG features of the real images
+        Returns:
+            (d_losses, g_losses, fake_images): losses of the D step, of the G
+                                               step (None if not taken) and
+                                               the generated images
+        '''
+        rois = prepare_rois(bbox, real_images.size(2))
+        d_losses, fake_images = self.d_step(real_images, label, bbox, rois, z, depths)
+        g_losses = None
+        if iteration % self.g_every == 0:
+            g_losses = self.g_step(fake_images, real_images, label, rois, real_features)
+        return d_losses, g_losses, fake_images
@@ -1,3 +1,6 @@
+import copy
+import functools
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -49,55 +52,132 @@ def truncted_random(num_o=8, thres=1.0):
 
 # VGG Features matching
 class Vgg19(torch.nn.Module):
-    def __init__(self, requires_grad=False):
+    # end (exclusive) of each slice in the VGG19 features, at relu1_1, relu2_1, relu3_1, relu4_1 and relu5_1
+    slice_ends = (2, 7, 12, 21, 30)
+
+    def __init__(self, requires_grad=False, num_slices=5, pretrained=True):
         super(Vgg19, self).__init__()
-        vgg_pretrained_features = models.vgg19(pretrained=True).features
-        self.slice1 = torch.nn.Sequential()
-        self.slice2 = torch.nn.Sequential()
-        self.slice3 = torch.nn.Sequential()
-        self.slice4 = torch.nn.Sequential()
-        self.slice5 = torch.nn.Sequential()
-        for x in range(2):
-            self.slice1.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(2, 7):
-            self.slice2.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(7, 12):
-            self.slice3.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(12, 21):
-            self.slice4.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(21, 30):
-            self.slice5.add_module(str(x), vgg_pretrained_features[x])
+        vgg_pretrained_features = models.vgg19(pretrained=pretrained).features
+        # only the slices up to num_slices are built and run
+        self.num_slices = num_slices
+        for i in range(num_slices):
+            start = self.slice_ends[i - 1] if i > 0 else 0
+            slice = torch.nn.Sequential()
+            for x in range(start, self.slice_ends[i]):
+                slice.add_module(str(x), vgg_pretrained_features[x])
+            setattr(self, f'slice{i + 1}', slice)
         if not requires_grad:
             for param in self.parameters():
                 param.requires_grad = False
 
-    def forward(self, X):
-        h_relu1 = self.slice1(X)
-        h_relu2 = self.slice2(h_relu1)
-        h_relu3 = self.slice3(h_relu2)
-        h_relu4 = self.slice4(h_relu3)
-        h_relu5 = self.slice5(h_relu4)
-        out = [h_relu1, h_relu2, h_relu3, h_relu4, h_relu5]
+    def forward(self, X, start=0):
+        # X is the output of the slice start, e.g. cached features, 0 for images
+        out = []
+        h = X
+        for i in range(start, self.num_slices):
+            h = getattr(self, f'slice{i + 1}')(h)
+            out.append(h)
         return out
 
 
 class VGGLoss(nn.Module):
-    def __init__(self):
+    '''
+    Perceptual loss, weighted L1 distance between the VGG19 features of the
+    fake and the real images
+
+    The real features don't depend on the generator, they are computed
+    without autograd, or in the same batch as the fake ones with fuse=True,
+    which makes larger batches at the cost of keeping their activations.
+    They can also be given, e.g. from data.vgg_cache.VGGFeatureCache, only
+    the slices deeper than the given ones are then computed.
+    VGG only runs up to the deepest slice with a non-zero weight. With
+    several GPUs the batch is split among persistent copies of the frozen
+    VGG, one per device, instead of replicating it at each call like
+    nn.DataParallel.
+
+    Args:
+        weights: weights of the slices, from relu1_1 to relu5_1
+        device_ids: GPUs the batch is split among, all the visible ones by
+                    default, the module runs on its own device if empty
+        fuse: run the fake and the real images in a single VGG forward
+        pretrained: load the ImageNet weights of VGG19
+    '''
+
+    def __init__(self, weights: 'list[float]' = (1.0 / 32, 1.0 / 16, 1.0 / 8, 1.0 / 4, 1.0),
+                 device_ids: 'list[int]' = None, fuse: bool = False, pretrained: bool = True):
         super(VGGLoss, self).__init__()
-        self.vgg = Vgg19().cuda()
+        self.weights = list(weights)
+        num_slices = max(i + 1 for i, weight in enumerate(self.weights) if weight)
+        self.vgg = Vgg19(num_slices=num_slices, pretrained=pretrained)
         self.criterion = nn.L1Loss()
-        self.weights = [1.0 / 32, 1.0 / 16, 1.0 / 8, 1.0 / 4, 1.0]
-
-    def forward(self, x, y):
-        x_vgg, y_vgg = self.vgg(x), self.vgg(y)
+        self.fuse = fuse
+
+        if device_ids is None:
+            device_ids = list(range(torch.cuda.device_count()))
+        self.device_ids = device_ids
+        if device_ids:
+            self.vgg.cuda(device_ids[0])
+        # copies of the frozen VGG on the other devices, made at the first call
+        self.replicas = None
+
+    def features(self, vgg, x, y=None, y_features=None):
+        '''Features of the fake images x and the detached features of the real images y'''
+        if y_features is not None:
+            with torch.no_grad():
+                y_vgg = [f.float() for f in y_features[:vgg.num_slices]]
+                if len(y_vgg) < vgg.num_slices:
+                    y_vgg += vgg(y_vgg[-1], start=len(y_vgg))
+            return vgg(x), y_vgg
+
+        if self.fuse:
+            features = vgg(torch.cat((x, y)))
+            return [f[:len(x)] for f in features], [f[len(x):].detach() for f in features]
+
+        with torch.no_grad():
+            y_vgg = vgg(y)
+        return vgg(x), y_vgg
+
+    def distance(self, vgg, x, y=None, y_features=None):
+        x_vgg, y_vgg = self.features(vgg, x, y, y_features)
         loss = 0
 
         for i in range(len(x_vgg)):
-            loss += self.weights[i] * \
-                self.criterion(x_vgg[i], y_vgg[i].detach())
+            if self.weights[i]:
+                loss += self.weights[i] * self.criterion(x_vgg[i], y_vgg[i])
 
         return loss
 
+    def split(self, *inputs):
+        '''Returns the VGG copies and the chunks of the inputs the batch is split into'''
+        if len(self.device_ids) <= 1:
+            return [self.vgg], [inputs]
+
+        if self.replicas is None:
+            self.replicas = [self.vgg] + [copy.deepcopy(self.vgg).cuda(device) for device in self.device_ids[1:]]
+
+        chunks = nn.parallel.scatter(inputs, self.device_ids)
+        return self.replicas[:len(chunks)], chunks
+
+    def real_features(self, y):
+        '''VGG features of the real images y, without autograd'''
+        replicas, chunks = self.split(y)
+        with torch.no_grad():
+            if len(replicas) == 1:
+                return replicas[0](*chunks[0])
+            return nn.parallel.gather(nn.parallel.parallel_apply(replicas, chunks), y.device)
+
+    def forward(self, x, y=None, y_features=None):
+        '''Loss of the fake images x, given the real images y or their features y_features'''
+        replicas, chunks = self.split(x, y, y_features)
+        if len(replicas) == 1:
+            return self.distance(replicas[0], *chunks[0])
+
+        distances = [functools.partial(self.distance, vgg) for vgg in replicas]
+        losses = nn.parallel.parallel_apply(distances, chunks)
+
+        # mean over the whole batch, the chunks may have different sizes
+        return sum(loss.to(x.device) * len(chunk[0]) for loss, chunk in zip(losses, chunks)) / len(x)
+
 
 def normalize_tensor(tensor: torch.Tensor, to_: 'tuple[float, float]', from_: 'tuple[float, float]' = None, eps: float = 1e-12) -> torch.Tensor:
     '''
@@ -120,10 +200,12 @@ def normalize_tensor(tensor: torch.Tensor, to_: 'tuple[float, float]', from_: 't
 
 def scale_boxes(boxes: torch.Tensor, shape: 'tuple[int, int]', format: str = None, dtype: torch.dtype = None) -> torch.Tensor:
     '''
-    Scales bounding boxes to match the given image size
+    Scales bounding boxes to match the given image size, coordinates and sizes
+    are scaled and truncated to integers separately (xmax is int(x*W)+int(w*W))
 
     Args:
-        boxes: Tensor of bounding boxes in the (x, y, w, h) format, in the range (0,1)
+        boxes: Tensor of bounding boxes of shape (..., 4), e.g. (O, 4) or (B, O, 4),
+               in the (x, y, w, h) format, in the range (0,1)
         shape: tuple (height, width)
         format: 'coordinates' for (xmin, ymin, xmax, ymax) format, default format,
                 'size' for (x, y, w, h) format,
@@ -132,28 +214,26 @@ def scale_boxes(boxes: torch.Tensor, shape: 'tuple[int, int]', format: str = Non
     Returns:
         boxes: Tensor of bounding boxes in the specified format, scaled up to the specified shape
     '''
-    bboxes = boxes.clone()
-
-    for i, box in enumerate(bboxes):
-        x, y, w, h = box
-        hh, ww = shape
-
-        if format is None or format == 'coordinates':
-            # (xmin, ymin, xmax, ymax)
-            bboxes[i] = torch.tensor(
-                (int(x*ww), int(y*hh), int(x*ww)+int(w*ww), int(y*hh)+int(h*hh)))
-        elif format == 'size':
-            # (x, y, w, h)
-            bboxes[i] = torch.tensor(
-                (int(x*ww), int(y*hh), int(w*ww), int(h*hh)))
-        elif format == 'inverse_size':
-            # (y, x, h, w)
-            bboxes[i] = torch.tensor(
-                (int(y*hh), int(x*ww), int(h*hh), int(w*ww)))
-        else:
-            raise ValueError('Unrecognized format')
-
-        if dtype is not None:
-            bboxes = bboxes.type(dtype)
+    hh, ww = shape
+
+    # scale in the boxes dtype and truncate towards zero, as int() does
+    x, y, w, h = boxes.unbind(-1)
+    x, y = (x * ww).trunc(), (y * hh).trunc()
+    w, h = (w * ww).trunc(), (h * hh).trunc()
+
+    if format is None or format == 'coordinates':
+        # (xmin, ymin, xmax, ymax)
+        bboxes = torch.stack((x, y, x + w, y + h), dim=-1)
+    elif format == 'size':
+        # (x, y, w, h)
+        bboxes = torch.stack((x, y, w, h), dim=-1)
+    elif format == 'inverse_size':
+        # (y, x, h, w)
+        bboxes = torch.stack((y, x, h, w), dim=-1)
+    else:
+        raise ValueError('Unrecognized format')
+
+    if dtype is not None:
+        bboxes = bboxes.type(dtype)
 
     return bboxes